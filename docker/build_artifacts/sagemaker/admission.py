@@ -0,0 +1,162 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Admission control of the python service: limits on the invocations each gunicorn worker
+runs at once per model and per TFS instance, with a bounded queue of waiting invocations.
+"""
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+
+class AdmissionRejected(Exception):
+    """Raised when an invocation is over the concurrency limit and cannot wait."""
+
+
+class ConcurrencyLimiter:
+    """Lets at most ``max_concurrent`` callers in at once, and up to ``max_queue`` more wait
+    for a slot for at most ``queue_timeout_seconds``. Everyone else is rejected at once.
+
+    ``on_queue_change`` is called with +1 and -1 as callers start and stop waiting.
+    """
+
+    def __init__(
+        self, name, max_concurrent, max_queue, queue_timeout_seconds, on_queue_change=None
+    ):
+        self.name = name
+        self._max_concurrent = max_concurrent
+        self._max_queue = max_queue
+        self._queue_timeout_seconds = queue_timeout_seconds
+        self._on_queue_change = on_queue_change
+        self._condition = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+
+    def _wait(self, deadline):
+        """Wait for a free slot, holding the condition, until the deadline."""
+        if self.waiting >= self._max_queue:
+            raise AdmissionRejected("{} is at its concurrency limit".format(self.name))
+        self._queue_changed(1)
+        try:
+            while self.in_flight >= self._max_concurrent:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise AdmissionRejected("timed out waiting for {}".format(self.name))
+                self._condition.wait(remaining)
+        finally:
+            self._queue_changed(-1)
+
+    def _queue_changed(self, change):
+        self.waiting += change
+        if self._on_queue_change:
+            self._on_queue_change(change)
+
+    def enter(self, deadline=None):
+        """Take a slot. The wait for a slot ends at ``deadline``, when it is earlier than
+        the queue timeout.
+
+        :raises AdmissionRejected: if no slot is free and the queue is full, or no slot
+            became free in time
+        """
+        with self._condition:
+            if self.in_flight >= self._max_concurrent:
+                wait_until = time.time() + self._queue_timeout_seconds
+                if deadline is not None:
+                    wait_until = min(wait_until, deadline)
+                self._wait(wait_until)
+            self.in_flight += 1
+
+    def exit(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    @contextmanager
+    def acquire(self, deadline=None):
+        """Hold a slot in the block."""
+        self.enter(deadline)
+        try:
+            yield
+        finally:
+            self.exit()
+
+
+class AdmissionController:
+    """Creates a ConcurrencyLimiter for each model and each TFS instance (by rest port) on
+    first use. A limit of 0 means no limit.
+
+    ``on_queue_change`` is called with the scope ('model' or 'instance'), the model name or
+    rest port, and +1 or -1. ``on_reject`` is called with the scope when an invocation is
+    rejected.
+    """
+
+    def __init__(
+        self,
+        max_per_model,
+        max_per_instance,
+        max_queue,
+        queue_timeout_seconds,
+        on_queue_change=None,
+        on_reject=None,
+    ):
+        self._limits = {"model": max_per_model, "instance": max_per_instance}
+        self._max_queue = max_queue
+        self._queue_timeout_seconds = queue_timeout_seconds
+        self._on_queue_change = on_queue_change
+        self._on_reject = on_reject
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def _limiter(self, scope, key):
+        if not self._limits[scope]:
+            return None
+        with self._lock:
+            limiter = self._limiters.get((scope, key))
+            if limiter is None:
+                on_queue_change = None
+                if self._on_queue_change:
+                    on_queue_change = functools.partial(self._on_queue_change, scope, key)
+                limiter = ConcurrencyLimiter(
+                    "{} {}".format(scope, key),
+                    self._limits[scope],
+                    self._max_queue,
+                    self._queue_timeout_seconds,
+                    on_queue_change,
+                )
+                self._limiters[(scope, key)] = limiter
+            return limiter
+
+    @contextmanager
+    def _admit(self, scope, key, deadline):
+        limiter = self._limiter(scope, key)
+        if limiter is None:
+            yield
+            return
+        try:
+            limiter.enter(deadline)
+        except AdmissionRejected:
+            if self._on_reject:
+                self._on_reject(scope)
+            raise
+        try:
+            yield
+        finally:
+            limiter.exit()
+
+    def model(self, model_name, deadline=None):
+        """Context manager holding a slot of the model, see ConcurrencyLimiter.enter."""
+        return self._admit("model", model_name, deadline)
+
+    def instance(self, rest_port, deadline=None):
+        """Context manager holding a slot of the TFS instance with the given rest port."""
+        return self._admit("instance", rest_port, deadline)
@@ -0,0 +1,419 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import asyncio
+import io
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import falcon
+
+import admission
+import grpc_utils
+import metrics
+import python_service
+import tfs_utils
+
+log = logging.getLogger(__name__)
+
+ASGI_EXECUTOR_THREADS = int(os.environ.get("SAGEMAKER_ASGI_EXECUTOR_THREADS", 16))
+
+
+class _Request:
+    """The parts of falcon.Request that the python service resources use, backed by an
+    ASGI scope and the fully received request body.
+    """
+
+    def __init__(self, scope, body):
+        self.uri = scope["path"]
+        self.method = scope["method"]
+        self.stream = io.BytesIO(body)
+        self._headers = {
+            name.decode("latin-1").lower(): value.decode("latin-1")
+            for name, value in scope["headers"]
+        }
+        has_length = body or "content-length" in self._headers
+        self.content_length = len(body) if has_length else None
+
+    def get_header(self, name):
+        return self._headers.get(name.lower())
+
+
+class _Response:
+    def __init__(self):
+        self.status = falcon.HTTP_200
+        self.body = None
+        self.content_type = None
+
+
+def _compile_uri_template(uri_template):
+    return re.compile("^" + re.sub(r"{(\w+)}", r"(?P<\1>[^/]+)", uri_template) + "$")
+
+
+class _AsyncResponseStream(python_service._ResponseStream):
+    """The chunks of a streamed response returned as an async iterator."""
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._chunks.__anext__()
+        except Exception:
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        try:
+            if hasattr(self._chunks, "aclose"):
+                await self._chunks.aclose()
+        finally:
+            self._release()
+
+
+def _is_tfs_unavailable(error):
+    if isinstance(error, aiohttp.ClientConnectorError):
+        return True
+    return python_service._is_tfs_unavailable(error)
+
+
+class AsyncInvoker:
+    """Serves invocations of a PythonServiceResource on the event loop.
+
+    ``async def`` handlers are awaited, sync handlers run on a bounded thread pool, and
+    TFS is called with aiohttp or with non-blocking gRPC calls.
+    """
+
+    def __init__(self, resource, executor):
+        self._resource = resource
+        self._executor = executor
+        self._aio_sessions = {}
+
+        self._handler = getattr(resource, "_handler", None)
+        self._input_handler = getattr(resource, "_input_handler", None)
+        self._output_handler = getattr(resource, "_output_handler", None)
+        self._has_inference_script = hasattr(resource, "_handler")
+
+    def _aio_session(self, rest_port):
+        if rest_port not in self._aio_sessions:
+            connector = aiohttp.TCPConnector(limit=tfs_utils.TFS_REST_POOL_SIZE)
+            self._aio_sessions[rest_port] = aiohttp.ClientSession(connector=connector)
+        return self._aio_sessions[rest_port]
+
+    async def close(self):
+        for session in self._aio_sessions.values():
+            await session.close()
+        self._aio_sessions = {}
+
+    async def _run(self, fn, *args):
+        if asyncio.iscoroutinefunction(fn):
+            return await fn(*args)
+        return await asyncio.get_event_loop().run_in_executor(self._executor, fn, *args)
+
+    async def send_to_tfs(self, data, context):
+        """The asyncio counterpart of python_service.send_to_tfs."""
+        with metrics.stage_timer(context.model_name, "tfs"):
+            return await self._send_to_tfs(data, context)
+
+    async def _send_to_tfs(self, data, context):
+        if python_service._use_grpc(data, context):
+            try:
+                request, row_format = await self._run(
+                    python_service._grpc_predict_request, data, context
+                )
+                return await grpc_utils.predict_async(
+                    context.channel, request, row_format, timeout=tfs_utils.time_remaining(context)
+                )
+            except ValueError as e:
+                log.debug("sending request over rest, cannot convert it to grpc: %s", e)
+
+        remaining = tfs_utils.time_remaining(context)
+        # without a deadline the timeout of the session applies
+        kwargs = {"timeout": aiohttp.ClientTimeout(total=remaining)} if remaining else {}
+        try:
+            async with context.aio_session.post(context.rest_uri, data=data, **kwargs) as response:
+                content = await response.read()
+                return tfs_utils.TfsResponse(response.status, content)
+        except asyncio.TimeoutError:
+            raise tfs_utils.DeadlineExceeded("request deadline exceeded")
+
+    async def _handlers(self, data, context):
+        if not self._has_inference_script:
+            response = await self.send_to_tfs(data.read(), context)
+            return response.content, context.accept_header
+
+        # handlers may run on the thread pool, so only their latency is recorded here
+        if self._handler:
+            with metrics.stage_timer(context.model_name, "handler"):
+                return await self._run(self._handler, data, context)
+
+        with metrics.stage_timer(context.model_name, "input_handler"):
+            processed_input = await self._run(self._input_handler, data, context)
+        response = await self.send_to_tfs(processed_input, context)
+        with metrics.stage_timer(context.model_name, "output_handler"):
+            return await self._run(self._output_handler, response, context)
+
+    async def _call_handlers(self, res, data, context, rest_port):
+        if self._resource._shed_expired(res, context):
+            return None
+        if python_service._is_protobuf_request(context):
+            return await self._run(
+                self._resource._call_protobuf_predict, res, data, context, rest_port
+            )
+        try:
+            res.status = falcon.HTTP_200
+            body, res.content_type = await self._handlers(data, context)
+            if hasattr(body, "__aiter__"):
+                body = _AsyncResponseStream(body)
+            elif python_service._is_stream(body):
+                body = python_service._stream_chunks(body, context.model_name)
+            res.body = body
+        except Exception as e:  # pylint: disable=broad-except
+            return self._resource._call_handlers_error(res, e, rest_port)
+        return None
+
+    def _parse_request(self, req, rest_port, grpc_port, **kwargs):
+        return tfs_utils.parse_request(
+            req,
+            rest_port,
+            grpc_port,
+            self._resource._tfs_default_model_name,
+            session=self._resource._session(rest_port),
+            aio_session=self._aio_session(rest_port),
+            **kwargs
+        )
+
+    async def invoke(self, req, res, model_name=None):
+        model = model_name or tfs_utils.parse_tfs_custom_attributes(req).get(
+            "tfs-model-name", self._resource._tfs_default_model_name
+        )
+        if not metrics.METRICS_ENABLED:
+            await self._admit_invocation(req, res, model_name, model)
+            return
+
+        with metrics.stage_timer(model, "total"):
+            await self._admit_invocation(req, res, model_name, model)
+        metrics.record_invocation(model, res.status)
+
+    async def _admit_invocation(self, req, res, model_name, model):
+        # waiting for a slot would block the event loop, so invocations over the
+        # concurrency limits are rejected without queueing
+        try:
+            admitted = python_service._admission.model(model, time.time())
+            with python_service._hold_for_stream(res, admitted):
+                await self._invoke(req, res, model_name)
+        except admission.AdmissionRejected as e:
+            self._resource._reject(res, e)
+
+    async def _invoke(self, req, res, model_name=None):
+        resource = self._resource
+        if python_service.SAGEMAKER_MULTI_MODEL_ENABLED:
+            # counted before the model is checked, so that it is not evicted meanwhile
+            invocation = resource._model_usage.invocation(model_name)
+            with python_service._hold_for_stream(res, invocation):
+                await self._invoke_model(req, res, model_name)
+            return
+
+        resource._retry_budget.deposit()
+        body = req.stream.getvalue()
+        tried = []
+        while True:
+            route = resource._router.route(excluded=tried)
+            with python_service._hold_for_stream(res, route) as instance:
+                data, context = self._parse_request(
+                    req,
+                    instance.rest_port,
+                    instance.grpc_port,
+                    channel=resource._channels[instance.grpc_port],
+                )
+                data = io.BytesIO(body)
+                error = await self._call_handlers_on_instance(
+                    res, data, context, instance.rest_port
+                )
+
+            if not _is_tfs_unavailable(error):
+                resource._router.record_success(instance)
+                return
+            resource._router.record_failure(instance)
+            tried.append(instance)
+            if not resource._can_retry(tried):
+                return
+            log.warning("{} is unavailable, retrying on another instance".format(instance))
+
+    async def _invoke_model(self, req, res, model_name):
+        resource = self._resource
+        entry = resource._check_model_loaded(res, model_name)
+        if entry is None:
+            return
+
+        rest_port = entry["rest_port"]
+        grpc_port = entry["grpc_port"]
+        data, context = self._parse_request(
+            req,
+            rest_port,
+            grpc_port,
+            model_name=model_name,
+            channel=resource._channel(grpc_port),
+        )
+        await self._call_handlers_on_instance(res, data, context, rest_port)
+
+    async def _call_handlers_on_instance(self, res, data, context, rest_port):
+        """Call the handlers holding a slot of the TFS instance, until they return or their
+        streamed response is sent.
+        """
+        hold_for_stream = python_service._hold_for_stream
+        with hold_for_stream(res, python_service._admission.instance(rest_port, time.time())):
+            with hold_for_stream(res, metrics.tfs_in_flight(rest_port)):
+                return await self._call_handlers(res, data, context, rest_port)
+
+
+class AsgiApplication:
+    """An ASGI application serving the routes of python_service.ServiceResources.
+
+    Invocations are handled on the event loop by AsyncInvoker. Every other request
+    (ping and the multi-model management API) calls the falcon resource method on the
+    thread pool.
+    """
+
+    def __init__(self, resources):
+        self._executor = ThreadPoolExecutor(max_workers=ASGI_EXECUTOR_THREADS)
+        self._routes = [
+            (_compile_uri_template(uri_template), resource)
+            for uri_template, resource in resources.routes()
+        ]
+        self._invoker = AsyncInvoker(resources._python_service_resource, self._executor)
+        self._invocation_resource = resources._python_service_resource
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self._invoker.close()
+                self._executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _match(self, path):
+        for pattern, resource in self._routes:
+            match = pattern.match(path)
+            if match:
+                return resource, match.groupdict()
+        return None, None
+
+    async def _http(self, scope, receive, send):
+        req = _Request(scope, await _read_body(receive))
+        res = _Response()
+
+        resource, params = self._match(req.uri)
+        responder = getattr(resource, "on_" + req.method.lower(), None)
+        if responder is None:
+            res.status = falcon.HTTP_404 if resource is None else falcon.HTTP_405
+        else:
+            try:
+                await self._respond(resource, responder, req, res, params)
+            except Exception as e:  # pylint: disable=broad-except
+                log.exception("exception handling request: {}".format(e))
+                res.status = falcon.HTTP_500
+                res.body = json.dumps({"error": str(e)})
+
+        await _send_response(send, res, self._executor)
+
+    async def _respond(self, resource, responder, req, res, params):
+        is_invocation = params.get("model_name") or "invocations" in req.uri
+        if resource is self._invocation_resource and req.method == "POST" and is_invocation:
+            await self._invoker.invoke(req, res, params.get("model_name"))
+        else:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(self._executor, lambda: responder(req, res, **params))
+
+
+async def _read_body(receive):
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        more_body = message.get("more_body", False)
+    return b"".join(chunks)
+
+
+async def _stream_body(send, body, executor):
+    """Send the chunks of a streamed body as they are produced. Chunks of a synchronous
+    iterator are produced in the executor, so that handlers do not block the event loop.
+    """
+    try:
+        if hasattr(body, "__aiter__"):
+            async for chunk in body:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        else:
+            loop = asyncio.get_event_loop()
+            while True:
+                chunk = await loop.run_in_executor(executor, next, body, None)
+                if chunk is None:
+                    break
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        # releases the slots the invocation holds, also when the client went away
+        if hasattr(body, "aclose"):
+            await body.aclose()
+        elif hasattr(body, "close"):
+            body.close()
+
+
+async def _send_response(send, res, executor):
+    body = res.body or b""
+    content_type = res.content_type or "application/json"
+    if python_service._is_stream(body):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": int(res.status.split(" ")[0]),
+                "headers": [
+                    (b"content-type", content_type.encode("latin-1")),
+                    (python_service.ACCEL_BUFFERING_HEADER.lower().encode("latin-1"), b"no"),
+                ],
+            }
+        )
+        await _stream_body(send, body, executor)
+        return
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    await send(
+        {
+            "type": "http.response.start",
+            "status": int(res.status.split(" ")[0]),
+            "headers": [
+                (b"content-type", content_type.encode("latin-1")),
+                (b"content-length", str(len(body)).encode("latin-1")),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+app = AsgiApplication(python_service.resources)
@@ -0,0 +1,134 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Splitting of multi-record request bodies into chunks that the python service processes
+in parallel, and merging of the responses of the chunks in the order of the records.
+
+CSV and JSON lines bodies are split by line, and JSON bodies in the TFS REST API row format
+by their "instances". CSV bodies must not have a header row.
+"""
+import json
+
+JSON_CONTENT_TYPE = "application/json"
+LINE_CONTENT_TYPES = (
+    "text/csv",
+    "application/jsonlines",
+    "application/jsonl",
+    "application/x-jsonlines",
+)
+
+
+class ChunkResponse:
+    """The status, body and content type the handlers set for one chunk."""
+
+    def __init__(self):
+        self.status = None
+        self.body = None
+        self.stream = None
+        self.content_type = None
+
+    def set_header(self, name, value):
+        pass
+
+
+def _media_type(content_type):
+    return (content_type or "").split(";")[0].strip().lower()
+
+
+def _split_lines(stream, records):
+    lines = []
+    # the body read so far, while it fits in one chunk
+    read = []
+    for line in iter(stream.readline, b""):
+        if read is not None:
+            read.append(line)
+        if not line.strip():
+            continue
+        if len(lines) == records:
+            yield b"".join(lines)
+            lines, read = [], None
+        lines.append(line)
+    yield b"".join(lines) if read is None else b"".join(read)
+
+
+def _split_instances(body, records):
+    try:
+        request = json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(request, dict) or not isinstance(request.get("instances"), list):
+        return None
+    instances = request["instances"]
+    chunks = []
+    for i in range(0, len(instances), records):
+        request["instances"] = instances[i : i + records]
+        chunks.append(json.dumps(request).encode("utf-8"))
+    return chunks
+
+
+def split(stream, content_type, records):
+    """Split a request body into chunks of at most ``records`` records each, reading it
+    from a file-like stream. Line bodies are read as their chunks are consumed, and JSON
+    bodies whole, since they are parsed whole.
+
+    :return: an iterator of the chunks, which is only the unchanged body if it is not a
+        multi-record body of a supported content type, or has no more than ``records``
+        records
+    """
+    media_type = _media_type(content_type)
+    if media_type in LINE_CONTENT_TYPES:
+        return _split_lines(stream, records)
+    body = stream.read()
+    chunks = _split_instances(body, records) if media_type == JSON_CONTENT_TYPE else None
+    return iter(chunks if chunks and len(chunks) > 1 else [body])
+
+
+def to_bytes(body):
+    if isinstance(body, str):
+        return body.encode("utf-8")
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        return bytes(body)
+    # the chunks of a streamed body
+    return b"".join(to_bytes(chunk) for chunk in body)
+
+
+def _merge_json(bodies):
+    documents = [json.loads(body) for body in bodies]
+    if all(isinstance(document, list) for document in documents):
+        return [item for document in documents for item in document]
+    if all(isinstance(document, dict) for document in documents):
+        if all(isinstance(document.get("predictions"), list) for document in documents):
+            merged = documents[0]
+            merged["predictions"] = [p for d in documents for p in d["predictions"]]
+            return merged
+    return None
+
+
+def merge(bodies, content_type):
+    """Merge the response bodies of the chunks of a request, in order.
+
+    JSON responses with a "predictions" list, and JSON arrays, are merged into one response.
+    Any other responses, such as CSV or JSON lines, are joined line by line.
+    """
+    bodies = [to_bytes(body) for body in bodies]
+    if _media_type(content_type) == JSON_CONTENT_TYPE:
+        try:
+            merged = _merge_json(bodies)
+        except ValueError:
+            merged = None
+        if merged is not None:
+            return json.dumps(merged).encode("utf-8")
+    lines = []
+    for body in bodies:
+        if body:
+            lines.append(body if body.endswith(b"\n") else body + b"\n")
+    return b"".join(lines)
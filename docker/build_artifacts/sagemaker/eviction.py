@@ -0,0 +1,277 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Usage tracking of the models of a multi-model endpoint, to evict the least recently used
+idle models when a new model does not fit in the memory or process budget.
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+MAX_EVICTION_RECORDS = 100
+# model_registry.AVAILABLE
+AVAILABLE = "available"
+USAGE_DIR = "/sagemaker/model-usage"
+MIN_USAGE_SLOTS = 64
+# the version of the registry entry of a model, the invocations in flight, and the last
+# invocation time
+_SLOT = struct.Struct("qqd")
+
+
+def process_rss(pid):
+    """Return the resident memory of a process in bytes, or 0 if it is not running."""
+    try:
+        with open("/proc/{}/statm".format(pid), "r") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ModelUsage:
+    """The last invocation time and the invocations in flight of each loaded model, and the
+    models being drained for eviction, so that every worker sees the invocations of the others.
+
+    Each worker counts its invocations in its own usage file, shared in memory with the other
+    workers, in the slot of the model given by its registry entry: the version of the entry,
+    the invocations in flight and the last invocation time. Invocations do not take the
+    registry lock; only draining a model for eviction updates the registry. The usage files of
+    dead workers are removed when a worker opens its own.
+
+    When ``enabled`` is False, invocations are not counted and models are never drained.
+    """
+
+    def __init__(
+        self, registry, enabled=True, worker=None, usage_dir=USAGE_DIR, poll_seconds=0.05
+    ):
+        self._registry = registry
+        self._enabled = enabled
+        self._worker = worker
+        self._usage_dir = usage_dir
+        self._poll_seconds = poll_seconds
+        self._file = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def last_used(self, model_name):
+        if not self._enabled:
+            return None
+        entry = self._registry.model(model_name)
+        if entry is None:
+            return None
+        return _slot_usage(entry, self._worker_slots())[1]
+
+    def last_used_times(self):
+        """Return the last invocation time of each loaded model, None if never invoked."""
+        if not self._enabled:
+            return {}
+        workers = self._worker_slots()
+        return {
+            name: _slot_usage(entry, workers)[1]
+            for name, entry in self._registry.models().items()
+        }
+
+    def admitted(self, model_name):
+        """Whether an invocation counted by ``invocation`` may use the model: the model is
+        not draining, and the invocation is counted with its current load.
+        """
+        entry = self._registry.model(model_name)
+        if entry is None or entry.get("draining"):
+            return False
+        if not self._enabled:
+            return True
+        with self._lock:
+            return self._own_version(entry["usage_slot"]) == entry["version"]
+
+    @contextmanager
+    def invocation(self, model_name):
+        """Count an invocation of the model as in flight in the block. The invocation must
+        check ``admitted`` in the block, after it is counted.
+        """
+        entry = self._registry.model(model_name) if self._enabled else None
+        if entry is None:
+            yield
+            return
+        slot, version = entry["usage_slot"], entry["version"]
+        with self._lock:
+            self._count(slot, version, 1)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._count(slot, version, -1)
+
+    def _count(self, slot, version, delta):
+        slots = self._own_slots(slot)
+        offset = slot * _SLOT.size
+        slot_version, in_flight, last_used = _SLOT.unpack_from(slots, offset)
+        if slot_version != version:
+            if delta < 0:
+                # the slot was taken by another load since the invocation was counted
+                return
+            in_flight, last_used = 0, 0.0
+        in_flight += delta
+        if delta < 0:
+            last_used = time.time()
+        _SLOT.pack_into(slots, offset, version, in_flight, last_used)
+
+    def _own_version(self, slot):
+        if self._slots is None or (slot + 1) * _SLOT.size > len(self._slots):
+            return None
+        return _SLOT.unpack_from(self._slots, slot * _SLOT.size)[0]
+
+    def _own_slots(self, slot):
+        """Return the usage file of this worker mapped in memory, grown to hold the slot."""
+        size = (slot + 1) * _SLOT.size
+        if self._slots is None:
+            os.makedirs(self._usage_dir, exist_ok=True)
+            worker = self._worker or os.getpid()
+            for pid in _usage_file_pids(self._usage_dir):
+                if pid != worker and not process_alive(pid):
+                    _remove(os.path.join(self._usage_dir, str(pid)))
+            self._file = open(os.path.join(self._usage_dir, str(worker)), "w+b")
+            self._map(max(size, MIN_USAGE_SLOTS * _SLOT.size))
+        elif size > len(self._slots):
+            size = max(size, 2 * len(self._slots))
+            self._slots.close()
+            self._map(size)
+        return self._slots
+
+    def _map(self, size):
+        self._file.truncate(size)
+        self._slots = mmap.mmap(self._file.fileno(), size)
+
+    def _worker_slots(self):
+        """Return whether each worker is alive, and the contents of its usage file."""
+        workers = []
+        for pid in _usage_file_pids(self._usage_dir):
+            try:
+                with open(os.path.join(self._usage_dir, str(pid)), "rb") as f:
+                    workers.append((process_alive(pid), f.read()))
+            except FileNotFoundError:
+                continue
+        return workers
+
+    def least_recently_used(self, excluded=()):
+        """Return the available models without invocations in flight in any worker, least
+        recently used first. Models that were never invoked count from when they loaded.
+        """
+        if not self._enabled:
+            return []
+        workers = self._worker_slots()
+        idle = []
+        for name, entry in self._registry.models().items():
+            if entry["state"] != AVAILABLE or entry["draining"] or name in excluded:
+                continue
+            busy, last_used = _slot_usage(entry, workers)
+            if not busy:
+                idle.append((last_used or entry["loaded_at"] or 0.0, name))
+        return [name for _, name in sorted(idle)]
+
+    def drain(self, model_name, timeout_seconds):
+        """Stop admitting invocations of the model in every worker, and wait for those in
+        flight.
+
+        :return: True if the model is idle, False if it is unavailable, drained by another
+            worker, or still busy after the timeout, in which case it admits invocations
+            again
+        """
+        if not self._enabled:
+            return False
+        with self._registry.update() as state:
+            entry = state["models"].get(model_name)
+            if entry is None or entry["state"] != AVAILABLE or entry["draining"]:
+                return False
+            entry["draining"] = True
+            version = entry["version"]
+
+        deadline = time.time() + timeout_seconds
+        while True:
+            entry = self._registry.model(model_name)
+            if entry is None or entry["version"] != version:
+                return False
+            if not _slot_usage(entry, self._worker_slots())[0]:
+                return True
+            if time.time() >= deadline:
+                self.undrain(model_name)
+                return False
+            time.sleep(self._poll_seconds)
+
+    def undrain(self, model_name):
+        """Admit invocations of a drained model again, when it could not be unloaded."""
+        with self._registry.update() as state:
+            entry = state["models"].get(model_name)
+            if entry is not None:
+                entry["draining"] = False
+
+
+def _slot_usage(entry, workers):
+    """Return whether the load of the model of the registry entry has invocations in flight
+    in a live worker, and its last invocation time, or None if it was never invoked.
+    """
+    offset = entry["usage_slot"] * _SLOT.size
+    busy, last_used = False, 0.0
+    for alive, slots in workers:
+        if len(slots) < offset + _SLOT.size:
+            continue
+        version, in_flight, slot_last_used = _SLOT.unpack_from(slots, offset)
+        if version != entry["version"]:
+            continue
+        busy = busy or (alive and in_flight > 0)
+        last_used = max(last_used, slot_last_used)
+    return busy, last_used or None
+
+
+def _usage_file_pids(usage_dir):
+    try:
+        return [int(name) for name in os.listdir(usage_dir) if name.isdigit()]
+    except FileNotFoundError:
+        return []
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def eviction_record(reason, last_used, memory_bytes):
+    return {
+        "evicted_at": time.time(),
+        "reason": reason,
+        "last_invoked_at": last_used,
+        "tfs_process_memory_bytes": memory_bytes,
+    }
+
+
+def add_record(records, model_name, record, max_records=MAX_EVICTION_RECORDS):
+    """Add the eviction record of a model to the most recent records, an insertion-ordered
+    dict by model name, keeping at most ``max_records``.
+    """
+    records.pop(model_name, None)
+    records[model_name] = record
+    while len(records) > max_records:
+        del records[next(iter(records))]
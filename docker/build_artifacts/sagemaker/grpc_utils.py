@@ -0,0 +1,500 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+import array
+import asyncio
+import base64
+import json
+import logging
+import sys
+import time
+
+import grpc
+
+from tfs_utils import TfsResponse
+
+try:
+    from tensorflow.core.framework import tensor_pb2, types_pb2
+    from tensorflow_serving.apis import get_model_metadata_pb2, predict_pb2
+    from tensorflow_serving.apis import prediction_service_pb2_grpc
+    from google.protobuf.message import DecodeError
+
+    GRPC_PREDICT_AVAILABLE = True
+    GRPC_PREDICT_IMPORT_ERROR = None
+except ImportError as e:
+    # the images install the tensorflow protos from min-tfs-client, see the Dockerfiles
+    GRPC_PREDICT_AVAILABLE = False
+    GRPC_PREDICT_IMPORT_ERROR = e
+
+try:
+    from google.protobuf import text_format
+    from tensorflow_serving.apis import get_model_status_pb2, model_management_pb2
+    from tensorflow_serving.apis import model_service_pb2_grpc
+
+    GRPC_MODEL_SERVICE_AVAILABLE = True
+except ImportError:
+    GRPC_MODEL_SERVICE_AVAILABLE = False
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SIGNATURE_NAME = "serving_default"
+PROTOBUF_CONTENT_TYPE = "application/x-protobuf"
+
+# grpc status code -> http status code, following the TFS REST API
+GRPC_TO_HTTP_STATUS = {
+    grpc.StatusCode.INVALID_ARGUMENT: 400,
+    grpc.StatusCode.FAILED_PRECONDITION: 400,
+    grpc.StatusCode.OUT_OF_RANGE: 400,
+    grpc.StatusCode.NOT_FOUND: 404,
+    grpc.StatusCode.ALREADY_EXISTS: 409,
+    grpc.StatusCode.RESOURCE_EXHAUSTED: 429,
+    grpc.StatusCode.UNIMPLEMENTED: 501,
+    grpc.StatusCode.UNAVAILABLE: 503,
+    grpc.StatusCode.DEADLINE_EXCEEDED: 504,
+}
+
+# tensorflow dtype -> (TensorProto value field, array typecode for tensor_content)
+if GRPC_PREDICT_AVAILABLE:
+    _DTYPES = {
+        types_pb2.DT_FLOAT: ("float_val", "f"),
+        types_pb2.DT_DOUBLE: ("double_val", "d"),
+        types_pb2.DT_INT8: ("int_val", "b"),
+        types_pb2.DT_INT16: ("int_val", "h"),
+        types_pb2.DT_INT32: ("int_val", "i"),
+        types_pb2.DT_INT64: ("int64_val", "q"),
+        types_pb2.DT_UINT8: ("int_val", "B"),
+        types_pb2.DT_UINT16: ("int_val", "H"),
+        types_pb2.DT_UINT32: ("uint32_val", "I"),
+        types_pb2.DT_UINT64: ("uint64_val", "Q"),
+        types_pb2.DT_BOOL: ("bool_val", "B"),
+        types_pb2.DT_STRING: ("string_val", None),
+    }
+else:
+    _DTYPES = {}
+
+# PredictionService stubs by channel, and {input name: dtype} maps of signatures by channel,
+# model name, version and signature name. The entries of a channel are dropped when it is
+# closed with close_channel, and those of a model by forget_model.
+_signature_inputs = {}
+_stubs = {}
+
+
+def init_gevent():
+    """Make gRPC calls wait in the gevent hub instead of blocking it, when gevent patched the
+    standard library, as gunicorn gevent workers do before they load the application. Must
+    be called before any channel is created.
+
+    :return: True if gRPC was initialized for gevent
+    """
+    monkey = sys.modules.get("gevent.monkey")
+    if monkey is None or not monkey.is_module_patched("socket"):
+        return False
+    from grpc.experimental import gevent as grpc_gevent
+
+    grpc_gevent.init_gevent()
+    return True
+
+
+def _stub(channel):
+    if channel not in _stubs:
+        _stubs[channel] = prediction_service_pb2_grpc.PredictionServiceStub(channel)
+    return _stubs[channel]
+
+
+def close_channel(channel):
+    """Close a channel, and drop its stub and the signatures fetched through it."""
+    _stubs.pop(channel, None)
+    for key in list(_signature_inputs):
+        if key[0] is channel:
+            _signature_inputs.pop(key, None)
+    channel.close()
+
+
+def forget_model(model_name):
+    """Drop the cached signatures of a model, which is unloaded or loaded again, possibly with
+    other signatures.
+    """
+    for key in list(_signature_inputs):
+        if key[1] == model_name:
+            _signature_inputs.pop(key, None)
+
+
+def _model_spec(spec, model_name, model_version, signature_name):
+    spec.name = model_name
+    if model_version:
+        spec.version.value = int(model_version)
+    spec.signature_name = signature_name
+
+
+def signature_inputs(channel, model_name, model_version, signature_name, timeout=None):
+    """Return the {input name: dtype} map of a model signature, fetched once from TFS
+    with GetModelMetadata and cached until the channel is closed or the model is forgotten.
+    """
+    key = (channel, model_name, model_version, signature_name)
+    if key not in _signature_inputs:
+        request = get_model_metadata_pb2.GetModelMetadataRequest()
+        _model_spec(request.model_spec, model_name, model_version, signature_name)
+        request.metadata_field.append("signature_def")
+        try:
+            response = _stub(channel).GetModelMetadata(request, timeout=timeout)
+        except grpc.RpcError as e:
+            raise ValueError("failed to get signature metadata: {}".format(e.details()))
+
+        signature_map = get_model_metadata_pb2.SignatureDefMap()
+        response.metadata["signature_def"].Unpack(signature_map)
+        if signature_name not in signature_map.signature_def:
+            raise ValueError("signature {} not found".format(signature_name))
+        inputs = signature_map.signature_def[signature_name].inputs
+        _signature_inputs[key] = {name: info.dtype for name, info in inputs.items()}
+    return _signature_inputs[key]
+
+
+def _shape(value):
+    shape = []
+    while isinstance(value, list):
+        shape.append(len(value))
+        value = value[0] if value else None
+    return shape
+
+
+def _flatten(value, flat):
+    if isinstance(value, list):
+        for v in value:
+            _flatten(v, flat)
+    else:
+        flat.append(value)
+    return flat
+
+
+def _string_value(value):
+    if isinstance(value, dict) and "b64" in value:
+        return base64.b64decode(value["b64"])
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    raise ValueError("expected a string value, got {}".format(type(value).__name__))
+
+
+def make_tensor_proto(value, dtype):
+    """Build a TensorProto of the given dtype from a (nested) list of JSON values."""
+    if dtype not in _DTYPES:
+        raise ValueError("unsupported dtype: {}".format(types_pb2.DataType.Name(dtype)))
+
+    shape = _shape(value)
+    flat = _flatten(value, [])
+    expected_size = 1
+    for dim in shape:
+        expected_size *= dim
+    if len(flat) != expected_size:
+        raise ValueError("tensor values are not a rectangular list, shape: {}".format(shape))
+
+    tensor = tensor_pb2.TensorProto(dtype=dtype)
+    for dim in shape:
+        tensor.tensor_shape.dim.add(size=dim)
+
+    field = _DTYPES[dtype][0]
+    if dtype == types_pb2.DT_STRING:
+        flat = [_string_value(v) for v in flat]
+    try:
+        getattr(tensor, field).extend(flat)
+    except TypeError as e:
+        raise ValueError("tensor values do not match dtype: {}".format(e))
+    return tensor
+
+
+def _columns(body, input_names):
+    if "instances" in body:
+        instances = body["instances"]
+        if not isinstance(instances, list):
+            raise ValueError("'instances' must be a list")
+        if instances and all(isinstance(i, dict) and "b64" not in i for i in instances):
+            try:
+                return {name: [i[name] for i in instances] for name in instances[0]}
+            except KeyError as e:
+                raise ValueError("instances do not have the same inputs: {}".format(e))
+        if len(input_names) != 1:
+            raise ValueError("unnamed 'instances' require a signature with exactly one input")
+        return {input_names[0]: instances}
+
+    if "inputs" in body:
+        inputs = body["inputs"]
+        if isinstance(inputs, dict) and "b64" not in inputs:
+            return inputs
+        if len(input_names) != 1:
+            raise ValueError("unnamed 'inputs' require a signature with exactly one input")
+        return {input_names[0]: inputs}
+
+    raise ValueError("request must contain 'instances' or 'inputs'")
+
+
+def make_predict_request(body, model_name, model_version, signature_inputs_fn):
+    """Convert a TFS REST predict request body (row or columnar format) to a PredictRequest.
+
+    ``signature_inputs_fn`` is called with the signature name and returns the
+    {input name: dtype} map of that signature.
+
+    Raises ValueError if the body cannot be expressed as a PredictRequest, in which case
+    the caller should send it to the REST API unchanged.
+    """
+    if isinstance(body, (bytes, str)):
+        body = json.loads(body)
+    if not isinstance(body, dict):
+        raise ValueError("request body must be a JSON object")
+
+    signature_name = body.get("signature_name", DEFAULT_SIGNATURE_NAME)
+    dtypes = signature_inputs_fn(signature_name)
+
+    request = predict_pb2.PredictRequest()
+    _model_spec(request.model_spec, model_name, model_version, signature_name)
+    for name, value in _columns(body, sorted(dtypes)).items():
+        if name not in dtypes:
+            raise ValueError("input {} is not in signature {}".format(name, signature_name))
+        request.inputs[name].CopyFrom(make_tensor_proto(value, dtypes[name]))
+
+    return request, "instances" in body
+
+
+def _reshape(flat, dims):
+    if not dims:
+        return flat[0]
+    if 0 in dims:
+        return []
+    for dim in reversed(dims[1:]):
+        flat = [flat[i : i + dim] for i in range(0, len(flat), dim)]
+    return flat
+
+
+def _json_string(value, b64):
+    if b64:
+        return {"b64": base64.b64encode(value).decode("utf-8")}
+    # TFS writes the bytes of the other strings as they are
+    return value.decode("utf-8", errors="replace")
+
+
+def _default_value(dtype):
+    if dtype == types_pb2.DT_STRING:
+        return b""
+    if dtype in (types_pb2.DT_FLOAT, types_pb2.DT_DOUBLE):
+        return 0.0
+    return 0
+
+
+def tensor_proto_to_list(tensor, b64=False):
+    """Convert a TensorProto to a (nested) list of JSON-serializable values. With ``b64``,
+    strings are base64-encoded as {"b64": ...} objects.
+    """
+    if tensor.dtype not in _DTYPES:
+        raise ValueError("unsupported dtype: {}".format(types_pb2.DataType.Name(tensor.dtype)))
+
+    field, typecode = _DTYPES[tensor.dtype]
+    dims = [d.size for d in tensor.tensor_shape.dim]
+    size = 1
+    for dim in dims:
+        size *= dim
+
+    if tensor.tensor_content:
+        values = array.array(typecode, tensor.tensor_content).tolist()
+    else:
+        values = list(getattr(tensor, field))
+        if not values:
+            # tensors of default values have no values at all, like tensorflow's make_ndarray
+            values = [_default_value(tensor.dtype)]
+        if len(values) == 1 and size != 1:
+            values = values * size
+
+    if tensor.dtype == types_pb2.DT_BOOL:
+        values = [bool(v) for v in values]
+    elif tensor.dtype == types_pb2.DT_STRING:
+        values = [_json_string(v, b64) for v in values]
+    return _reshape(values, dims)
+
+
+def predict_response_to_json(response, row_format):
+    """Convert a PredictResponse to the JSON body the TFS REST API would have returned.
+
+    As in the TFS REST API, the strings of outputs whose name ends with "_bytes" are
+    base64-encoded.
+
+    Raises ValueError if the outputs of a row format response have different batch sizes.
+    """
+    outputs = {
+        name: tensor_proto_to_list(t, b64=name.endswith("_bytes"))
+        for name, t in response.outputs.items()
+    }
+
+    if not row_format:
+        if len(outputs) == 1:
+            return {"outputs": next(iter(outputs.values()))}
+        return {"outputs": outputs}
+
+    if len(outputs) == 1:
+        return {"predictions": next(iter(outputs.values()))}
+    # scalar outputs have no batch dimension and are repeated in every row
+    batch_sizes = {len(value) for value in outputs.values() if isinstance(value, list)}
+    if len(batch_sizes) > 1:
+        raise ValueError("outputs have different batch sizes: {}".format(sorted(batch_sizes)))
+    batch_size = batch_sizes.pop() if batch_sizes else 1
+    return {
+        "predictions": [
+            {
+                name: value[i] if isinstance(value, list) else value
+                for name, value in outputs.items()
+            }
+            for i in range(batch_size)
+        ]
+    }
+
+
+def _tfs_response(call, encode_fn):
+    try:
+        response = call.result()
+    except grpc.RpcError as e:
+        if e.code() == grpc.StatusCode.UNAVAILABLE:
+            # let the caller fail over to another TFS instance
+            raise
+        if e.code() == grpc.StatusCode.DEADLINE_EXCEEDED:
+            # handled like a timeout of a REST request
+            raise
+        status = GRPC_TO_HTTP_STATUS.get(e.code(), 500)
+        body = json.dumps({"error": e.details()}).encode("utf-8")
+        return TfsResponse(status, body)
+
+    try:
+        body = encode_fn(response)
+    except ValueError as e:
+        # as the TFS REST API does for outputs it cannot express in the row format
+        return TfsResponse(400, json.dumps({"error": str(e)}).encode("utf-8"))
+    return TfsResponse(200, body)
+
+
+def _json_encoder(row_format):
+    return lambda response: json.dumps(predict_response_to_json(response, row_format)).encode(
+        "utf-8"
+    )
+
+
+def predict(channel, request, row_format, timeout=None):
+    """Call PredictionService.Predict and return the result as a TfsResponse."""
+    call = _stub(channel).Predict.future(request, timeout=timeout)
+    return _tfs_response(call, _json_encoder(row_format))
+
+
+def predict_async(channel, request, row_format, timeout=None):
+    """Start PredictionService.Predict without blocking the event loop.
+
+    Returns an asyncio future that resolves to a TfsResponse.
+    """
+    loop = asyncio.get_event_loop()
+    result = loop.create_future()
+    encode_fn = _json_encoder(row_format)
+
+    def _set_result(call):
+        if result.cancelled():
+            return
+        try:
+            result.set_result(_tfs_response(call, encode_fn))
+        except grpc.RpcError as e:
+            result.set_exception(e)
+
+    call = _stub(channel).Predict.future(request, timeout=timeout)
+    # grpc runs callbacks on its own threads
+    call.add_done_callback(lambda c: loop.call_soon_threadsafe(_set_result, c))
+    return result
+
+
+def parse_predict_request(body, model_name=None, model_version=None, default_model_name=None):
+    """Parse a serialized PredictRequest.
+
+    ``model_name`` and ``model_version`` replace the model spec of the message when they are
+    set. A message without a model name gets ``default_model_name``.
+
+    Raises ValueError if the body is not a PredictRequest.
+    """
+    request = predict_pb2.PredictRequest()
+    try:
+        request.ParseFromString(body)
+    except DecodeError as e:
+        raise ValueError("request body is not a serialized PredictRequest: {}".format(e))
+
+    if model_name:
+        request.model_spec.name = model_name
+    elif not request.model_spec.name:
+        request.model_spec.name = default_model_name
+    if model_version:
+        request.model_spec.ClearField("version_label")
+        request.model_spec.version.value = int(model_version)
+    return request
+
+
+def predict_protobuf(channel, request, serialized_response, timeout=None):
+    """Call PredictionService.Predict with a PredictRequest received from the client.
+
+    Returns a TfsResponse whose content is the serialized PredictResponse when
+    ``serialized_response`` is true, or the columnar TFS REST API JSON form of it otherwise.
+    """
+    if serialized_response:
+        encode_fn = predict_pb2.PredictResponse.SerializeToString
+    else:
+        encode_fn = _json_encoder(row_format=False)
+    call = _stub(channel).Predict.future(request, timeout=timeout)
+    return _tfs_response(call, encode_fn)
+
+
+def reload_model_config(channel, config, timeout=None):
+    """Replace the models served by a TFS process with those of a text format model config,
+    with ModelService.HandleReloadConfigRequest. TFS keeps serving the models that are in
+    both configs, and only loads the added models and unloads the removed ones.
+
+    :raises RuntimeError: if TFS rejects the config
+    """
+    request = model_management_pb2.ReloadConfigRequest()
+    text_format.Parse(config, request.config)
+    stub = model_service_pb2_grpc.ModelServiceStub(channel)
+    response = stub.HandleReloadConfigRequest(request, timeout=timeout)
+    if response.status.error_code:
+        raise RuntimeError(response.status.error_message)
+
+
+def wait_for_model_status(channel, model_name, timeout_seconds, wait_interval_seconds=0.5):
+    """Wait until every version of a model is available, with ModelService.GetModelStatus.
+    The TFS process may still be starting.
+
+    :raises RuntimeError: if a version of the model failed to load
+    :raises TimeoutError: if the model is not available within timeout_seconds
+    """
+    stub = model_service_pb2_grpc.ModelServiceStub(channel)
+    request = get_model_status_pb2.GetModelStatusRequest()
+    request.model_spec.name = model_name
+    states = get_model_status_pb2.ModelVersionStatus
+    deadline = time.time() + timeout_seconds
+    while time.time() < deadline:
+        try:
+            versions = stub.GetModelStatus(request, timeout=timeout_seconds).model_version_status
+        except grpc.RpcError as e:
+            # the process is starting, or has not started loading the model
+            if e.code() not in (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.NOT_FOUND):
+                raise
+            versions = []
+        for version in versions:
+            if version.state == states.END and version.status.error_code:
+                raise RuntimeError(
+                    "failed to load version {} of model {}: {}".format(
+                        version.version, model_name, version.status.error_message
+                    )
+                )
+        if versions and all(version.state == states.AVAILABLE for version in versions):
+            log.info("model %s is available", model_name)
+            return
+        time.sleep(wait_interval_seconds)
+    raise TimeoutError(
+        "model {} was not available after {} seconds".format(model_name, timeout_seconds)
+    )
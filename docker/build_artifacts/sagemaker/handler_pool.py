@@ -0,0 +1,320 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""A process pool that runs input and output handlers off the gunicorn worker, so that
+CPU-heavy pre- and post-processing does not hold up the other requests of a gevent worker.
+The request to TFS is still sent by the worker in between.
+
+Request bodies, handler results and TFS responses of at least ``shm_min_bytes`` are passed
+through files in /dev/shm, which the pool processes map into memory, instead of being
+pickled through the pool's pipes.
+"""
+import io
+import json
+import mmap
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+COPY_CHUNK_BYTES = 64 * 1024
+
+# a buffer of ``length`` bytes in the file at ``path``, which is removed by its reader.
+# ``text`` is True if the buffer holds a utf-8 encoded str.
+SharedBuffer = namedtuple("SharedBuffer", "path, length, text")
+
+
+class SharedResponse:
+    """A TFS response passed to an output handler in a pool process. It has the attributes of
+    tfs_utils.TfsResponse, and those of requests.Response that output handlers commonly use.
+    """
+
+    def __init__(self, status_code, headers, content, encoding=None, url=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding or "utf-8"
+        self.url = url
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding)
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def _new_shm_file():
+    fd, path = tempfile.mkstemp(prefix="sagemaker-handler-", dir=SHM_DIR)
+    return os.fdopen(fd, "wb"), path
+
+
+def share(value, min_bytes):
+    """Move a str or bytes-like value of at least ``min_bytes`` into a SharedBuffer, and
+    return every other value as it is.
+    """
+    if not isinstance(value, (str, bytes, bytearray, memoryview)):
+        return value
+    text = isinstance(value, str)
+    data = value.encode("utf-8") if text else value
+    if len(data) < min_bytes or not data:
+        return value
+    f, path = _new_shm_file()
+    with f:
+        f.write(data)
+    return SharedBuffer(path, len(data), text)
+
+
+def share_stream(stream, length, min_bytes):
+    """Copy a file-like request body of ``length`` bytes into a SharedBuffer, without
+    reading it into memory first. Bodies shorter than ``min_bytes`` are returned as bytes.
+    """
+    if length is None or length < min_bytes or length == 0:
+        return stream.read()
+    f, path = _new_shm_file()
+    with f:
+        shutil.copyfileobj(stream, f, COPY_CHUNK_BYTES)
+        length = f.tell()
+    return SharedBuffer(path, length, False)
+
+
+def take(value):
+    """Return the value of a SharedBuffer and remove its file. Other values are returned as
+    they are.
+    """
+    if not isinstance(value, SharedBuffer):
+        return value
+    try:
+        with open(value.path, "rb") as f:
+            data = f.read()
+    finally:
+        discard(value)
+    return data.decode("utf-8") if value.text else data
+
+
+def discard(value):
+    if isinstance(value, SharedBuffer):
+        try:
+            os.unlink(value.path)
+        except FileNotFoundError:
+            pass
+
+
+def _open_stream(value):
+    """Return a file-like object over a request body passed by the parent. Shared buffers
+    are mapped into memory rather than read.
+    """
+    if not isinstance(value, SharedBuffer):
+        return io.BytesIO(value)
+    with open(value.path, "rb") as f:
+        return mmap.mmap(f.fileno(), value.length, access=mmap.ACCESS_READ)
+
+
+def _response_state(response, min_bytes):
+    return (
+        response.status_code,
+        dict(getattr(response, "headers", {})),
+        share(response.content, min_bytes),
+        getattr(response, "encoding", None),
+        getattr(response, "url", None),
+    )
+
+
+def _run_input_handler(input_handler, data, context, restore_context, min_bytes):
+    stream = _open_stream(data)
+    try:
+        return share(input_handler(stream, restore_context(context)), min_bytes)
+    finally:
+        stream.close()
+
+
+def _run_output_handler(output_handler, response_state, context, restore_context, min_bytes):
+    status_code, headers, content, encoding, url = response_state
+    response = SharedResponse(status_code, headers, take(content), encoding, url)
+    body, content_type = output_handler(response, restore_context(context))
+    if body is not None and not isinstance(body, (str, bytes, bytearray, memoryview)):
+        # a streamed body cannot be passed back while it is produced, so it is collected
+        body = b"".join(c.encode("utf-8") if isinstance(c, str) else c for c in body)
+    return share(body, min_bytes), content_type
+
+
+def _serve(conn, initializer):
+    """Run the calls sent by the pool on ``conn`` until it sends None or is closed. Each
+    result is sent with the CPU time of the call.
+    """
+    if initializer is not None:
+        initializer()
+    while True:
+        try:
+            call = conn.recv()
+        except EOFError:
+            return
+        if call is None:
+            return
+        fn, args = call
+        cpu_start = time.process_time()
+        try:
+            ok, value = True, fn(*args)
+        except Exception as e:  # pylint: disable=broad-except
+            ok, value = False, e
+        cpu_seconds = time.process_time() - cpu_start
+        try:
+            conn.send((ok, value, cpu_seconds))
+        except Exception as e:  # pylint: disable=broad-except
+            # the exception, or the result, could not be pickled
+            error = RuntimeError("{}: {}".format(type(e).__name__, e))
+            conn.send((False, error, cpu_seconds))
+
+
+def _wait_function():
+    """Return a function that waits for a connection to be readable, without blocking the
+    other greenlets of a gevent worker.
+    """
+    try:
+        from gevent import monkey, socket
+
+        if monkey.is_module_patched("socket"):
+            return lambda conn: socket.wait_read(conn.fileno())
+    except ImportError:
+        pass
+    return lambda conn: conn.poll(None)
+
+
+class HandlerPool:
+    """Runs input and output handlers in a pool of ``processes`` processes.
+
+    The processes are started on first use, in the gunicorn worker that uses them, and are
+    replaced when they die. The handlers and ``restore_context`` are pickled by reference,
+    so they must be importable module level functions. ``prepare_context`` turns a Context
+    into one that can be pickled, and ``restore_context`` turns it back in the pool process.
+
+    ``initializer``, if given, is called in each pool process when it starts, and
+    ``cpu_seconds_fn``, if given, is called with the Context and the CPU seconds the pool
+    process spent in each handler call.
+    """
+
+    def __init__(
+        self,
+        processes,
+        shm_min_bytes,
+        prepare_context,
+        restore_context,
+        initializer=None,
+        cpu_seconds_fn=None,
+    ):
+        self.processes = processes
+        self._shm_min_bytes = shm_min_bytes
+        self._prepare_context = prepare_context
+        self._restore_context = restore_context
+        self._initializer = initializer
+        self._cpu_seconds_fn = cpu_seconds_fn
+        self._slots = threading.BoundedSemaphore(processes)
+        self._idle = []
+        self._workers = []
+        self._lock = threading.Lock()
+        self._wait_readable = _wait_function()
+
+    def _checkout(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=_serve, args=(child_conn, self._initializer), daemon=True
+        )
+        process.start()
+        child_conn.close()
+        worker = (process, conn)
+        with self._lock:
+            self._workers.append(worker)
+        return worker
+
+    def _retire(self, worker):
+        process, conn = worker
+        conn.close()
+        process.terminate()
+        with self._lock:
+            self._workers.remove(worker)
+
+    def _call(self, context, fn, *args):
+        with self._slots:
+            worker = self._checkout()
+            try:
+                worker[1].send((fn, args))
+                self._wait_readable(worker[1])
+                ok, value, cpu_seconds = worker[1].recv()
+            except (EOFError, OSError):
+                self._retire(worker)
+                raise RuntimeError("a handler process exited while running a handler")
+            except BaseException:
+                # the worker may still send the result of this call
+                self._retire(worker)
+                raise
+            with self._lock:
+                self._idle.append(worker)
+        if self._cpu_seconds_fn is not None:
+            self._cpu_seconds_fn(context, cpu_seconds)
+        if not ok:
+            raise value
+        return value
+
+    def run_input_handler(self, input_handler, data, context):
+        """Run ``input_handler(data, context)`` in the pool and return its result."""
+        if hasattr(data, "read"):
+            data = share_stream(data, context.content_length, self._shm_min_bytes)
+        else:
+            data = share(data, self._shm_min_bytes)
+        try:
+            result = self._call(
+                context,
+                _run_input_handler,
+                input_handler,
+                data,
+                self._prepare_context(context),
+                self._restore_context,
+                self._shm_min_bytes,
+            )
+        finally:
+            discard(data)
+        return take(result)
+
+    def run_output_handler(self, output_handler, response, context):
+        """Run ``output_handler(response, context)`` in the pool and return its result."""
+        state = _response_state(response, self._shm_min_bytes)
+        try:
+            body, content_type = self._call(
+                context,
+                _run_output_handler,
+                output_handler,
+                state,
+                self._prepare_context(context),
+                self._restore_context,
+                self._shm_min_bytes,
+            )
+        finally:
+            discard(state[2])
+        return take(body), content_type
+
+    def close(self):
+        with self._lock:
+            workers, self._workers, self._idle = self._workers, [], []
+        for process, conn in workers:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            conn.close()
+            process.join(5)
@@ -0,0 +1,146 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Logging setup of serve.py and the python service.
+
+Records are put on a queue and written to stderr by a background listener, so that request
+handling never waits on log output. Messages are only formatted by the listener.
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+LOG_FORMAT = logging.BASIC_FORMAT
+LOG_LEVEL = os.environ.get("SAGEMAKER_PYTHON_LOGLEVEL", "info").upper()
+# comma separated logger=level pairs, for example "tfs_utils=warning,python_service=debug"
+LOG_LEVELS = os.environ.get("SAGEMAKER_PYTHON_LOGLEVELS", "")
+REQUEST_LOGS_PER_SECOND = float(os.environ.get("SAGEMAKER_PYTHON_REQUEST_LOGS_PER_SECOND", 1))
+QUEUE_SIZE = 10000
+
+_lock = threading.Lock()
+_listener = None
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that leaves formatting to the listener, and drops records instead of
+    blocking when the queue is full.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def _parse_log_levels(log_levels):
+    levels = {}
+    for entry in log_levels.split(","):
+        if not entry.strip():
+            continue
+        name, _, level = entry.partition("=")
+        if not level:
+            raise ValueError(
+                "SAGEMAKER_PYTHON_LOGLEVELS must be comma separated logger=level pairs"
+            )
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging():
+    """Send all log records through a queue to a stderr handler running on a background
+    thread, and apply the configured log levels. Does nothing after the first call in a
+    process.
+    """
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        records = queue.Queue(QUEUE_SIZE)
+        _listener = logging.handlers.QueueListener(records, stream_handler)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(_QueueHandler(records))
+        root.setLevel(LOG_LEVEL)
+        for name, level in _parse_log_levels(LOG_LEVELS).items():
+            logging.getLogger(name).setLevel(level)
+
+
+def reset_after_fork():
+    """Write log records straight to stderr in a process forked from one that configured
+    logging. The listener thread does not run in the forked process, so records put on the
+    queue would never be written, and the queue lock may have been held when it forked.
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, _QueueHandler):
+            root.removeHandler(handler)
+            stream_handler = logging.StreamHandler()
+            stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+            root.addHandler(stream_handler)
+
+
+class RequestLogger:
+    """Logs per-request messages at no more than REQUEST_LOGS_PER_SECOND per message, and
+    reports how many were suppressed with the next message that gets through.
+
+    Arguments are formatted lazily, %-style, and only for messages that are logged.
+    """
+
+    def __init__(self, logger, per_second=REQUEST_LOGS_PER_SECOND):
+        self._logger = logger
+        self._interval = 1.0 / per_second if per_second > 0 else None
+        self._next_allowed = {}
+        self._suppressed = {}
+        self._lock = threading.Lock()
+
+    def _allow(self, msg):
+        if self._interval is None:
+            return False, 0
+        now = time.time()
+        with self._lock:
+            if now < self._next_allowed.get(msg, 0.0):
+                self._suppressed[msg] = self._suppressed.get(msg, 0) + 1
+                return False, 0
+            self._next_allowed[msg] = now + self._interval
+            return True, self._suppressed.pop(msg, 0)
+
+    def log(self, level, msg, *args):
+        if not self._logger.isEnabledFor(level):
+            return
+        allowed, suppressed = self._allow(msg)
+        if not allowed:
+            return
+        if suppressed:
+            msg += " (%d similar messages suppressed)"
+            args += (suppressed,)
+        self._logger.log(level, msg, *args)
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
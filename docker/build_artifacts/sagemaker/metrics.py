@@ -0,0 +1,270 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Prometheus metrics of the python service.
+
+Every gunicorn worker writes its samples to memory-mapped files in the directory named by
+the prometheus_multiproc_dir environment variable, which serve.py creates before starting
+gunicorn. /metrics is served by any worker and sums the files of all workers.
+"""
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+try:
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST,
+        CollectorRegistry,
+        Counter,
+        Gauge,
+        Histogram,
+        generate_latest,
+        multiprocess,
+    )
+
+    PROMETHEUS_AVAILABLE = True
+except ImportError:
+    PROMETHEUS_AVAILABLE = False
+
+log = logging.getLogger(__name__)
+
+MULTIPROC_DIR_ENV = "prometheus_multiproc_dir"
+METRICS_ENABLED = (
+    os.environ.get("SAGEMAKER_PYTHON_SERVICE_ENABLE_METRICS", "false").lower() == "true"
+    and PROMETHEUS_AVAILABLE
+    and bool(os.environ.get(MULTIPROC_DIR_ENV))
+)
+
+STAGE_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+# time.thread_time only counts the calling thread, but needs python 3.7
+_cpu_time = getattr(time, "thread_time", time.process_time)
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs):  # pylint: disable=W0613
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def observe(self, amount):
+        pass
+
+
+if METRICS_ENABLED:
+    INVOCATIONS = Counter(
+        "sagemaker_invocations_total",
+        "Invocations by model and response status code",
+        ["model", "status"],
+    )
+    STAGE_SECONDS = Histogram(
+        "sagemaker_invocation_stage_seconds",
+        "Latency of each stage of an invocation",
+        ["model", "stage"],
+        buckets=STAGE_BUCKETS,
+    )
+    HANDLER_CPU_SECONDS = Counter(
+        "sagemaker_handler_cpu_seconds_total",
+        "CPU time spent in inference.py handlers",
+        ["model"],
+    )
+    TFS_IN_FLIGHT = Gauge(
+        "sagemaker_tfs_in_flight_requests",
+        "Requests in flight to each TFS instance, by rest port",
+        ["rest_port"],
+        multiprocess_mode="livesum",
+    )
+    ADMISSION_QUEUE_DEPTH = Gauge(
+        "sagemaker_admission_queue_depth",
+        "Invocations waiting for a concurrency slot, by scope and model name or rest port",
+        ["scope", "key"],
+        multiprocess_mode="livesum",
+    )
+    ADMISSION_REJECTIONS = Counter(
+        "sagemaker_admission_rejections_total",
+        "Invocations rejected with 429 by the concurrency limits, by scope",
+        ["scope"],
+    )
+    LOCK_WAIT_SECONDS = Histogram(
+        "sagemaker_multi_model_lock_wait_seconds",
+        "Time spent waiting for the multi-model endpoint locks, by lock",
+        ["lock"],
+        buckets=STAGE_BUCKETS,
+    )
+    LOCK_HOLD_SECONDS = Histogram(
+        "sagemaker_multi_model_lock_hold_seconds",
+        "Time the multi-model endpoint locks are held, by lock",
+        ["lock"],
+        buckets=STAGE_BUCKETS,
+    )
+    BATCH_QUEUE_WAIT_SECONDS = Histogram(
+        "sagemaker_request_batch_queue_wait_seconds",
+        "Time batched predict requests wait for their batch to be sent, by model",
+        ["model"],
+        buckets=STAGE_BUCKETS,
+    )
+    BATCH_SIZE = Histogram(
+        "sagemaker_request_batch_size",
+        "Instances in each batch of predict requests sent to TFS, by model",
+        ["model"],
+        buckets=BATCH_SIZE_BUCKETS,
+    )
+    BATCHED_REQUESTS = Counter(
+        "sagemaker_batched_requests_total",
+        "Predict requests merged into batches, by model",
+        ["model"],
+    )
+    PREDICTION_CACHE_HITS = Counter(
+        "sagemaker_prediction_cache_hits_total",
+        "Instances whose prediction was found in the prediction cache, by model",
+        ["model"],
+    )
+    PREDICTION_CACHE_MISSES = Counter(
+        "sagemaker_prediction_cache_misses_total",
+        "Instances whose prediction was not found in the prediction cache, by model",
+        ["model"],
+    )
+else:
+    INVOCATIONS = STAGE_SECONDS = HANDLER_CPU_SECONDS = TFS_IN_FLIGHT = _NoopMetric()
+    ADMISSION_QUEUE_DEPTH = ADMISSION_REJECTIONS = _NoopMetric()
+    LOCK_WAIT_SECONDS = LOCK_HOLD_SECONDS = _NoopMetric()
+    BATCH_QUEUE_WAIT_SECONDS = BATCH_SIZE = BATCHED_REQUESTS = _NoopMetric()
+    PREDICTION_CACHE_HITS = PREDICTION_CACHE_MISSES = _NoopMetric()
+
+
+@contextmanager
+def stage_timer(model, stage):
+    """Record the time spent in the block as the latency of an invocation stage."""
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(model, stage).observe(time.perf_counter() - start)
+
+
+def lock_timings(lock, wait_seconds, hold_seconds):
+    """Record the time spent waiting for a lock, and the time it was held."""
+    LOCK_WAIT_SECONDS.labels(lock).observe(wait_seconds)
+    LOCK_HOLD_SECONDS.labels(lock).observe(hold_seconds)
+
+
+@contextmanager
+def handler_timer(model, stage):
+    """Record the latency and the CPU time of an inference.py handler call. Only the CPU
+    time of the calling thread is counted, handlers run in the handler pool add theirs with
+    handler_cpu.
+    """
+    if not METRICS_ENABLED:
+        yield
+        return
+    start, cpu_start = time.perf_counter(), _cpu_time()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(model, stage).observe(time.perf_counter() - start)
+        HANDLER_CPU_SECONDS.labels(model).inc(_cpu_time() - cpu_start)
+
+
+def handler_cpu(model, cpu_seconds):
+    """Record the CPU time of an inference.py handler call that ran in another process."""
+    HANDLER_CPU_SECONDS.labels(model).inc(cpu_seconds)
+
+
+@contextmanager
+def tfs_in_flight(rest_port):
+    TFS_IN_FLIGHT.labels(rest_port).inc()
+    try:
+        yield
+    finally:
+        TFS_IN_FLIGHT.labels(rest_port).dec()
+
+
+def admission_queue_changed(scope, key, change):
+    ADMISSION_QUEUE_DEPTH.labels(scope, key).inc(change)
+
+
+def record_admission_rejection(scope):
+    ADMISSION_REJECTIONS.labels(scope).inc()
+
+
+def record_batched_request(model, queue_wait_seconds):
+    BATCHED_REQUESTS.labels(model).inc()
+    BATCH_QUEUE_WAIT_SECONDS.labels(model).observe(queue_wait_seconds)
+
+
+def record_batch(model, batch_size):
+    BATCH_SIZE.labels(model).observe(batch_size)
+
+
+def record_prediction_cache_lookups(model, hits, misses):
+    if hits:
+        PREDICTION_CACHE_HITS.labels(model).inc(hits)
+    if misses:
+        PREDICTION_CACHE_MISSES.labels(model).inc(misses)
+
+
+def record_invocation(model, status):
+    INVOCATIONS.labels(model, status.split(" ", 1)[0]).inc()
+
+
+def remove_dead_workers():
+    """Drop the live gauge samples of workers that are gone, which gunicorn replaced with
+    new workers. Called when a worker starts.
+    """
+    if not METRICS_ENABLED:
+        return
+    pids = set()
+    for name in os.listdir(os.environ[MULTIPROC_DIR_ENV]):
+        if name.startswith("gauge_live"):
+            pids.add(int(name.rsplit("_", 1)[1].split(".")[0]))
+    for pid in pids:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            log.info("removing metrics of exited worker %d", pid)
+            multiprocess.mark_process_dead(pid)
+        except PermissionError:
+            pass
+
+
+def generate():
+    """Return the content type and the text exposition of the metrics of all workers."""
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return CONTENT_TYPE_LATEST, generate_latest(registry)
@@ -0,0 +1,171 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Placement of the models of a multi-model endpoint on a fixed number of shared TFS
+processes, instead of one TFS process per model.
+
+When the processes have a capacity, in models or in bytes of model files, models are packed
+onto the fullest process they fit in, and another process is only started when no running
+process has room. Without a capacity, models are spread over all the processes, onto the
+one with the fewest bytes of models.
+"""
+import os
+import threading
+
+
+class NoCapacity(Exception):
+    """Raised when a model does not fit in any TFS process."""
+
+
+def model_size(base_path):
+    """Return the size in bytes of the files of a model."""
+    size = 0
+    for root, _, files in os.walk(base_path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+class ModelHost:
+    """A TFS process serving several models. ``pid``, ``rest_port`` and ``grpc_port`` are set
+    while the process runs.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.pid = None
+        self.rest_port = None
+        self.grpc_port = None
+        # model name -> (base path, size in bytes)
+        self.models = {}
+
+    @property
+    def size(self):
+        return sum(size for _, size in self.models.values())
+
+    def base_paths(self):
+        """Return the base path of each model, by model name."""
+        return {name: base_path for name, (base_path, _) in self.models.items()}
+
+    def state(self):
+        return {
+            "pid": self.pid,
+            "rest_port": self.rest_port,
+            "grpc_port": self.grpc_port,
+            "models": {name: list(entry) for name, entry in self.models.items()},
+        }
+
+    def restore(self, state):
+        self.pid = state["pid"]
+        self.rest_port = state["rest_port"]
+        self.grpc_port = state["grpc_port"]
+        self.models = {name: tuple(entry) for name, entry in state["models"].items()}
+
+    def __repr__(self):
+        return "tfs process {} (rest port: {}, models: {})".format(
+            self.index, self.rest_port, len(self.models)
+        )
+
+
+class ModelHostPool:
+    """Places models on up to ``max_hosts`` ModelHosts. A capacity of 0 means no limit."""
+
+    def __init__(self, max_hosts, max_models_per_host=0, max_bytes_per_host=0):
+        self.hosts = [ModelHost(i) for i in range(max_hosts)]
+        self._max_models = max_models_per_host
+        self._max_bytes = max_bytes_per_host
+        self._lock = threading.Lock()
+
+    def _fits(self, host, size):
+        if self._max_models and len(host.models) >= self._max_models:
+            return False
+        if self._max_bytes and host.size + size > self._max_bytes:
+            return False
+        return True
+
+    def _free_capacity(self, host, size):
+        """Capacity left on the host after adding a model, the smaller the better fit."""
+        if self._max_bytes:
+            return self._max_bytes - host.size - size
+        return self._max_models - len(host.models) - 1
+
+    def _choose(self, size):
+        candidates = [host for host in self.hosts if self._fits(host, size)]
+        if not candidates:
+            return None
+        if not self._max_models and not self._max_bytes:
+            return min(candidates, key=lambda host: (host.size, len(host.models)))
+        running = [host for host in candidates if host.models]
+        if running:
+            return min(running, key=lambda host: self._free_capacity(host, size))
+        return candidates[0]
+
+    def has_room(self, size):
+        """Return True if a model of ``size`` bytes fits in a host."""
+        with self._lock:
+            return self._choose(size) is not None
+
+    def place(self, model_name, base_path, size):
+        """Add a model to the host chosen for it, and return the host.
+
+        :raises NoCapacity: if the model does not fit in any host
+        """
+        with self._lock:
+            host = self._choose(size)
+            if host is None:
+                raise NoCapacity(
+                    "no tfs process has room for model {} ({} bytes)".format(model_name, size)
+                )
+            host.models[model_name] = (base_path, size)
+            return host
+
+    def add(self, host, model_name, base_path, size):
+        """Add a model to the given host, whether it fits or not."""
+        with self._lock:
+            host.models[model_name] = (base_path, size)
+
+    def remove(self, model_name):
+        """Remove a model from its host, and return the host, or None if it is not placed."""
+        with self._lock:
+            host = self.host_of(model_name)
+            if host is not None:
+                del host.models[model_name]
+            return host
+
+    def state(self):
+        """Return the JSON-serializable state of the running hosts, by index."""
+        with self._lock:
+            return {
+                str(host.index): host.state()
+                for host in self.hosts
+                if host.models or host.rest_port is not None
+            }
+
+    def restore(self, state):
+        """Restore the hosts from a state returned by ``state``."""
+        with self._lock:
+            for host in self.hosts:
+                host_state = state.get(str(host.index))
+                if host_state is None:
+                    host.pid = host.rest_port = host.grpc_port = None
+                    host.models = {}
+                else:
+                    host.restore(host_state)
+
+    def host_of(self, model_name):
+        for host in self.hosts:
+            if model_name in host.models:
+                return host
+        return None
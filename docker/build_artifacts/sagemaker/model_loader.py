@@ -0,0 +1,66 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Background loading of the models of a multi-model endpoint, so that loads waiting for TFS
+do not hold the workers that serve invocations.
+
+At most ``parallelism`` models load at a time, and the others wait in a queue. A request to
+load a model that is already queued or loading gets the future of that load instead of
+starting another one.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LoadResponse:
+    """The status and body a load sets, like a falcon response."""
+
+    def __init__(self):
+        self.status = None
+        self.body = None
+
+
+class ModelLoader:
+    """Runs ``load_fn(model_name, *args)`` in the background, which returns the result of
+    the load.
+    """
+
+    def __init__(self, load_fn, parallelism):
+        self._load_fn = load_fn
+        self._executor = ThreadPoolExecutor(max_workers=parallelism)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def submit(self, model_name, *args):
+        """Queue the load of a model, unless it is queued or loading already.
+
+        :return: the future of the load, and True if it is the load in flight
+        """
+        with self._lock:
+            future = self._in_flight.get(model_name)
+            if future is not None:
+                return future, True
+            future = self._executor.submit(self._load, model_name, args)
+            self._in_flight[model_name] = future
+            return future, False
+
+    def in_flight(self, model_name):
+        """Return the future of the load of a model that is queued or loading, or None."""
+        with self._lock:
+            return self._in_flight.get(model_name)
+
+    def _load(self, model_name, args):
+        try:
+            return self._load_fn(model_name, *args)
+        finally:
+            with self._lock:
+                del self._in_flight[model_name]
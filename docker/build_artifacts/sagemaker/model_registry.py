@@ -0,0 +1,260 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""The models of a multi-model endpoint, their TFS processes and the free TFS ports, shared by
+all the gunicorn workers.
+
+The registry is a JSON file that is replaced atomically on every change, so readers never
+see a partial write and never take a lock: a worker only parses the file again when its
+inode, modification time or size changed. Writers serialize on an exclusive lock of another
+file, and read the registry again under the lock before changing it, which only takes the
+time to parse and write the registry.
+
+The ports are allocated in slots of a rest port and a grpc port: slot i is the i-th port of
+the rest port range and of the grpc port range. The free slots are a stack, so a slot is
+claimed and released in constant time.
+"""
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+REGISTRY_PATH = "/sagemaker/model-registry.json"
+LOCK_PATH = "/sagemaker/model-registry.lock"
+# waits for a lock longer than this are logged
+LOCK_WAIT_WARNING_SECONDS = 1.0
+
+# states of a model, and of its load
+QUEUED = "queued"
+LOADING = "loading"
+AVAILABLE = "available"
+FAILED = "failed"
+UNLOADING = "unloading"
+
+log = logging.getLogger(__name__)
+
+
+def reset(path=REGISTRY_PATH):
+    """Remove the registry of a previous run."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def ports_available(state):
+    return bool(state["ports"]["free"])
+
+
+def take_ports(state):
+    """Claim a free slot.
+
+    :return: the (rest port, grpc port) of the slot, or None if no slots are left
+    """
+    ports = state["ports"]
+    if not ports["free"]:
+        return None
+    slot = ports["free"].pop()
+    return ports["rest_port"] + slot, ports["grpc_port"] + slot
+
+
+def release_ports(state, rest_port, grpc_port):
+    """Release the slot of ports claimed by ``take_ports``."""
+    ports = state["ports"]
+    slot = rest_port - ports["rest_port"]
+    if slot != grpc_port - ports["grpc_port"]:
+        raise ValueError("ports {} and {} are not in the same slot".format(rest_port, grpc_port))
+    ports["free"].append(slot)
+
+
+def new_model(state, rest_port, grpc_port, base_path, host=None):
+    """Return the entry of a model that starts loading. Its version is different from the
+    version of any previous load of the model.
+    """
+    return {
+        "state": LOADING,
+        "rest_port": rest_port,
+        "grpc_port": grpc_port,
+        "pid": None,
+        "base_path": base_path,
+        "host": host,
+        "version": state["version"] + 1,
+        "loaded_at": None,
+        # the slot of the model in the usage files of the workers, see eviction.ModelUsage
+        "usage_slot": _free_usage_slot(state),
+        "draining": False,
+    }
+
+
+def _free_usage_slot(state):
+    taken = {entry["usage_slot"] for entry in state["models"].values()}
+    slot = 0
+    while slot in taken:
+        slot += 1
+    return slot
+
+
+class FileLock:
+    """An exclusive lock of a file, between processes and between the threads of a process,
+    since the lock of a file does not exclude the other threads of the process that holds it.
+
+    ``timings_fn``, if given, is called with the seconds spent waiting for the lock and the
+    seconds it was held, after every release.
+
+    With ``poll_seconds``, the lock of the file is tried every ``poll_seconds`` instead of
+    waited for in a blocking call, which would block every greenlet of a gevent worker while
+    another process holds the lock for long.
+    """
+
+    def __init__(self, path, timings_fn=None, poll_seconds=None):
+        self._path = path
+        self._timings_fn = timings_fn
+        self._poll_seconds = poll_seconds
+        self._thread_lock = threading.Lock()
+        self._file = None
+        self._wait_seconds = 0.0
+        self._acquired_at = 0.0
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self._thread_lock.acquire()
+        try:
+            self._file = open(self._path, "a", encoding="utf8")
+            self._lock_file()
+        except BaseException:
+            self._close()
+            raise
+        self._acquired_at = time.perf_counter()
+        self._wait_seconds = self._acquired_at - start
+        if self._wait_seconds > LOCK_WAIT_WARNING_SECONDS:
+            log.warning("waited %.3f seconds for lock %s", self._wait_seconds, self._path)
+        return self
+
+    def _lock_file(self):
+        if self._poll_seconds is None:
+            fcntl.lockf(self._file.fileno(), fcntl.LOCK_EX)
+            return
+        while True:
+            try:
+                fcntl.lockf(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except (BlockingIOError, PermissionError):
+                time.sleep(self._poll_seconds)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        hold_seconds = time.perf_counter() - self._acquired_at
+        wait_seconds = self._wait_seconds
+        fcntl.lockf(self._file.fileno(), fcntl.LOCK_UN)
+        self._close()
+        if self._timings_fn is not None:
+            self._timings_fn(wait_seconds, hold_seconds)
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._thread_lock.release()
+
+
+class ModelRegistry:
+    """A registry whose port slots come from ``tfs_ports``, a dict of the "rest_port" and
+    "grpc_port" ranges. ``lock_timings_fn`` is the ``timings_fn`` of the registry lock.
+
+    Its state holds the entry of each model by name (see ``new_model``), the state of the
+    shared TFS processes by index (see ``ModelHostPool.state``), the port slots, the loads that
+    are queued, loading or failed by model name, and the most recent evictions by model name.
+    """
+
+    def __init__(self, tfs_ports, path=REGISTRY_PATH, lock_path=LOCK_PATH, lock_timings_fn=None):
+        self._tfs_ports = tfs_ports
+        self._path = path
+        self._lock = FileLock(lock_path, lock_timings_fn)
+        self._state = None
+        self._stat = None
+
+    def _initial_state(self):
+        rest_ports, grpc_ports = self._tfs_ports["rest_port"], self._tfs_ports["grpc_port"]
+        slots = min(len(rest_ports), len(grpc_ports))
+        return {
+            "version": 0,
+            "models": {},
+            "hosts": {},
+            "ports": {
+                "rest_port": rest_ports.start,
+                "grpc_port": grpc_ports.start,
+                # the lowest slots are claimed first
+                "free": list(range(slots - 1, -1, -1)),
+            },
+            "loads": {},
+            "evictions": {},
+        }
+
+    def _load(self):
+        """Parse the registry, and return its state and the stat of the file it was read
+        from.
+        """
+        try:
+            with open(self._path, "r", encoding="utf8") as f:
+                return json.load(f), _stat_key(os.fstat(f.fileno()))
+        except FileNotFoundError:
+            return self._initial_state(), None
+
+    def snapshot(self):
+        """Return the current state, without locking. It must not be modified."""
+        try:
+            stat = _stat_key(os.stat(self._path))
+        except FileNotFoundError:
+            stat = None
+        if self._state is None or stat != self._stat:
+            self._state, self._stat = self._load()
+        return self._state
+
+    def models(self):
+        return self.snapshot()["models"]
+
+    def model(self, model_name):
+        return self.snapshot()["models"].get(model_name)
+
+    @contextmanager
+    def update(self):
+        """Lock the registry and yield its state to change. The state is written when the
+        block exits without an exception. Updates must not be nested.
+        """
+        with self._lock:
+            state, _ = self._load()
+            yield state
+            state["version"] += 1
+            self._write(state)
+
+    def _write(self, state):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self._path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf8") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self._path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def model_available(self, model_name, **fields):
+        """Mark a loading model as available, with the given fields, and forget its eviction."""
+        with self.update() as state:
+            state["models"][model_name].update(fields, state=AVAILABLE, loaded_at=time.time())
+            state["evictions"].pop(model_name, None)
+
+
+def _stat_key(stat):
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
@@ -10,26 +10,10 @@
 # distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
 # ANY KIND, either express or implied. See the License for the specific
 # language governing permissions and limitations under the License.
-import fcntl
 import signal
-import time
 from contextlib import contextmanager
 
 MODEL_CONFIG_FILE = "/sagemaker/model-config.cfg"
-DEFAULT_LOCK_FILE = "/sagemaker/lock-file.lock"
-
-
-@contextmanager
-def lock(path=DEFAULT_LOCK_FILE):
-    f = open(path, "w", encoding="utf8")
-    fd = f.fileno()
-    fcntl.lockf(fd, fcntl.LOCK_EX)
-
-    try:
-        yield
-    finally:
-        time.sleep(1)
-        fcntl.lockf(fd, fcntl.LOCK_UN)
 
 
 @contextmanager
@@ -0,0 +1,233 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Bulk conversions between request payloads, NumPy arrays and TFS requests and responses,
+for use in inference.py handlers through ``context.codec``.
+
+Every function works on a whole payload at once, so that parsing and serialization run in
+NumPy and the json module instead of in per-value Python loops.
+"""
+import json
+
+try:
+    import numpy as np
+
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+try:
+    from tensorflow.core.framework import tensor_pb2, types_pb2
+
+    TENSOR_PROTO_AVAILABLE = True
+except ImportError:
+    TENSOR_PROTO_AVAILABLE = False
+
+if NUMPY_AVAILABLE and TENSOR_PROTO_AVAILABLE:
+    _TF_DTYPES = {
+        np.dtype(np.float16): types_pb2.DT_HALF,
+        np.dtype(np.float32): types_pb2.DT_FLOAT,
+        np.dtype(np.float64): types_pb2.DT_DOUBLE,
+        np.dtype(np.int8): types_pb2.DT_INT8,
+        np.dtype(np.int16): types_pb2.DT_INT16,
+        np.dtype(np.int32): types_pb2.DT_INT32,
+        np.dtype(np.int64): types_pb2.DT_INT64,
+        np.dtype(np.uint8): types_pb2.DT_UINT8,
+        np.dtype(np.uint16): types_pb2.DT_UINT16,
+        np.dtype(np.uint32): types_pb2.DT_UINT32,
+        np.dtype(np.uint64): types_pb2.DT_UINT64,
+        np.dtype(np.bool_): types_pb2.DT_BOOL,
+    }
+else:
+    _TF_DTYPES = {}
+
+
+def _check_numpy():
+    if not NUMPY_AVAILABLE:
+        raise ImportError("numpy is required by the codec, install it with requirements.txt")
+
+
+def _text(data):
+    if hasattr(data, "read"):
+        data = data.read()
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data).decode("utf-8")
+    return data
+
+
+def csv_to_ndarray(data, dtype="float32", delimiter=","):
+    """Parse numeric CSV rows into a 2-d ndarray with one row per CSV line.
+
+    :param data: CSV text, bytes or a file-like object such as the handler's ``data``
+    :param dtype: dtype of the array
+    :param delimiter: value separator
+    :return: ndarray of shape (rows, columns)
+    """
+    _check_numpy()
+    lines = _text(data).replace("\r\n", "\n").strip("\n")
+    if not lines:
+        return np.empty((0, 0), dtype=dtype)
+    rows = lines.count("\n") + 1
+    first_line = lines.split("\n", 1)[0]
+    columns = first_line.count(delimiter) + 1
+    flat = np.fromstring(lines.replace("\n", delimiter), dtype=dtype, sep=delimiter)
+    if flat.size != rows * columns:
+        raise ValueError("CSV rows must all have {} numeric values".format(columns))
+    return flat.reshape(rows, columns)
+
+
+def jsonlines_to_ndarray(data, dtype=None):
+    """Parse JSON lines, each holding one instance (a number or a nested list), into an
+    ndarray whose first dimension is the line.
+    """
+    _check_numpy()
+    lines = [line for line in _text(data).splitlines() if line.strip()]
+    return np.asarray(json.loads("[" + ",".join(lines) + "]"), dtype=dtype)
+
+
+def _to_ndarrays(value, dtype):
+    if isinstance(value, dict) and "b64" not in value:
+        return {name: np.asarray(v, dtype=dtype) for name, v in value.items()}
+    return np.asarray(value, dtype=dtype)
+
+
+def tfs_json_to_ndarrays(data, dtype=None):
+    """Parse a TFS REST predict request in the row ('instances') or columnar ('inputs')
+    format.
+
+    :return: an ndarray for unnamed inputs, or a dict of input name to ndarray
+    """
+    _check_numpy()
+    body = json.loads(_text(data))
+    if "instances" in body:
+        instances = body["instances"]
+        if instances and all(isinstance(i, dict) and "b64" not in i for i in instances):
+            columns = {name: [i[name] for i in instances] for name in instances[0]}
+            return _to_ndarrays(columns, dtype)
+        return np.asarray(instances, dtype=dtype)
+    if "inputs" in body:
+        return _to_ndarrays(body["inputs"], dtype)
+    raise ValueError("request must contain 'instances' or 'inputs'")
+
+
+def _tolist(value):
+    return value.tolist() if hasattr(value, "tolist") else value
+
+
+def ndarray_to_tfs_json(value, row_format=True, signature_name=None):
+    """Serialize an ndarray, or a dict of input name to ndarray, into a TFS REST predict
+    request body.
+
+    :param row_format: use the row ('instances') format, otherwise the columnar ('inputs')
+        format
+    :return: the request body as a str
+    """
+    if isinstance(value, dict):
+        columns = {name: _tolist(v) for name, v in value.items()}
+        if row_format:
+            names = list(columns)
+            rows = zip(*(columns[name] for name in names))
+            body = {"instances": [dict(zip(names, row)) for row in rows]}
+        else:
+            body = {"inputs": columns}
+    else:
+        body = {"instances" if row_format else "inputs": _tolist(value)}
+    if signature_name:
+        body["signature_name"] = signature_name
+    return json.dumps(body)
+
+
+def ndarray_to_tensor_proto(array):
+    """Convert an ndarray to a TensorProto, copying numeric data as one block of bytes."""
+    _check_numpy()
+    if not TENSOR_PROTO_AVAILABLE:
+        raise ImportError("tensorflow protos are required to build a TensorProto")
+    array = np.asarray(array)
+    tensor = tensor_pb2.TensorProto()
+    for dim in array.shape:
+        tensor.tensor_shape.dim.add(size=dim)
+
+    if array.dtype.kind in ("S", "U", "O"):
+        tensor.dtype = types_pb2.DT_STRING
+        tensor.string_val.extend(
+            v.encode("utf-8") if isinstance(v, str) else bytes(v) for v in array.flat
+        )
+        return tensor
+
+    native_dtype = array.dtype.newbyteorder("=")
+    if native_dtype not in _TF_DTYPES:
+        raise ValueError("unsupported dtype: {}".format(array.dtype))
+    tensor.dtype = _TF_DTYPES[native_dtype]
+    # tensor_content holds the values in little-endian row-major order
+    little_endian = array.dtype.newbyteorder("<")
+    tensor.tensor_content = np.ascontiguousarray(array, dtype=little_endian).tobytes()
+    return tensor
+
+
+class TfsResponseView:
+    """A view of a TFS REST predict response that decodes the JSON body on first access
+    and converts outputs to ndarrays only when they are read.
+    """
+
+    def __init__(self, response, dtype=None):
+        self._content = response.content if hasattr(response, "content") else response
+        self._dtype = dtype
+        self._body = None
+        self._arrays = {}
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = json.loads(self._content)
+        return self._body
+
+    def _result(self):
+        body = self.body
+        if "predictions" in body:
+            return body["predictions"], True
+        if "outputs" in body:
+            return body["outputs"], False
+        raise ValueError("response has no 'predictions' or 'outputs': {}".format(body))
+
+    def names(self):
+        """Output names, or an empty list if the model has a single unnamed output."""
+        result, row_format = self._result()
+        if row_format:
+            return list(result[0]) if result and isinstance(result[0], dict) else []
+        return list(result) if isinstance(result, dict) else []
+
+    def __getitem__(self, name):
+        _check_numpy()
+        if name not in self._arrays:
+            result, row_format = self._result()
+            if row_format:
+                value = [row[name] for row in result]
+            else:
+                value = result[name]
+            self._arrays[name] = np.asarray(value, dtype=self._dtype)
+        return self._arrays[name]
+
+    @property
+    def array(self):
+        """The single output as an ndarray."""
+        _check_numpy()
+        if None not in self._arrays:
+            result, _ = self._result()
+            if self.names():
+                raise ValueError("response has named outputs, use view[name]")
+            self._arrays[None] = np.asarray(result, dtype=self._dtype)
+        return self._arrays[None]
+
+
+def response_view(response, dtype=None):
+    """Return a TfsResponseView of a TFS response, or of its JSON content."""
+    return TfsResponseView(response, dtype)
@@ -0,0 +1,154 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# how often the version served for a model without an explicit version is re-read from TFS
+MODEL_VERSION_CHECK_SECONDS = 10
+STATS_LOG_INTERVAL_SECONDS = 60
+
+# returned by PredictionCache.get_many for keys that are not cached
+MISS = object()
+
+
+def instance_digest(instance):
+    """Hash of the canonical JSON encoding of an instance, so that instances which differ
+    only in key order or whitespace share a cache entry.
+    """
+    canonical = json.dumps(instance, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+class PredictionCache:
+    """An LRU cache of per-instance TFS predictions, bounded by the approximate size in bytes
+    of the cached predictions. Entries older than ``ttl_seconds`` are treated as misses,
+    unless ``ttl_seconds`` is 0.
+
+    Keys are (model name, model version, signature name, instance digest) tuples.
+    """
+
+    def __init__(self, max_bytes, ttl_seconds):
+        self._max_bytes = max_bytes
+        self._ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._model_versions = {}
+        self._lock = threading.Lock()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._stats_logged_at = time.time()
+
+    @staticmethod
+    def key(model_name, model_version, signature_name, instance):
+        return model_name, model_version, signature_name, instance_digest(instance)
+
+    def _expired(self, stored_at, now):
+        return self._ttl_seconds > 0 and now - stored_at > self._ttl_seconds
+
+    def get_many(self, keys):
+        """Return the cached prediction for each key, or MISS."""
+        now = time.time()
+        values = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and self._expired(entry[2], now):
+                    self._remove(key)
+                    entry = None
+                if entry is None:
+                    self.misses += 1
+                    values.append(MISS)
+                else:
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    values.append(entry[0])
+            self._log_stats(now)
+
+        lookups = {}
+        for key, value in zip(keys, values):
+            lookups.setdefault(key[0], [0, 0])[value is MISS] += 1
+        for model_name, (hits, misses) in lookups.items():
+            metrics.record_prediction_cache_lookups(model_name, hits, misses)
+        return values
+
+    def put(self, key, value):
+        size = len(json.dumps(value)) + sum(len(str(part)) for part in key)
+        if size > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.time())
+            self.size_bytes += size
+            while self.size_bytes > self._max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.size_bytes -= size
+
+    def invalidate(self, model_name):
+        """Drop every entry of the model."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == model_name]:
+                self._remove(key)
+            self._model_versions.pop(model_name, None)
+
+    def model_version(self, model_name, fetch_version_fn):
+        """Return the version TFS serves for the model when the request names no version.
+
+        ``fetch_version_fn`` is called at most every MODEL_VERSION_CHECK_SECONDS. When the
+        version it returns changes, the entries of the model are dropped.
+        """
+        now = time.time()
+        cached = self._model_versions.get(model_name)
+        if cached and now - cached[1] < MODEL_VERSION_CHECK_SECONDS:
+            return cached[0]
+
+        version = fetch_version_fn()
+        if cached and cached[0] != version:
+            log.info(
+                "model {} version changed from {} to {}, invalidating cached predictions".format(
+                    model_name, cached[0], version
+                )
+            )
+            self.invalidate(model_name)
+        self._model_versions[model_name] = (version, now)
+        return version
+
+    def _log_stats(self, now):
+        if now - self._stats_logged_at < STATS_LOG_INTERVAL_SECONDS:
+            return
+        self._stats_logged_at = now
+        lookups = max(self.hits + self.misses, 1)
+        log.info(
+            "prediction cache stats: hits: {}, misses: {}, hit rate: {:.1%}, entries: {}, "
+            "size: {} bytes, evictions: {}".format(
+                self.hits,
+                self.misses,
+                self.hits / lookups,
+                len(self._entries),
+                self.size_bytes,
+                self.evictions,
+            )
+        )
@@ -10,24 +10,48 @@
 # distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
 # ANY KIND, either express or implied. See the License for the specific
 # language governing permissions and limitations under the License.
-import bisect
+import collections
+import functools
 import importlib.util
+import io
+import itertools
 import json
 import logging
 import os
+import signal
 import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+
 import grpc
 
 import falcon
 import requests
-import random
 
-from multi_model_utils import lock, MultiModelException
+from multi_model_utils import MultiModelException
+import admission
+import chunking
+import eviction
+import grpc_utils
+import handler_pool
+import logging_utils
+import metrics
+import model_host
+import model_loader
+import model_registry
+import prediction_cache
+import request_batcher
+import routing
 import tfs_utils
+import warmup
+import worker_sizing
 
 SAGEMAKER_MULTI_MODEL_ENABLED = os.environ.get("SAGEMAKER_MULTI_MODEL", "false").lower() == "true"
 MODEL_DIR = "models" if SAGEMAKER_MULTI_MODEL_ENABLED else "model"
 INFERENCE_SCRIPT_PATH = f"/opt/ml/{MODEL_DIR}/code/inference.py"
+WARMUP_PATH = f"/opt/ml/{MODEL_DIR}/code/warmup"
 
 SAGEMAKER_BATCHING_ENABLED = os.environ.get("SAGEMAKER_TFS_ENABLE_BATCHING", "false").lower()
 MODEL_CONFIG_FILE_PATH = "/sagemaker/model-config.cfg"
@@ -35,48 +59,585 @@ TFS_GRPC_PORTS = os.environ.get("TFS_GRPC_PORTS")
 TFS_REST_PORTS = os.environ.get("TFS_REST_PORTS")
 SAGEMAKER_TFS_PORT_RANGE = os.environ.get("SAGEMAKER_SAFE_PORT_RANGE")
 TFS_INSTANCE_COUNT = int(os.environ.get("SAGEMAKER_TFS_INSTANCE_COUNT", "1"))
+TFS_ROUTING_POLICY = os.environ.get("SAGEMAKER_TFS_ROUTING_POLICY", "least_outstanding").lower()
+TFS_MAX_RETRIES = int(os.environ.get("SAGEMAKER_TFS_MAX_RETRIES", 1))
+TFS_RETRY_BUDGET_PERCENT = float(os.environ.get("SAGEMAKER_TFS_RETRY_BUDGET_PERCENT", 10))
+TFS_CIRCUIT_BREAKER_FAILURES = int(os.environ.get("SAGEMAKER_TFS_CIRCUIT_BREAKER_FAILURES", 5))
+TFS_CIRCUIT_BREAKER_SECONDS = int(os.environ.get("SAGEMAKER_TFS_CIRCUIT_BREAKER_SECONDS", 10))
+TFS_TRANSPORT = os.environ.get("SAGEMAKER_TFS_TRANSPORT", "rest").lower()
+TFS_GRPC_MIN_PAYLOAD_BYTES = int(os.environ.get("SAGEMAKER_TFS_GRPC_MIN_PAYLOAD_BYTES", 65536))
+TFS_GRPC_MAX_MESSAGE_BYTES = int(os.environ.get("SAGEMAKER_TFS_GRPC_MAX_MESSAGE_BYTES", -1))
+PYTHON_SERVICE_BATCHING_ENABLED = (
+    os.environ.get("SAGEMAKER_PYTHON_SERVICE_ENABLE_BATCHING", "false").lower() == "true"
+)
+PYTHON_SERVICE_MAX_BATCH_SIZE = int(os.environ.get("SAGEMAKER_PYTHON_SERVICE_MAX_BATCH_SIZE", 32))
+PYTHON_SERVICE_BATCH_TIMEOUT_MICROS = int(
+    os.environ.get("SAGEMAKER_PYTHON_SERVICE_BATCH_TIMEOUT_MICROS", 2000)
+)
+PYTHON_SERVICE_STREAM_MIN_BYTES = int(
+    os.environ.get("SAGEMAKER_PYTHON_SERVICE_STREAM_MIN_BYTES", 0)
+)
+PYTHON_SERVICE_SPOOL_MIN_BYTES = int(
+    os.environ.get("SAGEMAKER_PYTHON_SERVICE_SPOOL_MIN_BYTES", 1024 * 1024)
+)
+PREDICTION_CACHE_ENABLED = (
+    os.environ.get("SAGEMAKER_PYTHON_SERVICE_ENABLE_PREDICTION_CACHE", "false").lower() == "true"
+)
+PREDICTION_CACHE_MAX_BYTES = int(
+    os.environ.get("SAGEMAKER_PYTHON_SERVICE_PREDICTION_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+)
+PREDICTION_CACHE_TTL_SECONDS = int(
+    os.environ.get("SAGEMAKER_PYTHON_SERVICE_PREDICTION_CACHE_TTL_SECONDS", 0)
+)
+PYTHON_SERVICE_MAX_CONCURRENCY_PER_MODEL = int(
+    os.environ.get("SAGEMAKER_PYTHON_SERVICE_MAX_CONCURRENCY_PER_MODEL", 0)
+)
+PYTHON_SERVICE_MAX_CONCURRENCY_PER_INSTANCE = int(
+    os.environ.get("SAGEMAKER_PYTHON_SERVICE_MAX_CONCURRENCY_PER_INSTANCE", 0)
+)
+PYTHON_SERVICE_MAX_QUEUE_SIZE = int(os.environ.get("SAGEMAKER_PYTHON_SERVICE_MAX_QUEUE_SIZE", 0))
+PYTHON_SERVICE_MAX_QUEUE_WAIT_MS = int(
+    os.environ.get("SAGEMAKER_PYTHON_SERVICE_MAX_QUEUE_WAIT_MS", 1000)
+)
+PYTHON_SERVICE_HANDLER_PROCESSES = os.environ.get(
+    "SAGEMAKER_PYTHON_SERVICE_HANDLER_PROCESSES", "0"
+).lower()
+PYTHON_SERVICE_HANDLER_SHM_MIN_BYTES = int(
+    os.environ.get("SAGEMAKER_PYTHON_SERVICE_HANDLER_SHM_MIN_BYTES", 1024 * 1024)
+)
+PYTHON_SERVICE_CHUNKING_ENABLED = (
+    os.environ.get("SAGEMAKER_PYTHON_SERVICE_ENABLE_CHUNKING", "false").lower() == "true"
+)
+# by default a chunk is one TFS batch
+PYTHON_SERVICE_CHUNK_RECORDS = int(
+    os.environ.get(
+        "SAGEMAKER_PYTHON_SERVICE_CHUNK_RECORDS", os.environ.get("SAGEMAKER_TFS_MAX_BATCH_SIZE", 8)
+    )
+)
+PYTHON_SERVICE_CHUNK_MIN_BYTES = int(
+    os.environ.get("SAGEMAKER_PYTHON_SERVICE_CHUNK_MIN_BYTES", 1024 * 1024)
+)
+PYTHON_SERVICE_CHUNK_PARALLELISM = int(
+    os.environ.get("SAGEMAKER_PYTHON_SERVICE_CHUNK_PARALLELISM", 2 * TFS_INSTANCE_COUNT)
+)
+MULTI_MODEL_TFS_PROCESSES = int(os.environ.get("SAGEMAKER_MULTI_MODEL_TFS_PROCESSES", 0))
+MULTI_MODEL_MAX_MODELS_PER_PROCESS = int(
+    os.environ.get("SAGEMAKER_MULTI_MODEL_MAX_MODELS_PER_PROCESS", 0)
+)
+MULTI_MODEL_MAX_BYTES_PER_PROCESS = int(
+    os.environ.get("SAGEMAKER_MULTI_MODEL_MAX_BYTES_PER_PROCESS", 0)
+)
+MULTI_MODEL_EVICTION_ENABLED = (
+    os.environ.get("SAGEMAKER_MULTI_MODEL_ENABLE_EVICTION", "false").lower() == "true"
+)
+MULTI_MODEL_MAX_MEMORY_BYTES = int(os.environ.get("SAGEMAKER_MULTI_MODEL_MAX_MEMORY_BYTES", 0))
+MULTI_MODEL_MAX_PROCESSES = int(os.environ.get("SAGEMAKER_MULTI_MODEL_MAX_PROCESSES", 0))
+# how long an eviction waits for the invocations in flight of a model it picked as idle
+EVICTION_DRAIN_SECONDS = 5
+MULTI_MODEL_LOAD_PARALLELISM = int(os.environ.get("SAGEMAKER_MULTI_MODEL_LOAD_PARALLELISM", 4))
+MULTI_MODEL_ASYNC_LOAD_ENABLED = (
+    os.environ.get("SAGEMAKER_MULTI_MODEL_ENABLE_ASYNC_LOAD", "false").lower() == "true"
+)
+# how often a load request checks on the load of the model by another worker
+LOAD_POLL_SECONDS = 0.2
+PYTHON_SERVICE_WARMUP_ROUNDS = int(os.environ.get("SAGEMAKER_PYTHON_SERVICE_WARMUP_ROUNDS", 1))
+# set by serve.py, which waits for every worker to finish warming up before starting nginx
+WARMUP_STATUS_DIR = os.environ.get("SAGEMAKER_WARMUP_STATUS_DIR")
 
-logging.basicConfig(level=logging.INFO)
+logging_utils.configure_logging()
 log = logging.getLogger(__name__)
+request_log = logging_utils.RequestLogger(log)
+
+# the tfs gRPC calls of gevent workers, including model loads, must not block the other
+# requests of the worker
+if grpc_utils.init_gevent():
+    log.info("initialized grpc for gevent")
+
+
+def _handler_process_count():
+    """Number of processes that run the input and output handlers of this worker, 0 to run
+    them in the worker. 'auto' shares the cpus the gunicorn workers leave spare.
+    """
+    if PYTHON_SERVICE_HANDLER_PROCESSES != "auto":
+        try:
+            count = int(PYTHON_SERVICE_HANDLER_PROCESSES)
+        except ValueError:
+            count = -1
+        if count < 0:
+            raise ValueError(
+                "SAGEMAKER_PYTHON_SERVICE_HANDLER_PROCESSES must be 'auto' or a "
+                "non-negative integer"
+            )
+        return count
+    cpus, _ = worker_sizing.cpu_limit()
+    # set to the actual number of workers by serve.py
+    workers = int(os.environ.get("SAGEMAKER_GUNICORN_WORKERS", 1))
+    return max(1, int(cpus - workers) // workers)
+
 
 CUSTOM_ATTRIBUTES_HEADER = "X-Amzn-SageMaker-Custom-Attributes"
+# tells nginx to pass a streamed response on as it arrives, instead of buffering it
+ACCEL_BUFFERING_HEADER = "X-Accel-Buffering"
+
+if TFS_TRANSPORT not in ["rest", "grpc", "auto"]:
+    raise ValueError("SAGEMAKER_TFS_TRANSPORT must be 'rest', 'grpc' or 'auto'")
+if TFS_TRANSPORT != "rest" and not grpc_utils.GRPC_PREDICT_AVAILABLE:
+    log.warning(
+        "SAGEMAKER_TFS_TRANSPORT is '{}' but the tensorflow-serving-api protos could not be "
+        "imported ({}), falling back to the REST API".format(
+            TFS_TRANSPORT, grpc_utils.GRPC_PREDICT_IMPORT_ERROR
+        )
+    )
+
+_shared_tfs_processes = SAGEMAKER_MULTI_MODEL_ENABLED and MULTI_MODEL_TFS_PROCESSES > 0
+if _shared_tfs_processes and not grpc_utils.GRPC_MODEL_SERVICE_AVAILABLE:
+    log.warning(
+        "SAGEMAKER_MULTI_MODEL_TFS_PROCESSES is set but tensorflow-serving-api protos could "
+        "not be imported, starting one tfs process per model"
+    )
+    _shared_tfs_processes = False
+
+if SAGEMAKER_MULTI_MODEL_ENABLED and MULTI_MODEL_LOAD_PARALLELISM < 1:
+    raise ValueError("SAGEMAKER_MULTI_MODEL_LOAD_PARALLELISM must be a positive integer")
+
+if PYTHON_SERVICE_BATCHING_ENABLED:
+    if PYTHON_SERVICE_MAX_BATCH_SIZE < 1:
+        raise ValueError("SAGEMAKER_PYTHON_SERVICE_MAX_BATCH_SIZE must be a positive integer")
+    log.info(
+        "batching concurrent predict requests, max batch size: {}, timeout: {} us".format(
+            PYTHON_SERVICE_MAX_BATCH_SIZE, PYTHON_SERVICE_BATCH_TIMEOUT_MICROS
+        )
+    )
+    _batcher = request_batcher.RequestBatcher(
+        PYTHON_SERVICE_MAX_BATCH_SIZE, PYTHON_SERVICE_BATCH_TIMEOUT_MICROS / 1000000.0
+    )
+else:
+    _batcher = None
+
+if PREDICTION_CACHE_ENABLED:
+    log.info(
+        "caching predictions per instance, max size: {} bytes, ttl: {} seconds".format(
+            PREDICTION_CACHE_MAX_BYTES, PREDICTION_CACHE_TTL_SECONDS
+        )
+    )
+    _prediction_cache = prediction_cache.PredictionCache(
+        PREDICTION_CACHE_MAX_BYTES, PREDICTION_CACHE_TTL_SECONDS
+    )
+else:
+    _prediction_cache = None
+
+if PYTHON_SERVICE_CHUNKING_ENABLED and not SAGEMAKER_MULTI_MODEL_ENABLED:
+    if PYTHON_SERVICE_CHUNK_RECORDS < 1:
+        raise ValueError("SAGEMAKER_PYTHON_SERVICE_CHUNK_RECORDS must be a positive integer")
+    if PYTHON_SERVICE_CHUNK_PARALLELISM < 1:
+        raise ValueError("SAGEMAKER_PYTHON_SERVICE_CHUNK_PARALLELISM must be a positive integer")
+    log.info(
+        "splitting bodies of at least {} bytes into chunks of {} records, {} chunks "
+        "in parallel".format(
+            PYTHON_SERVICE_CHUNK_MIN_BYTES,
+            PYTHON_SERVICE_CHUNK_RECORDS,
+            PYTHON_SERVICE_CHUNK_PARALLELISM,
+        )
+    )
+    # shared by the requests of the worker, so it also bounds the chunks of all requests
+    _chunk_executor = ThreadPoolExecutor(PYTHON_SERVICE_CHUNK_PARALLELISM)
+else:
+    _chunk_executor = None
+
+_handler_processes = _handler_process_count()
+if _handler_processes:
+    log.info(
+        "running input and output handlers in {} processes per worker, sharing buffers of "
+        "at least {} bytes".format(_handler_processes, PYTHON_SERVICE_HANDLER_SHM_MIN_BYTES)
+    )
+    _handler_pool = handler_pool.HandlerPool(
+        _handler_processes,
+        PYTHON_SERVICE_HANDLER_SHM_MIN_BYTES,
+        tfs_utils.detach_context,
+        tfs_utils.attach_context,
+        initializer=logging_utils.reset_after_fork,
+        cpu_seconds_fn=lambda context, cpu_seconds: metrics.handler_cpu(
+            context.model_name, cpu_seconds
+        ),
+    )
+else:
+    _handler_pool = None
+
+if PYTHON_SERVICE_MAX_CONCURRENCY_PER_MODEL or PYTHON_SERVICE_MAX_CONCURRENCY_PER_INSTANCE:
+    log.info(
+        "limiting concurrent invocations per worker, per model: {}, per tfs instance: {}, "
+        "queue size: {}, max queue wait: {} ms".format(
+            PYTHON_SERVICE_MAX_CONCURRENCY_PER_MODEL or "unlimited",
+            PYTHON_SERVICE_MAX_CONCURRENCY_PER_INSTANCE or "unlimited",
+            PYTHON_SERVICE_MAX_QUEUE_SIZE,
+            PYTHON_SERVICE_MAX_QUEUE_WAIT_MS,
+        )
+    )
+# without limits every invocation is admitted at once
+_admission = admission.AdmissionController(
+    PYTHON_SERVICE_MAX_CONCURRENCY_PER_MODEL,
+    PYTHON_SERVICE_MAX_CONCURRENCY_PER_INSTANCE,
+    PYTHON_SERVICE_MAX_QUEUE_SIZE,
+    PYTHON_SERVICE_MAX_QUEUE_WAIT_MS / 1000.0,
+    on_queue_change=metrics.admission_queue_changed,
+    on_reject=metrics.record_admission_rejection,
+)
+
+
+def _is_tfs_unavailable(error):
+    """Whether the error means that the request never reached TFS, so that it is safe to
+    send it to another instance.
+    """
+    if isinstance(error, requests.exceptions.ConnectionError):
+        return True
+    return isinstance(error, grpc.RpcError) and error.code() == grpc.StatusCode.UNAVAILABLE
+
+
+def _is_timeout(error):
+    """Whether the error means that the request reached its deadline while waiting for TFS."""
+    if isinstance(error, (tfs_utils.DeadlineExceeded, requests.exceptions.ReadTimeout)):
+        return True
+    return isinstance(error, grpc.RpcError) and error.code() == grpc.StatusCode.DEADLINE_EXCEEDED
+
+
+def _error_message(body):
+    """The error of a response body, which is a JSON object with an "error" or plain text."""
+    if isinstance(body, bytes):
+        body = body.decode("utf-8")
+    try:
+        error = json.loads(body)
+    except (TypeError, ValueError):
+        return body
+    return error.get("error", body) if isinstance(error, dict) else body
+
+
+def _use_grpc(data, context):
+    if TFS_TRANSPORT == "rest" or not grpc_utils.GRPC_PREDICT_AVAILABLE:
+        return False
+    if context.channel is None or (context.method or "predict") != "predict":
+        return False
+    if not isinstance(data, (bytes, str)):
+        return False
+    return TFS_TRANSPORT == "grpc" or len(data) >= TFS_GRPC_MIN_PAYLOAD_BYTES
+
+
+def _grpc_predict_request(data, context):
+    def _signature_inputs(signature_name):
+        return grpc_utils.signature_inputs(
+            context.channel,
+            context.model_name,
+            context.model_version,
+            signature_name,
+            timeout=tfs_utils.time_remaining(context),
+        )
+
+    return grpc_utils.make_predict_request(
+        data, context.model_name, context.model_version, _signature_inputs
+    )
+
+
+def _grpc_predict(data, context):
+    request, row_format = _grpc_predict_request(data, context)
+    return grpc_utils.predict(
+        context.channel, request, row_format, timeout=tfs_utils.time_remaining(context)
+    )
+
+
+def _row_predict_request(data, context):
+    """Return the instances and signature name of a row format predict request body that
+    has no other fields, or None.
+    """
+    if (context.method or "predict") != "predict" or not isinstance(data, (bytes, str)):
+        return None
+    try:
+        body = json.loads(data)
+    except ValueError:
+        return None
+    if not isinstance(body, dict) or not set(body) <= {"instances", "signature_name"}:
+        return None
+    instances = body.get("instances")
+    if not isinstance(instances, list) or not instances:
+        return None
+    return instances, body.get("signature_name")
+
+
+def _predict_instances(instances, signature_name, context, data=None):
+    if _batcher and len(instances) < PYTHON_SERVICE_MAX_BATCH_SIZE:
+        key = (context.model_name, context.model_version, signature_name)
+        return _batcher.submit(
+            key, instances, signature_name, lambda body: _send_to_tfs(body, context)
+        )
+    if data is None:
+        body = {"instances": instances}
+        if signature_name:
+            body["signature_name"] = signature_name
+        data = json.dumps(body)
+    return _send_to_tfs(data, context)
+
+
+def _cached_predict(instances, signature_name, context, data):
+    model_version = context.model_version or _prediction_cache.model_version(
+        context.model_name,
+        lambda: tfs_utils.serving_model_version(context.rest_session, context.rest_uri),
+    )
+    if model_version is None:
+        return _predict_instances(instances, signature_name, context, data)
+
+    keys = [
+        _prediction_cache.key(context.model_name, model_version, signature_name, instance)
+        for instance in instances
+    ]
+    predictions = _prediction_cache.get_many(keys)
+    misses = [i for i, prediction in enumerate(predictions) if prediction is prediction_cache.MISS]
+    if not misses:
+        return tfs_utils.TfsResponse(200, json.dumps({"predictions": predictions}).encode("utf-8"))
+    if len(misses) == len(instances):
+        response = _predict_instances(instances, signature_name, context, data)
+    else:
+        response = _predict_instances([instances[i] for i in misses], signature_name, context)
+    if response.status_code != 200:
+        return response
+
+    for i, prediction in zip(misses, json.loads(response.content)["predictions"]):
+        predictions[i] = prediction
+        _prediction_cache.put(keys[i], prediction)
+    return tfs_utils.TfsResponse(200, json.dumps({"predictions": predictions}).encode("utf-8"))
+
+
+def _send_to_tfs(data, context):
+    if _use_grpc(data, context):
+        try:
+            return _grpc_predict(data, context)
+        except ValueError as e:
+            log.debug("sending request over rest, cannot convert it to grpc: %s", e)
+    return context.rest_session.post(
+        context.rest_uri, data=data, timeout=tfs_utils.time_remaining(context)
+    )
+
+
+def send_to_tfs(data, context):
+    """Send a predict, classify or regress request body to TFS.
+
+    Uses the TFS REST API by default. Predict requests are sent with PredictionService.Predict
+    over the gRPC channel instead when SAGEMAKER_TFS_TRANSPORT is 'grpc', or when it is 'auto'
+    and the body is at least SAGEMAKER_TFS_GRPC_MIN_PAYLOAD_BYTES long. Either way the
+    response has the status_code and content of a TFS REST response.
+
+    When SAGEMAKER_PYTHON_SERVICE_ENABLE_PREDICTION_CACHE is 'true', the predictions of row
+    format predict requests are cached per instance, and only the instances that are not
+    cached are sent to TFS. When SAGEMAKER_PYTHON_SERVICE_ENABLE_BATCHING is 'true', row
+    format predict requests for the same model, version and signature that arrive together
+    are merged into one TFS request, and each caller gets the predictions for its own
+    instances.
+
+    :param data: request body in TFS REST API format
+    :param context: context instance of the request
+    :return: TFS response
+    """
+    with metrics.stage_timer(context.model_name, "tfs"):
+        row_request = (_prediction_cache or _batcher) and _row_predict_request(data, context)
+        if not row_request:
+            return _send_to_tfs(data, context)
+
+        instances, signature_name = row_request
+        if _prediction_cache:
+            return _cached_predict(instances, signature_name, context, data)
+        return _predict_instances(instances, signature_name, context, data)
+
+
+def _is_protobuf_request(context):
+    content_type = context.request_content_type.split(";")[0].strip().lower()
+    return content_type == grpc_utils.PROTOBUF_CONTENT_TYPE
+
+
+def _should_stream(context):
+    if PYTHON_SERVICE_STREAM_MIN_BYTES <= 0 or context.content_length is None:
+        return False
+    return context.content_length >= PYTHON_SERVICE_STREAM_MIN_BYTES
+
+
+def _is_stream(body):
+    """Return True if a handler returned an iterable of response chunks, rather than the
+    whole response body.
+    """
+    return body is not None and not isinstance(body, (str, bytes, bytearray, memoryview))
+
+
+def _encode_chunks(chunks, model_name):
+    """Encode the str chunks of a streamed response. The status was already sent when the
+    chunks are produced, so a handler error ends the response early instead.
+    """
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            if chunk:
+                yield chunk
+    except Exception:  # pylint: disable=broad-except
+        log.exception("exception streaming the response of %s, ending it early", model_name)
+        raise
+
+
+class _ResponseStream:
+    """The chunks of a streamed response, which the server sends after the handlers
+    returned. Functions added with release_on_close are called when the chunks run out or
+    the server closes the response, so that the invocation holds its slots until its
+    response is sent.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._release_fns = []
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._chunks)
+        except Exception:
+            self.close()
+            raise
+
+    def release_on_close(self, release_fn):
+        if self._closed:
+            release_fn()
+        else:
+            self._release_fns.append(release_fn)
+
+    def close(self):
+        try:
+            if hasattr(self._chunks, "close"):
+                self._chunks.close()
+        finally:
+            self._release()
+
+    def _release(self):
+        self._closed = True
+        release_fns, self._release_fns = self._release_fns, []
+        for release_fn in release_fns:
+            release_fn()
+
+
+def _stream_chunks(chunks, model_name):
+    return _ResponseStream(_encode_chunks(chunks, model_name))
+
+
+def _response_stream(res):
+    for body in (getattr(res, "stream", None), res.body):
+        if isinstance(body, _ResponseStream):
+            return body
+    return None
+
+
+@contextmanager
+def _hold_for_stream(res, context_manager):
+    """Enter the context manager for the block. When the block sets a streamed response
+    body, exit it once the response is closed instead.
+    """
+    with ExitStack() as stack:
+        value = stack.enter_context(context_manager)
+        yield value
+        stream = _response_stream(res)
+        if stream is not None:
+            stream.release_on_close(stack.pop_all().close)
+
+
+def _set_body(res, body, model_name):
+    if _is_stream(body):
+        res.stream = _stream_chunks(body, model_name)
+        res.set_header(ACCEL_BUFFERING_HEADER, "no")
+    else:
+        res.body = body
 
 
 def default_handler(data, context):
     """A default inference request handler that directly send post request to TFS rest port with
     un-processed data and return un-processed response
 
+    Bodies of at least SAGEMAKER_PYTHON_SERVICE_STREAM_MIN_BYTES are streamed to TFS
+    without being read into memory, other bodies are sent as bytes without decoding.
+
     :param data: input data
     :param context: context instance that contains tfs_rest_uri
     :return: inference response from TFS model server
     """
-    data = data.read().decode("utf-8")
-    if not isinstance(data, str):
-        data = json.loads(data)
-    response = requests.post(context.rest_uri, data=data)
+    if _should_stream(context):
+        data = tfs_utils.BodyStream(data, context.content_length)
+    else:
+        with metrics.stage_timer(context.model_name, "body_read"):
+            data = data.read()
+    response = send_to_tfs(data, context)
     return response.content, context.accept_header
 
 
 class PythonServiceResource:
     def __init__(self):
+        self._tfs_default_model_name = os.environ.get("TFS_DEFAULT_MODEL_NAME", "None")
+        self._sessions = {}
+        self._channels = {}
         if SAGEMAKER_MULTI_MODEL_ENABLED:
-            self._model_tfs_rest_port = {}
-            self._model_tfs_grpc_port = {}
-            self._model_tfs_pid = {}
-            self._tfs_ports = self._parse_sagemaker_port_range_mme(SAGEMAKER_TFS_PORT_RANGE)
+            # shared by the workers, which load and invoke each other's models
+            self._registry = model_registry.ModelRegistry(
+                self._parse_sagemaker_port_range_mme(SAGEMAKER_TFS_PORT_RANGE),
+                lock_timings_fn=functools.partial(metrics.lock_timings, "registry"),
+            )
+            # pid -> process of the tfs processes this worker started
+            self._tfs_processes = {}
+            # model name -> version of the model the prediction cache holds predictions of
+            self._model_versions = {}
             # If Multi-Model mode is enabled, dependencies/handlers will be imported
             # during the _handle_load_model_post()
             self.model_handlers = {}
+            self._model_usage = eviction.ModelUsage(
+                self._registry, enabled=MULTI_MODEL_EVICTION_ENABLED
+            )
+            self._loader = model_loader.ModelLoader(self._run_load, MULTI_MODEL_LOAD_PARALLELISM)
+            if _shared_tfs_processes:
+                log.info(
+                    "serving models from {} shared tfs processes, max models per process: {}, "
+                    "max bytes per process: {}".format(
+                        MULTI_MODEL_TFS_PROCESSES,
+                        MULTI_MODEL_MAX_MODELS_PER_PROCESS or "unlimited",
+                        MULTI_MODEL_MAX_BYTES_PER_PROCESS or "unlimited",
+                    )
+                )
+                self._model_host_locks = [
+                    # held by a worker while its tfs process loads models
+                    model_registry.FileLock(
+                        "/sagemaker/tfs-shared-{}.lock".format(i),
+                        functools.partial(metrics.lock_timings, "tfs_process"),
+                        poll_seconds=LOAD_POLL_SECONDS,
+                    )
+                    for i in range(MULTI_MODEL_TFS_PROCESSES)
+                ]
         else:
             self._tfs_grpc_ports = self._parse_concat_ports(TFS_GRPC_PORTS)
             self._tfs_rest_ports = self._parse_concat_ports(TFS_REST_PORTS)
+            self._router = routing.create_router(
+                TFS_ROUTING_POLICY,
+                self._tfs_rest_ports,
+                self._tfs_grpc_ports,
+                failure_threshold=TFS_CIRCUIT_BREAKER_FAILURES,
+                cooldown_seconds=TFS_CIRCUIT_BREAKER_SECONDS,
+                unavailable_ports_fn=tfs_utils.unavailable_tfs_ports,
+            )
+            self._retry_budget = routing.RetryBudget(TFS_RETRY_BUDGET_PERCENT / 100)
+            # retries need a request body that can be read again
+            self._retries_enabled = TFS_MAX_RETRIES > 0 and len(self._tfs_rest_ports) > 1
 
-            self._channels = {}
             for grpc_port in self._tfs_grpc_ports:
                 # Initialize grpc channel here so gunicorn worker could have mapping
                 # between each grpc port and channel
                 self._setup_channel(grpc_port)
 
+            for rest_port in self._tfs_rest_ports:
+                # TFS is already serving when gunicorn starts, so open one
+                # keep-alive connection per port before the first invocation
+                self._setup_session(rest_port)
+                self._warm_session(rest_port, self._tfs_default_model_name)
+
         if os.path.exists(INFERENCE_SCRIPT_PATH):
             # Single-Model Mode & Multi-Model Mode both use one inference.py
             self._handler, self._input_handler, self._output_handler = self._import_handlers()
@@ -87,7 +648,6 @@ class PythonServiceResource:
             self._handlers = default_handler
 
         self._tfs_enable_batching = SAGEMAKER_BATCHING_ENABLED == "true"
-        self._tfs_default_model_name = os.environ.get("TFS_DEFAULT_MODEL_NAME", "None")
         self._tfs_wait_time_seconds = int(os.environ.get("SAGEMAKER_TFS_WAIT_TIME_SECONDS", 300))
 
     def on_post(self, req, res, model_name=None):
@@ -95,14 +655,11 @@ class PythonServiceResource:
             self._handle_invocation_post(req, res, model_name)
         else:
             data = json.loads(req.stream.read().decode("utf-8"))
-            self._handle_load_model_post(res, data)
+            self._handle_load_request(res, data)
 
     def _parse_concat_ports(self, concat_ports):
         return concat_ports.split(",")
 
-    def _pick_port(self, ports):
-        return random.choice(ports)
-
     def _parse_sagemaker_port_range_mme(self, port_range):
         lower, upper = port_range.split("-")
         lower = int(lower)
@@ -110,36 +667,281 @@ class PythonServiceResource:
         rest_port = lower
         grpc_port = (lower + upper) // 2
         tfs_ports = {
-            "rest_port": [port for port in range(rest_port, grpc_port)],
-            "grpc_port": [port for port in range(grpc_port, upper)],
+            "rest_port": range(rest_port, grpc_port),
+            "grpc_port": range(grpc_port, upper),
         }
         return tfs_ports
 
     def _ports_available(self):
-        with lock():
-            rest_ports = self._tfs_ports["rest_port"]
-            grpc_ports = self._tfs_ports["grpc_port"]
-        return len(rest_ports) > 0 and len(grpc_ports) > 0
+        return model_registry.ports_available(self._registry.snapshot())
+
+    def _handle_load_request(self, res, data):
+        """Queue the load of a model on the background loader, or attach to its load in
+        flight, and wait for the load unless loads are asynchronous.
+        """
+        model_name = data["model_name"]
+        load_state, queued = self._queue_load(model_name)
+        if load_state == model_registry.AVAILABLE:
+            res.status = falcon.HTTP_409
+            res.body = json.dumps({"error": "Model {} is already loaded.".format(model_name)})
+            return
+        if load_state == model_registry.UNLOADING:
+            res.status = falcon.HTTP_409
+            res.body = json.dumps({"error": "Model {} is being unloaded.".format(model_name)})
+            return
+
+        if queued:
+            future, _ = self._loader.submit(model_name, data)
+        else:
+            # None when another worker loads the model
+            future = self._loader.in_flight(model_name)
+        if MULTI_MODEL_ASYNC_LOAD_ENABLED:
+            res.status = falcon.HTTP_202
+            res.body = json.dumps({"model_name": model_name, "state": load_state})
+            return
+        result = future.result() if future is not None else self._wait_for_load(model_name)
+        res.status, res.body = result.status, result.body
 
-    def _handle_load_model_post(self, res, data):  # noqa: C901
+    def _queue_load(self, model_name):
+        """Record the load of a model as queued in the registry, unless the model is loaded,
+        or queued or loading by any worker.
+
+        :return: the state of the load or of the model, and True if the load was queued
+        """
+        with self._registry.update() as state:
+            entry = state["models"].get(model_name)
+            load = state["loads"].get(model_name)
+            if load is not None and load["state"] != model_registry.FAILED:
+                if eviction.process_alive(load["worker"]):
+                    return load["state"], False
+                log.warning("the worker loading model %s exited, loading it again", model_name)
+                if entry is not None and entry["state"] == model_registry.LOADING:
+                    self._remove_model_entry(state, model_name)
+                    entry = None
+            if entry is not None:
+                return entry["state"], False
+            state["loads"][model_name] = {
+                "state": model_registry.QUEUED,
+                "worker": os.getpid(),
+                "updated_at": time.time(),
+            }
+            return model_registry.QUEUED, True
+
+    def _run_load(self, model_name, data):
+        """Load a model on the background loader."""
+        with self._registry.update() as state:
+            state["loads"][model_name].update(state=model_registry.LOADING, updated_at=time.time())
+        res = model_loader.LoadResponse()
+        try:
+            self._load_model(res, data)
+        except MultiModelException as e:
+            res.status, res.body = e.code, json.dumps({"error": e.msg})
+        except Exception as e:  # pylint: disable=broad-except
+            log.exception("failed to load model %s", model_name)
+            res.status, res.body = falcon.HTTP_500, json.dumps({"error": str(e)})
+        with self._registry.update() as state:
+            if res.status == falcon.HTTP_200:
+                del state["loads"][model_name]
+            else:
+                state["loads"][model_name] = {
+                    "state": model_registry.FAILED,
+                    "worker": os.getpid(),
+                    "updated_at": time.time(),
+                    "status": res.status,
+                    "error": _error_message(res.body),
+                }
+        return res
+
+    def _wait_for_load(self, model_name):
+        """Wait for the load of a model by another worker."""
+        res = model_loader.LoadResponse()
+        deadline = time.time() + self._tfs_wait_time_seconds
+        while time.time() < deadline:
+            load = self._registry.snapshot()["loads"].get(model_name)
+            if load is None:
+                res.status = falcon.HTTP_200
+                res.body = json.dumps(
+                    {"success": "Successfully loaded model {}.".format(model_name)}
+                )
+                return res
+            if load["state"] == model_registry.FAILED:
+                res.status, res.body = load["status"], json.dumps({"error": load["error"]})
+                return res
+            time.sleep(LOAD_POLL_SECONDS)
+        res.status = falcon.HTTP_408
+        res.body = json.dumps({"error": "Model {} is still loading.".format(model_name)})
+        return res
+
+    def _load_model(self, res, data):
+        """Load a model, first evicting least recently used idle models if it would not fit
+        in the budgets, and once more if it still runs out of ports or memory.
+        """
+        model_name = data["model_name"]
+        if MULTI_MODEL_EVICTION_ENABLED and self._registry.model(model_name) is None:
+            if os.path.exists(data["url"]):
+                self._make_room(model_name, model_host.model_size(data["url"]))
+        try:
+            self._handle_load_model_post(res, data)
+        except MultiModelException as e:
+            if e.code != falcon.HTTP_507:
+                raise
+            res.status, res.body = e.code, json.dumps({"error": e.msg})
+        if res.status == falcon.HTTP_507 and MULTI_MODEL_EVICTION_ENABLED:
+            if self._evict_one("not enough memory or ports to load a model", (model_name,)):
+                res.status, res.body = None, None
+                self._handle_load_model_post(res, data)
+
+    def _tfs_memory_bytes(self):
+        pids = {entry["pid"] for entry in self._registry.models().values() if entry["pid"]}
+        return sum(eviction.process_rss(pid) for pid in pids)
+
+    def _over_budget(self, model_bytes):
+        """Return why a new model of model_bytes does not fit, or None if it fits."""
+        state = self._registry.snapshot()
+        if _shared_tfs_processes:
+            if not self._host_pool(state).has_room(model_bytes):
+                return "no tfs process has room for the model"
+        else:
+            if not model_registry.ports_available(state):
+                return "no available ports"
+            if MULTI_MODEL_MAX_PROCESSES and len(state["models"]) >= MULTI_MODEL_MAX_PROCESSES:
+                return "{} tfs processes are running".format(len(state["models"]))
+        if MULTI_MODEL_MAX_MEMORY_BYTES:
+            used = self._tfs_memory_bytes()
+            if used + model_bytes > MULTI_MODEL_MAX_MEMORY_BYTES:
+                return "tfs processes use {} bytes of the {} bytes memory budget".format(
+                    used, MULTI_MODEL_MAX_MEMORY_BYTES
+                )
+        return None
+
+    def _make_room(self, model_name, model_bytes):
+        reason = self._over_budget(model_bytes)
+        while reason:
+            if not self._evict_one(reason, (model_name,)):
+                log.warning("no idle model to evict for model %s: %s", model_name, reason)
+                return
+            reason = self._over_budget(model_bytes)
+
+    def _evict_one(self, reason, excluded=()):
+        """Unload the least recently used model without invocations in flight.
+
+        :return: True if a model was evicted
+        """
+        for model_name in self._model_usage.least_recently_used(excluded):
+            if not self._model_usage.drain(model_name, EVICTION_DRAIN_SECONDS):
+                continue
+            entry = self._registry.model(model_name)
+            memory_bytes = eviction.process_rss(entry["pid"]) if entry["pid"] else 0
+            last_used = self._model_usage.last_used(model_name)
+            record = eviction.eviction_record(reason, last_used, memory_bytes)
+            try:
+                if not self._unload_model(model_name, record):
+                    # another worker unloads it
+                    continue
+            except (OSError, RuntimeError, grpc.RpcError) as e:
+                log.warning("failed to evict model %s: %s", model_name, e)
+                self._model_usage.undrain(model_name)
+                continue
+            log.info(
+                "evicted model %s, last used %.0f seconds ago, tfs process memory: %d "
+                "bytes, reason: %s",
+                model_name,
+                time.time() - (last_used or entry["loaded_at"]),
+                memory_bytes,
+                reason,
+            )
+            return True
+        return False
+
+    def _host_pool(self, state):
+        """Return the shared TFS processes of the registry state."""
+        pool = model_host.ModelHostPool(
+            MULTI_MODEL_TFS_PROCESSES,
+            MULTI_MODEL_MAX_MODELS_PER_PROCESS,
+            MULTI_MODEL_MAX_BYTES_PER_PROCESS,
+        )
+        pool.restore(state["hosts"])
+        return pool
+
+    def _remove_model(self, model_name, eviction_record=None):
+        """Remove a model from the registry and from its shared TFS process, and release its
+        ports.
+
+        :return: the entry of the model, or None if it is not registered
+        """
+        with self._registry.update() as state:
+            entry = self._remove_model_entry(state, model_name)
+            if eviction_record is not None:
+                eviction.add_record(state["evictions"], model_name, eviction_record)
+        return entry
+
+    def _remove_model_entry(self, state, model_name):
+        entry = state["models"].pop(model_name, None)
+        if entry is not None and entry["host"] is not None:
+            pool = self._host_pool(state)
+            pool.remove(model_name)
+            state["hosts"] = pool.state()
+        elif entry is not None and entry["rest_port"] is not None:
+            model_registry.release_ports(state, entry["rest_port"], entry["grpc_port"])
+        return entry
+
+    def _kill_tfs(self, pid):
+        """Kill a TFS process, which another worker may have started."""
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process = self._tfs_processes.pop(pid, None)
+        if process is not None:
+            process.wait()
+        # the processes this worker started that other workers killed
+        for other_pid, other_process in list(self._tfs_processes.items()):
+            if other_process.poll() is not None:
+                del self._tfs_processes[other_pid]
+
+    def _close_connections(self, rest_port, grpc_port):
+        session = self._sessions.pop(rest_port, None)
+        if session is not None:
+            session.close()
+        channel = self._channels.pop(grpc_port, None)
+        if channel is not None:
+            grpc_utils.close_channel(channel)
+
+    def _handle_load_model_post(self, res, data):
         model_name = data["model_name"]
         base_path = data["url"]
+        if _shared_tfs_processes:
+            self._load_shared_model(res, model_name, base_path)
+            return
+
+        # claim the model and its ports, so that no other worker loads it meanwhile
+        with self._registry.update() as state:
+            loaded = model_name in state["models"]
+            ports = None if loaded else model_registry.take_ports(state)
+            if ports is not None:
+                state["models"][model_name] = model_registry.new_model(state, *ports, base_path)
 
         # model is already loaded
-        if model_name in self._model_tfs_pid:
+        if loaded:
             res.status = falcon.HTTP_409
             res.body = json.dumps({"error": "Model {} is already loaded.".format(model_name)})
+            return
 
         # check if there are available ports
-        if not self._ports_available():
+        if ports is None:
             res.status = falcon.HTTP_507
             res.body = json.dumps(
                 {"error": "Memory exhausted: no available ports to load the model."}
             )
-        with lock():
-            self._model_tfs_rest_port[model_name] = self._tfs_ports["rest_port"].pop()
-            self._model_tfs_grpc_port[model_name] = self._tfs_ports["grpc_port"].pop()
+            return
 
+        try:
+            self._start_model(res, model_name, base_path, *ports)
+        finally:
+            if res.status != falcon.HTTP_200:
+                self._remove_model(model_name)
+
+    def _start_model(self, res, model_name, base_path, rest_port, grpc_port):  # noqa: C901
         # validate model files are in the specified base_path
         if self.validate_model_dir(base_path):
             try:
@@ -157,21 +959,27 @@ class PythonServiceResource:
                     tfs_utils.create_batching_config(batching_config_file)
 
                 cmd = tfs_utils.tfs_command(
-                    self._model_tfs_grpc_port[model_name],
-                    self._model_tfs_rest_port[model_name],
+                    grpc_port,
+                    rest_port,
                     tfs_config_file,
                     self._tfs_enable_batching,
                     batching_config_file,
                 )
                 p = subprocess.Popen(cmd.split())
+                self._tfs_processes[p.pid] = p
 
-                tfs_utils.wait_for_model(
-                    self._model_tfs_rest_port[model_name], model_name, self._tfs_wait_time_seconds
-                )
+                try:
+                    tfs_utils.wait_for_model(rest_port, model_name, self._tfs_wait_time_seconds)
+                except BaseException:
+                    self._kill_tfs(p.pid)
+                    raise
 
                 log.info("started tensorflow serving (pid: %d)", p.pid)
-                # update model name <-> tfs pid map
-                self._model_tfs_pid[model_name] = p
+                self._registry.model_available(model_name, pid=p.pid)
+                self._setup_session(rest_port)
+                self._setup_channel(grpc_port)
+                if _prediction_cache:
+                    _prediction_cache.invalidate(model_name)
 
                 res.status = falcon.HTTP_200
                 res.body = json.dumps(
@@ -180,8 +988,8 @@ class PythonServiceResource:
                         "listening on rest port {} "
                         "and grpc port {}.".format(
                             model_name,
-                            self._model_tfs_rest_port,
-                            self._model_tfs_grpc_port,
+                            rest_port,
+                            grpc_port,
                         )
                     }
                 )
@@ -221,66 +1029,517 @@ class PythonServiceResource:
                 }
             )
 
+    def _load_shared_model(self, res, model_name, base_path):
+        """Load a model into one of the shared TFS processes, starting the process if it is
+        not running.
+        """
+        if not self.validate_model_dir(base_path):
+            res.status = falcon.HTTP_404
+            res.body = json.dumps(
+                {
+                    "error": "Could not find valid base path {} for servable {}".format(
+                        base_path, model_name
+                    )
+                }
+            )
+            return
+        size = model_host.model_size(base_path)
+        error = None
+        with self._registry.update() as state:
+            if model_name in state["models"]:
+                error = falcon.HTTP_409, "Model {} is already loaded.".format(model_name)
+            else:
+                pool = self._host_pool(state)
+                try:
+                    host = pool.place(model_name, base_path, size)
+                except model_host.NoCapacity as e:
+                    error = falcon.HTTP_507, "Memory exhausted: {}".format(e)
+                else:
+                    state["hosts"] = pool.state()
+                    state["models"][model_name] = model_registry.new_model(
+                        state, None, None, base_path, host=host.index
+                    )
+        if error is not None:
+            res.status = error[0]
+            res.body = json.dumps({"error": error[1]})
+            return
+
+        log.info("loading model %s into %s", model_name, host)
+        try:
+            host = self._update_model_host(host.index)
+            grpc_utils.wait_for_model_status(
+                self._channel(host.grpc_port), model_name, self._tfs_wait_time_seconds
+            )
+        except (MultiModelException, RuntimeError, OSError, grpc.RpcError) as e:
+            self._remove_model(model_name)
+            self._rollback_model_host(host.index)
+            self._set_load_error(res, model_name, e)
+            return
+
+        self._registry.model_available(
+            model_name, rest_port=host.rest_port, grpc_port=host.grpc_port, pid=host.pid
+        )
+        if _prediction_cache:
+            _prediction_cache.invalidate(model_name)
+        res.status = falcon.HTTP_200
+        res.body = json.dumps(
+            {
+                "success": "Successfully loaded model {}, listening on rest port {} "
+                "and grpc port {}.".format(model_name, host.rest_port, host.grpc_port)
+            }
+        )
+
+    def _set_load_error(self, res, model_name, error):
+        if isinstance(error, TimeoutError):
+            res.status = falcon.HTTP_408
+        elif isinstance(error, MultiModelException):
+            res.status, error = error.code, error.msg
+        elif isinstance(error, OSError) and error.errno == 12:
+            res.status = falcon.HTTP_507
+            error = "Memory exhausted: not enough memory to start TFS instance"
+        else:
+            res.status = falcon.HTTP_500
+        log.error("failed to load model %s: %s", model_name, error)
+        res.body = json.dumps({"error": str(error)})
+
+    def _model_host_config_file(self, host):
+        return "/sagemaker/tfs-config/shared-{}/model-config.cfg".format(host.index)
+
+    def _update_model_host(self, index):
+        """Make the TFS process of a host serve the models of the host in the registry,
+        starting it if it is not running, and stopping it if it has no models left.
+
+        :return: the host
+        """
+        with self._model_host_locks[index]:
+            host = self._host_pool(self._registry.snapshot()).hosts[index]
+            if not host.models:
+                self._stop_model_host(host)
+                return host
+            config = tfs_utils.create_tfs_config_models(host.base_paths())
+            config_file = self._model_host_config_file(host)
+            os.makedirs(os.path.dirname(config_file), exist_ok=True)
+            with open(config_file, "w", encoding="utf8") as f:
+                f.write(config)
+            if host.pid is None:
+                self._start_model_host(host, config_file)
+            else:
+                grpc_utils.reload_model_config(
+                    self._channel(host.grpc_port), config, timeout=self._tfs_wait_time_seconds
+                )
+            return host
+
+    def _rollback_model_host(self, index):
+        try:
+            self._update_model_host(index)
+        except (RuntimeError, OSError, grpc.RpcError) as e:
+            log.warning("failed to restore the model config of tfs process %s: %s", index, e)
+
+    def _start_model_host(self, host, config_file):
+        with self._registry.update() as state:
+            ports = model_registry.take_ports(state)
+            if ports is not None:
+                host.rest_port, host.grpc_port = ports
+                # the models of the host may have been unloaded meanwhile
+                state["hosts"].setdefault(str(host.index), host.state()).update(
+                    rest_port=host.rest_port, grpc_port=host.grpc_port
+                )
+        if ports is None:
+            raise MultiModelException(
+                falcon.HTTP_507, "Memory exhausted: no available ports to start TFS."
+            )
+
+        batching_config_file = "/sagemaker/batching/shared-{}/batching-config.cfg".format(
+            host.index
+        )
+        if self._tfs_enable_batching:
+            tfs_utils.create_batching_config(batching_config_file)
+        cmd = tfs_utils.tfs_command(
+            host.grpc_port,
+            host.rest_port,
+            config_file,
+            self._tfs_enable_batching,
+            batching_config_file,
+        )
+        try:
+            process = subprocess.Popen(cmd.split())
+        except OSError:
+            self._release_model_host(host)
+            raise
+        self._tfs_processes[process.pid] = process
+        host.pid = process.pid
+        with self._registry.update() as state:
+            state["hosts"][str(host.index)]["pid"] = host.pid
+        log.info("started %s (pid: %d)", host, host.pid)
+        self._setup_session(host.rest_port)
+        self._setup_channel(host.grpc_port)
+
+    def _stop_model_host(self, host):
+        if host.pid is None:
+            return
+        log.info("stopping %s, it has no models left", host)
+        self._kill_tfs(host.pid)
+        self._cleanup_config_file(self._model_host_config_file(host))
+        self._close_connections(host.rest_port, host.grpc_port)
+        self._release_model_host(host)
+
+    def _release_model_host(self, host):
+        """Release the ports of a host whose process stopped."""
+        with self._registry.update() as state:
+            host_state = state["hosts"].pop(str(host.index), None)
+            if host_state is not None and host_state["models"]:
+                # models placed on the host meanwhile start it again
+                host_state.update(pid=None, rest_port=None, grpc_port=None)
+                state["hosts"][str(host.index)] = host_state
+            model_registry.release_ports(state, host.rest_port, host.grpc_port)
+        host.pid = host.rest_port = host.grpc_port = None
+
+    def _unload_shared_model(self, model_name, entry, eviction_record):
+        self._remove_model(model_name, eviction_record)
+        try:
+            self._update_model_host(entry["host"])
+        except (RuntimeError, OSError, grpc.RpcError):
+            # TFS still serves the model
+            size = model_host.model_size(entry["base_path"])
+            with self._registry.update() as state:
+                pool = self._host_pool(state)
+                pool.add(pool.hosts[entry["host"]], model_name, entry["base_path"], size)
+                state["hosts"] = pool.state()
+                state["models"][model_name] = dict(entry, state=model_registry.AVAILABLE)
+                state["evictions"].pop(model_name, None)
+            raise
+
     def _cleanup_config_file(self, config_file):
         if os.path.exists(config_file):
             os.remove(config_file)
 
+    def _check_model_loaded(self, res, model_name):
+        """Return the registry entry of the model to invoke, or None if it is not available."""
+        if not model_name:
+            res.status = falcon.HTTP_400
+            res.body = json.dumps({"error": "Invocation request does not contain model name."})
+            return None
+        entry = self._registry.model(model_name)
+        if (
+            entry is None
+            or entry["state"] != model_registry.AVAILABLE
+            or not self._model_usage.admitted(model_name)
+        ):
+            res.status = falcon.HTTP_404
+            res.body = json.dumps({"error": "Model {} is not loaded yet.".format(model_name)})
+            return None
+        if self._model_versions.get(model_name) != entry["version"]:
+            # the model was loaded again, possibly by another worker
+            if _prediction_cache:
+                _prediction_cache.invalidate(model_name)
+            grpc_utils.forget_model(model_name)
+            self._model_versions[model_name] = entry["version"]
+        return entry
+
     def _handle_invocation_post(self, req, res, model_name=None):
+        model = model_name or tfs_utils.parse_tfs_custom_attributes(req).get(
+            "tfs-model-name", self._tfs_default_model_name
+        )
+        if not metrics.METRICS_ENABLED:
+            self._admit_invocation(req, res, model_name, model)
+            return
+
+        with metrics.stage_timer(model, "total"):
+            self._admit_invocation(req, res, model_name, model)
+        metrics.record_invocation(model, res.status)
+
+    def _admit_invocation(self, req, res, model_name, model):
+        try:
+            deadline = tfs_utils.request_deadline(req)
+            with _hold_for_stream(res, _admission.model(model, deadline)):
+                self._invoke(req, res, model_name, model)
+        except admission.AdmissionRejected as e:
+            self._reject(res, e)
+
+    def _reject(self, res, error):
+        request_log.info("rejecting invocation: %s", error)
+        res.status = falcon.HTTP_429
+        res.body = json.dumps({"error": str(error)})
+
+    def _invoke(self, req, res, model_name=None, model=None):
         if SAGEMAKER_MULTI_MODEL_ENABLED:
-            if model_name:
-                if model_name not in self._model_tfs_rest_port:
-                    res.status = falcon.HTTP_404
-                    res.body = json.dumps(
-                        {"error": "Model {} is not loaded yet.".format(model_name)}
-                    )
-                    return
-                else:
-                    log.info("model name: {}".format(model_name))
-                    rest_port = self._model_tfs_rest_port[model_name]
-                    log.info("rest port: {}".format(str(self._model_tfs_rest_port[model_name])))
-                    grpc_port = self._model_tfs_grpc_port[model_name]
-                    log.info("grpc port: {}".format(str(self._model_tfs_grpc_port[model_name])))
-                    data, context = tfs_utils.parse_request(
-                        req,
-                        rest_port,
-                        grpc_port,
-                        self._tfs_default_model_name,
-                        model_name=model_name,
-                    )
-            else:
-                res.status = falcon.HTTP_400
-                res.body = json.dumps({"error": "Invocation request does not contain model name."})
-        else:
-            # Randomly pick port used for routing incoming request.
-            grpc_port = self._pick_port(self._tfs_grpc_ports)
-            rest_port = self._pick_port(self._tfs_rest_ports)
-            data, context = tfs_utils.parse_request(
-                req,
-                rest_port,
-                grpc_port,
-                self._tfs_default_model_name,
-                channel=self._channels[grpc_port],
-            )
+            # counted before the model is checked, so that it is not evicted meanwhile
+            with _hold_for_stream(res, self._model_usage.invocation(model_name)):
+                self._invoke_model(req, res, model_name)
+            return
+
+        if _chunk_executor is not None and self._should_chunk(req):
+            self._invoke_chunked(req, res, model)
+            return
+
+        self._retry_budget.deposit()
+        body = None
+        if self._retries_enabled:
+            with metrics.stage_timer(model, "body_read"):
+                body = tfs_utils.spool_body(req.stream, PYTHON_SERVICE_SPOOL_MIN_BYTES)
+        try:
+            self._route_invocation(req, res, body)
+        finally:
+            if body is not None:
+                body.close()
+
+    def _invoke_model(self, req, res, model_name):
+        entry = self._check_model_loaded(res, model_name)
+        if entry is None:
+            return
+
+        rest_port = entry["rest_port"]
+        grpc_port = entry["grpc_port"]
+        request_log.info(
+            "model name: %s, rest port: %s, grpc port: %s", model_name, rest_port, grpc_port
+        )
+        data, context = tfs_utils.parse_request(
+            req,
+            rest_port,
+            grpc_port,
+            self._tfs_default_model_name,
+            model_name=model_name,
+            channel=self._channel(grpc_port),
+            session=self._session(rest_port),
+        )
+        with _hold_for_stream(res, _admission.instance(rest_port, context.deadline)):
+            with _hold_for_stream(res, metrics.tfs_in_flight(rest_port)):
+                self._call_handlers(res, data, context, rest_port)
+
+    def _should_chunk(self, req):
+        if req.content_length is None or req.content_length < PYTHON_SERVICE_CHUNK_MIN_BYTES:
+            return False
+        content_type = req.get_header("Content-Type") or tfs_utils.DEFAULT_CONTENT_TYPE
+        return content_type.split(";")[0].strip().lower() != grpc_utils.PROTOBUF_CONTENT_TYPE
+
+    def _invoke_chunked(self, req, res, model):
+        """Run the handlers and TFS on chunks of a multi-record body in parallel, spread
+        across the TFS instances, and merge the responses in the order of the records.
+
+        The body is split as it is read, at most PYTHON_SERVICE_CHUNK_PARALLELISM chunks
+        ahead of the first chunk without a response. The chunks share the admission of the
+        request, and its deposit in the retry budget.
+        """
+        self._retry_budget.deposit()
+        chunks = chunking.split(
+            tfs_utils.BodyStream(req.stream, req.content_length),
+            req.get_header("Content-Type") or tfs_utils.DEFAULT_CONTENT_TYPE,
+            PYTHON_SERVICE_CHUNK_RECORDS,
+        )
+        first = next(chunks)
+        second = next(chunks, None)
+        if second is None:
+            self._route_invocation(req, res, io.BytesIO(first))
+            return
+
+        request_log.info("processing %s records in chunks", model)
+        chunks = itertools.chain((first, second), chunks)
+        del first, second
+        invoke_chunk = functools.partial(self._invoke_chunk, req)
+        pending = collections.deque()
+        bodies = []
+        while True:
+            for chunk in itertools.islice(chunks, PYTHON_SERVICE_CHUNK_PARALLELISM - len(pending)):
+                pending.append(_chunk_executor.submit(invoke_chunk, chunk))
+            if not pending:
+                break
+            response = pending.popleft().result()
+            if response.status != falcon.HTTP_200:
+                for future in pending:
+                    future.cancel()
+                res.status, res.body = response.status, response.body
+                return
+            if not bodies:
+                res.content_type = response.content_type
+            bodies.append(response.body)
+        res.status = falcon.HTTP_200
+        res.body = chunking.merge(bodies, res.content_type)
+
+    def _invoke_chunk(self, req, chunk):
+        response = chunking.ChunkResponse()
+        self._route_invocation(req, response, io.BytesIO(chunk), len(chunk), admitted=True)
+        if response.stream is not None:
+            # sent with the other chunks, and not held until then
+            response.body, response.stream = chunking.to_bytes(response.stream), None
+        return response
+
+    def _route_invocation(self, req, res, body, content_length=None, admitted=False):
+        """Run the handlers on a TFS instance, retrying on another instance when it is
+        unavailable. ``admitted`` is set for the chunks of a request, which share the
+        admission of the request instead of taking the admission of their instances.
+        """
+        tried = []
+        while True:
+            # The rest and grpc ports always belong to the same TFS instance, which
+            # stays counted as in flight until the handlers return, or until their
+            # streamed response is sent.
+            with _hold_for_stream(res, self._router.route(excluded=tried)) as instance:
+                data, context = tfs_utils.parse_request(
+                    req,
+                    instance.rest_port,
+                    instance.grpc_port,
+                    self._tfs_default_model_name,
+                    channel=self._channels[instance.grpc_port],
+                    session=self._sessions[instance.rest_port],
+                )
+                if body is not None:
+                    body.seek(0)
+                    data = body
+                if content_length is not None:
+                    context = context._replace(content_length=content_length)
+                rest_port = instance.rest_port
+                with ExitStack() as stack:
+                    if not admitted:
+                        stack.enter_context(
+                            _hold_for_stream(res, _admission.instance(rest_port, context.deadline))
+                        )
+                    with _hold_for_stream(res, metrics.tfs_in_flight(rest_port)):
+                        error = self._call_handlers(res, data, context, rest_port)
+
+            if not _is_tfs_unavailable(error):
+                self._router.record_success(instance)
+                return
+            self._router.record_failure(instance)
+            tried.append(instance)
+            if not self._can_retry(tried):
+                return
+            log.warning("{} is unavailable, retrying on another instance".format(instance))
 
+    def _can_retry(self, tried):
+        if not self._retries_enabled or len(tried) > TFS_MAX_RETRIES:
+            return False
+        if len(tried) >= len(self._tfs_rest_ports):
+            return False
+        return self._retry_budget.withdraw()
+
+    def _call_handlers(self, res, data, context, rest_port):
+        """Run the handlers and set the response, returning the exception raised by the
+        handlers, if any.
+        """
+        if self._shed_expired(res, context):
+            return None
+        if _is_protobuf_request(context):
+            return self._call_protobuf_predict(res, data, context, rest_port)
         try:
             res.status = falcon.HTTP_200
 
-            res.body, res.content_type = self._handlers(data, context)
+            body, res.content_type = self._handlers(data, context)
+            _set_body(res, body, context.model_name)
         except Exception as e:  # pylint: disable=broad-except
-            log.exception("exception handling request: {}".format(e))
-            res.status = falcon.HTTP_500
-            res.body = json.dumps({"error": str(e)}).encode("utf-8")  # pylint: disable=E1101
+            return self._call_handlers_error(res, e, rest_port)
+        return None
+
+    def _shed_expired(self, res, context):
+        """Reject the request without any TFS work if its deadline passed while it was
+        queued.
+        """
+        if context.deadline is None or time.time() < context.deadline:
+            return False
+        request_log.info("rejecting request for %s, deadline exceeded", context.model_name)
+        res.status = falcon.HTTP_503
+        res.body = json.dumps({"error": "request deadline exceeded before it was processed"})
+        return True
+
+    def _call_protobuf_predict(self, res, data, context, rest_port):
+        """Forward a serialized PredictRequest to TFS over gRPC, bypassing the handlers."""
+        if not grpc_utils.GRPC_PREDICT_AVAILABLE or context.channel is None:
+            res.status = falcon.HTTP_415
+            res.body = json.dumps({"error": "protobuf requests are not supported"})
+            return None
+
+        # in multi-model mode the model name always comes from the url
+        model_name = None
+        attributes = tfs_utils.parse_custom_attributes_header(context.custom_attributes)
+        if SAGEMAKER_MULTI_MODEL_ENABLED or "tfs-model-name" in attributes:
+            model_name = context.model_name
+        try:
+            request = grpc_utils.parse_predict_request(
+                data.read(), model_name, context.model_version, context.model_name
+            )
+        except ValueError as e:
+            res.status = falcon.HTTP_400
+            res.body = json.dumps({"error": str(e)})
+            return None
+
+        serialized_response = grpc_utils.PROTOBUF_CONTENT_TYPE in context.accept_header
+        try:
+            response = grpc_utils.predict_protobuf(
+                context.channel,
+                request,
+                serialized_response,
+                timeout=tfs_utils.time_remaining(context),
+            )
+        except Exception as e:  # pylint: disable=broad-except
+            return self._call_handlers_error(res, e, rest_port)
+
+        res.status = falcon.get_http_status(response.status_code)
+        res.body = response.content
+        if serialized_response and response.status_code == 200:
+            res.content_type = grpc_utils.PROTOBUF_CONTENT_TYPE
+        else:
+            res.content_type = "application/json"
+        return None
+
+    def _call_handlers_error(self, res, error, rest_port):
+        if isinstance(error, requests.exceptions.ConnectionError):
+            # pooled connections to a restarted TFS instance are all dead
+            self._reset_session(rest_port)
+        if _is_timeout(error):
+            request_log.info("request deadline exceeded while waiting for TFS: %s", error)
+            res.status = falcon.HTTP_504
+            res.body = json.dumps({"error": "request deadline exceeded"}).encode("utf-8")
+            return error
+        log.exception("exception handling request: {}".format(error))
+        res.status = falcon.HTTP_500
+        res.body = json.dumps({"error": str(error)}).encode("utf-8")  # pylint: disable=E1101
+        return error
 
     def _setup_channel(self, grpc_port):
         if grpc_port not in self._channels:
             log.info("Creating grpc channel for port: %s", grpc_port)
-            self._channels[grpc_port] = grpc.insecure_channel("localhost:{}".format(grpc_port))
+            options = [
+                ("grpc.max_send_message_length", TFS_GRPC_MAX_MESSAGE_BYTES),
+                ("grpc.max_receive_message_length", TFS_GRPC_MAX_MESSAGE_BYTES),
+            ]
+            self._channels[grpc_port] = grpc.insecure_channel(
+                "localhost:{}".format(grpc_port), options=options
+            )
+
+    def _setup_session(self, rest_port):
+        if rest_port not in self._sessions:
+            log.info("Creating rest session for port: %s", rest_port)
+            self._sessions[rest_port] = tfs_utils.create_rest_session()
+
+    def _channel(self, grpc_port):
+        self._setup_channel(grpc_port)
+        return self._channels[grpc_port]
+
+    def _session(self, rest_port):
+        self._setup_session(rest_port)
+        return self._sessions[rest_port]
+
+    def _warm_session(self, rest_port, model_name):
+        uri = "http://localhost:{}/v1/models/{}".format(rest_port, model_name)
+        try:
+            self._sessions[rest_port].get(uri, timeout=5)
+        except requests.exceptions.RequestException as e:
+            log.warning("failed to warm up rest session for port %s: %s", rest_port, e)
+
+    def _reset_session(self, rest_port):
+        session = self._sessions.pop(rest_port, None)
+        if session is not None:
+            log.info("Resetting rest session for port: %s", rest_port)
+            session.close()
+        self._setup_session(rest_port)
 
     def _import_handlers(self):
         inference_script = INFERENCE_SCRIPT_PATH
         spec = importlib.util.spec_from_file_location("inference", inference_script)
         inference = importlib.util.module_from_spec(spec)
         spec.loader.exec_module(inference)
+        if _handler_pool is not None:
+            # the handler processes unpickle the handlers by module and name
+            sys.modules["inference"] = inference
 
         _custom_handler, _custom_input_handler, _custom_output_handler = None, None, None
         if hasattr(inference, "handler"):
@@ -295,71 +1554,146 @@ class PythonServiceResource:
 
     def _make_handler(self, custom_handler, custom_input_handler, custom_output_handler):
         if custom_handler:
-            return custom_handler
+            if not metrics.METRICS_ENABLED:
+                return custom_handler
+
+            def timed_handler(data, context):
+                with metrics.handler_timer(context.model_name, "handler"):
+                    return custom_handler(data, context)
+
+            return timed_handler
+
+        run_input_handler, run_output_handler = custom_input_handler, custom_output_handler
+        if _handler_pool is not None:
+            # requests to TFS are still sent by the worker, between the handler processes
+            run_input_handler = functools.partial(
+                _handler_pool.run_input_handler, custom_input_handler
+            )
+            run_output_handler = functools.partial(
+                _handler_pool.run_output_handler, custom_output_handler
+            )
 
         def handler(data, context):
-            processed_input = custom_input_handler(data, context)
-            response = requests.post(context.rest_uri, data=processed_input)
-            return custom_output_handler(response, context)
+            with metrics.handler_timer(context.model_name, "input_handler"):
+                processed_input = run_input_handler(data, context)
+            response = send_to_tfs(processed_input, context)
+            with metrics.handler_timer(context.model_name, "output_handler"):
+                return run_output_handler(response, context)
 
         return handler
 
     def on_get(self, req, res, model_name=None):  # pylint: disable=W0613
         if model_name is None:
-            models_info = {}
-            uri = "http://localhost:{}/v1/models/{}"
-            for model, port in self._model_tfs_rest_port.items():
-                try:
-                    info = json.loads(requests.get(uri.format(port, model)).content)
-                    models_info[model] = info
-                except ValueError as e:
-                    log.exception("exception handling request: {}".format(e))
-                    res.status = falcon.HTTP_500
-                    res.body = json.dumps({"error": str(e)}).encode("utf-8")
+            self._list_models(res)
+            return
+        state = self._registry.snapshot()
+        entry = state["models"].get(model_name)
+        load = state["loads"].get(model_name)
+        if entry is not None and entry["state"] == model_registry.AVAILABLE:
+            uri = "http://localhost:{}/v1/models/{}".format(entry["rest_port"], model_name)
+            try:
+                info = json.loads(requests.get(uri).content)
+                body = {"model": info, "state": model_registry.AVAILABLE}
+                res.status = falcon.HTTP_200
+                last_used = self._model_usage.last_used(model_name)
+                res.body = json.dumps(self._add_model_usage(entry, body, last_used))
+            except ValueError as e:
+                log.exception("exception handling GET models request.")
+                res.status = falcon.HTTP_500
+                res.body = json.dumps({"error": str(e)}).encode("utf-8")
+        elif load is not None or entry is not None:
             res.status = falcon.HTTP_200
-            res.body = json.dumps(models_info)
+            res.body = json.dumps(self._load_state(model_name, entry, load))
         else:
-            if model_name not in self._model_tfs_rest_port:
-                res.status = falcon.HTTP_404
-                res.body = json.dumps(
-                    {"error": "Model {} is loaded yet.".format(model_name)}
-                ).encode("utf-8")
-            else:
-                port = self._model_tfs_rest_port[model_name]
-                uri = "http://localhost:{}/v1/models/{}".format(port, model_name)
-                try:
-                    info = requests.get(uri)
-                    res.status = falcon.HTTP_200
-                    res.body = json.dumps({"model": info}).encode("utf-8")
-                except ValueError as e:
-                    log.exception("exception handling GET models request.")
-                    res.status = falcon.HTTP_500
-                    res.body = json.dumps({"error": str(e)}).encode("utf-8")
+            error = {"error": "Model {} is not loaded yet.".format(model_name)}
+            record = state["evictions"].get(model_name)
+            if record is not None:
+                error["evicted"] = record
+            res.status = falcon.HTTP_404
+            res.body = json.dumps(error).encode("utf-8")
+
+    def _load_state(self, model_name, entry, load):
+        """Return the state of a model that is not available, which can be polled while it
+        loads.
+        """
+        if load is None:
+            return {"model_name": model_name, "state": entry["state"]}
+        body = {"model_name": model_name, "state": load["state"]}
+        if load["state"] == model_registry.FAILED:
+            body["error"] = load["error"]
+        return body
+
+    def _list_models(self, res):
+        state = self._registry.snapshot()
+        models_info = {}
+        last_used = self._model_usage.last_used_times()
+        uri = "http://localhost:{}/v1/models/{}"
+        for model, entry in state["models"].items():
+            if entry["state"] != model_registry.AVAILABLE:
+                models_info[model] = {"state": entry["state"]}
+                continue
+            try:
+                info = json.loads(requests.get(uri.format(entry["rest_port"], model)).content)
+                models_info[model] = self._add_model_usage(entry, info, last_used.get(model))
+            except ValueError as e:
+                log.exception("exception handling request: {}".format(e))
+                res.status = falcon.HTTP_500
+                res.body = json.dumps({"error": str(e)}).encode("utf-8")
+        for model, load in state["loads"].items():
+            if model not in models_info or load["state"] == model_registry.FAILED:
+                models_info[model] = self._load_state(model, None, load)
+        # evicted models stay listed until they are loaded again
+        for model, record in state["evictions"].items():
+            models_info.setdefault(model, {"evicted": record})
+        res.status = falcon.HTTP_200
+        res.body = json.dumps(models_info)
+
+    def _add_model_usage(self, entry, info, last_used):
+        if isinstance(info, dict):
+            info["last_invoked_at"] = last_used
+            info["tfs_process_memory_bytes"] = eviction.process_rss(entry["pid"])
+        return info
 
     def on_delete(self, req, res, model_name):  # pylint: disable=W0613
-        if model_name not in self._model_tfs_pid:
+        try:
+            unloaded = self._unload_model(model_name)
+        except (OSError, RuntimeError, grpc.RpcError) as error:
+            res.status = falcon.HTTP_500
+            res.body = json.dumps({"error": str(error)}).encode("utf-8")
+            return
+        if not unloaded:
             res.status = falcon.HTTP_404
             res.body = json.dumps({"error": "Model {} is not loaded yet".format(model_name)})
-        else:
-            try:
-                self._model_tfs_pid[model_name].kill()
-                os.remove("/sagemaker/tfs-config/{}/model-config.cfg".format(model_name))
-                os.rmdir("/sagemaker/tfs-config/{}".format(model_name))
-                release_rest_port = self._model_tfs_rest_port[model_name]
-                release_grpc_port = self._model_tfs_grpc_port[model_name]
-                with lock():
-                    bisect.insort(self._tfs_ports["rest_port"], release_rest_port)
-                    bisect.insort(self._tfs_ports["grpc_port"], release_grpc_port)
-                del self._model_tfs_rest_port[model_name]
-                del self._model_tfs_grpc_port[model_name]
-                del self._model_tfs_pid[model_name]
-                res.status = falcon.HTTP_200
-                res.body = json.dumps(
-                    {"success": "Successfully unloaded model {}.".format(model_name)}
-                )
-            except OSError as error:
-                res.status = falcon.HTTP_500
-                res.body = json.dumps({"error": str(error)}).encode("utf-8")
+            return
+        res.status = falcon.HTTP_200
+        res.body = json.dumps({"success": "Successfully unloaded model {}.".format(model_name)})
+
+    def _unload_model(self, model_name, eviction_record=None):
+        """Unload a model, recording its eviction if it is evicted.
+
+        :return: False if the model is not available, or another worker unloads it
+        """
+        with self._registry.update() as state:
+            entry = state["models"].get(model_name)
+            if entry is not None and entry["state"] == model_registry.AVAILABLE:
+                entry["state"] = model_registry.UNLOADING
+                entry = dict(entry)
+            else:
+                entry = None
+        if entry is None:
+            return False
+        if _prediction_cache:
+            _prediction_cache.invalidate(model_name)
+        grpc_utils.forget_model(model_name)
+        if entry["host"] is not None:
+            self._unload_shared_model(model_name, entry, eviction_record)
+            return True
+        self._kill_tfs(entry["pid"])
+        self._close_connections(entry["rest_port"], entry["grpc_port"])
+        self._remove_model(model_name, eviction_record)
+        os.remove("/sagemaker/tfs-config/{}/model-config.cfg".format(model_name))
+        os.rmdir("/sagemaker/tfs-config/{}".format(model_name))
+        return True
 
     def validate_model_dir(self, model_path):
         # model base path doesn't exits
@@ -385,24 +1719,65 @@ class PythonServiceResource:
 
 
 class PingResource:
+    def __init__(self, warmup_run=None):
+        self._warmup = warmup_run
+
     def on_get(self, req, res):  # pylint: disable=W0613
+        if self._warmup is not None and not self._warmup.done:
+            res.status = falcon.HTTP_503
+            res.body = json.dumps({"error": "warming up"})
+            return
         res.status = falcon.HTTP_200
 
 
+class MetricsResource:
+    def on_get(self, req, res):  # pylint: disable=W0613
+        res.status = falcon.HTTP_200
+        res.content_type, res.body = metrics.generate()
+
+
 class ServiceResources:
     def __init__(self):
         self._enable_model_manager = SAGEMAKER_MULTI_MODEL_ENABLED
         self._python_service_resource = PythonServiceResource()
-        self._ping_resource = PingResource()
+        self._ping_resource = PingResource(self._start_warmup())
+        self._metrics_resource = MetricsResource()
+        metrics.remove_dead_workers()
 
-    def add_routes(self, application):
-        application.add_route("/ping", self._ping_resource)
-        application.add_route("/invocations", self._python_service_resource)
+    def _start_warmup(self):
+        # multi-model endpoints start without a model to warm up
+        if SAGEMAKER_MULTI_MODEL_ENABLED or not os.path.isdir(WARMUP_PATH):
+            return None
+        samples = warmup.load_samples(WARMUP_PATH)
+        log.info("warming up with {} samples from {}".format(len(samples), WARMUP_PATH))
+        warmup_run = warmup.Warmup(
+            self._python_service_resource._invoke,
+            samples,
+            status_dir=WARMUP_STATUS_DIR,
+            rounds=PYTHON_SERVICE_WARMUP_ROUNDS,
+        )
+        warmup_run.start()
+        return warmup_run
+
+    def routes(self):
+        routes = [
+            ("/ping", self._ping_resource),
+            ("/invocations", self._python_service_resource),
+        ]
+        if metrics.METRICS_ENABLED:
+            routes.append(("/metrics", self._metrics_resource))
 
         if self._enable_model_manager:
-            application.add_route("/models", self._python_service_resource)
-            application.add_route("/models/{model_name}", self._python_service_resource)
-            application.add_route("/models/{model_name}/invoke", self._python_service_resource)
+            routes += [
+                ("/models", self._python_service_resource),
+                ("/models/{model_name}", self._python_service_resource),
+                ("/models/{model_name}/invoke", self._python_service_resource),
+            ]
+        return routes
+
+    def add_routes(self, application):
+        for uri_template, resource in self.routes():
+            application.add_route(uri_template, resource)
 
 
 app = falcon.API()
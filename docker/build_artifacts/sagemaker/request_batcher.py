@@ -0,0 +1,173 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import json
+import logging
+import threading
+import time
+
+import metrics
+from tfs_utils import TfsResponse
+
+log = logging.getLogger(__name__)
+
+STATS_LOG_INTERVAL_SECONDS = 60
+
+
+class _Batch:
+    def __init__(self):
+        self.instances = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.status_code = None
+        self.content = None
+        self.predictions = None
+        self.error = None
+        self.sent_at = None
+
+
+class BatchStats:
+    """Batch size and queue wait counters of a RequestBatcher."""
+
+    def __init__(self):
+        self.batches = 0
+        self.requests = 0
+        self.instances = 0
+        self.queue_wait_seconds = 0.0
+        self.max_queue_wait_seconds = 0.0
+
+    def record_batch(self, batch_size):
+        self.batches += 1
+        self.instances += batch_size
+
+    def record_request(self, queue_wait_seconds):
+        self.requests += 1
+        self.queue_wait_seconds += queue_wait_seconds
+        self.max_queue_wait_seconds = max(self.max_queue_wait_seconds, queue_wait_seconds)
+
+    def summary(self):
+        batches = max(self.batches, 1)
+        requests = max(self.requests, 1)
+        return (
+            "batches: {}, requests: {}, avg batch size: {:.1f} instances, "
+            "avg requests per batch: {:.1f}, avg queue wait: {:.2f} ms, "
+            "max queue wait: {:.2f} ms".format(
+                self.batches,
+                self.requests,
+                self.instances / batches,
+                self.requests / batches,
+                1000 * self.queue_wait_seconds / requests,
+                1000 * self.max_queue_wait_seconds,
+            )
+        )
+
+
+class RequestBatcher:
+    """Merges the 'instances' of concurrent TFS predict requests with the same key into one
+    request, and gives each caller the predictions for its own instances, in order.
+
+    The first caller of a batch waits for up to ``timeout_seconds``, or until the batch
+    holds ``max_batch_size`` instances, then sends the merged request. The other callers
+    wait for its response. This relies on callers running concurrently, on gevent
+    greenlets or on threads.
+    """
+
+    def __init__(self, max_batch_size, timeout_seconds):
+        self._max_batch_size = max_batch_size
+        self._timeout_seconds = timeout_seconds
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.stats = BatchStats()
+        self._stats_logged_at = time.time()
+
+    def _join(self, key, instances):
+        """Add the instances to the open batch for the key, and return the batch, the
+        position of the instances in it, and whether the caller is the batch leader.
+        """
+        with self._lock:
+            batch = self._pending.get(key)
+            if batch and len(batch.instances) + len(instances) > self._max_batch_size:
+                del self._pending[key]
+                batch.full.set()
+                batch = None
+
+            leader = batch is None
+            if leader:
+                batch = _Batch()
+                self._pending[key] = batch
+
+            start = len(batch.instances)
+            batch.instances.extend(instances)
+            if len(batch.instances) >= self._max_batch_size:
+                del self._pending[key]
+                batch.full.set()
+        return batch, start, leader
+
+    def submit(self, key, instances, signature_name, send_fn):
+        """Predict the instances as part of a batch.
+
+        ``key`` is a tuple that starts with the model name, which labels the batching
+        metrics. ``send_fn`` is called by the batch leader with the merged request body and
+        returns the TFS response. Returns a TfsResponse with the predictions for
+        ``instances``, or raises the exception raised by ``send_fn``.
+        """
+        enqueued_at = time.time()
+        batch, start, leader = self._join(key, instances)
+
+        if leader:
+            batch.full.wait(self._timeout_seconds)
+            with self._lock:
+                if self._pending.get(key) is batch:
+                    del self._pending[key]
+            self._send(batch, signature_name, send_fn)
+        else:
+            batch.done.wait()
+
+        self._record(key, enqueued_at, batch, leader)
+        return self._split(batch, start, start + len(instances))
+
+    def _send(self, batch, signature_name, send_fn):
+        body = {"instances": batch.instances}
+        if signature_name:
+            body["signature_name"] = signature_name
+        batch.sent_at = time.time()
+        try:
+            response = send_fn(json.dumps(body))
+            batch.status_code = response.status_code
+            batch.content = response.content
+            if response.status_code == 200:
+                batch.predictions = json.loads(response.content)["predictions"]
+        except Exception as e:  # pylint: disable=broad-except
+            batch.error = e
+        finally:
+            batch.done.set()
+
+    def _split(self, batch, start, end):
+        if batch.error is not None:
+            raise batch.error
+        if batch.predictions is None:
+            return TfsResponse(batch.status_code, batch.content)
+        content = json.dumps({"predictions": batch.predictions[start:end]}).encode("utf-8")
+        return TfsResponse(200, content)
+
+    def _record(self, key, enqueued_at, batch, leader):
+        queue_wait_seconds = batch.sent_at - enqueued_at
+        metrics.record_batched_request(key[0], queue_wait_seconds)
+        if leader:
+            metrics.record_batch(key[0], len(batch.instances))
+        with self._lock:
+            self.stats.record_request(queue_wait_seconds)
+            if leader:
+                self.stats.record_batch(len(batch.instances))
+            if time.time() - self._stats_logged_at >= STATS_LOG_INTERVAL_SECONDS:
+                self._stats_logged_at = time.time()
+                log.info("request batching stats: {}".format(self.stats.summary()))
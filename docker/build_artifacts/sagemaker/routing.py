@@ -0,0 +1,200 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+import itertools
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# how often the supervisor's list of restarting TFS instances is re-read
+HEALTH_REFRESH_SECONDS = 1.0
+
+
+class TfsInstance:
+    """A TFS process serving on a matched pair of REST and gRPC ports."""
+
+    def __init__(self, instance_id, rest_port, grpc_port):
+        self.instance_id = instance_id
+        self.rest_port = rest_port
+        self.grpc_port = grpc_port
+        self.in_flight = 0
+        self.restarting = False
+        self.consecutive_failures = 0
+        self.circuit_open_until = 0.0
+
+    def routable(self, now):
+        return not self.restarting and now >= self.circuit_open_until
+
+    def __repr__(self):
+        return "TfsInstance({}, rest_port={}, grpc_port={})".format(
+            self.instance_id, self.rest_port, self.grpc_port
+        )
+
+
+class RetryBudget:
+    """Limits retries to a fraction of recent requests, so that retries cannot multiply
+    the load on the remaining instances when TFS is failing everywhere.
+    """
+
+    def __init__(self, ratio, max_balance=10.0):
+        self._ratio = ratio
+        self._max_balance = max_balance
+        self._balance = max_balance
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._balance = min(self._max_balance, self._balance + self._ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+
+class Router:
+    """Picks the TFS instance for each request and tracks the number of requests each
+    instance has in flight. Subclasses implement _choose().
+
+    Instances that the supervisor is restarting (the rest ports returned by
+    ``unavailable_ports_fn``), and instances whose circuit breaker is open after
+    ``failure_threshold`` consecutive failures, are skipped for as long as any other
+    instance can take the request. An open circuit lets requests through again after
+    ``cooldown_seconds``.
+    """
+
+    def __init__(
+        self,
+        rest_ports,
+        grpc_ports,
+        failure_threshold=5,
+        cooldown_seconds=10,
+        unavailable_ports_fn=None,
+    ):
+        if len(rest_ports) != len(grpc_ports):
+            raise ValueError("number of rest ports and grpc ports must match")
+        self.instances = [
+            TfsInstance(i, rest_port, grpc_port)
+            for i, (rest_port, grpc_port) in enumerate(zip(rest_ports, grpc_ports))
+        ]
+        self._failure_threshold = failure_threshold
+        self._cooldown_seconds = cooldown_seconds
+        self._unavailable_ports_fn = unavailable_ports_fn
+        self._health_refreshed_at = 0.0
+        self._lock = threading.Lock()
+
+    def _choose(self, instances):
+        raise NotImplementedError()
+
+    def _refresh_health(self, now):
+        if not self._unavailable_ports_fn:
+            return
+        if now - self._health_refreshed_at < HEALTH_REFRESH_SECONDS:
+            return
+        self._health_refreshed_at = now
+        unavailable = self._unavailable_ports_fn()
+        for instance in self.instances:
+            instance.restarting = instance.rest_port in unavailable
+
+    def _candidates(self, excluded):
+        now = time.time()
+        self._refresh_health(now)
+        remaining = [i for i in self.instances if i not in excluded] or self.instances
+        return [i for i in remaining if i.routable(now)] or remaining
+
+    @contextmanager
+    def route(self, excluded=()):
+        """Yield the instance that should serve the request, counted as in flight
+        until the block exits. Instances in ``excluded`` are only used if there is
+        no other choice.
+        """
+        with self._lock:
+            instance = self._choose(self._candidates(excluded))
+            instance.in_flight += 1
+        try:
+            yield instance
+        finally:
+            with self._lock:
+                instance.in_flight -= 1
+
+    def record_success(self, instance):
+        if instance.consecutive_failures >= self._failure_threshold:
+            log.info("closing circuit breaker of %s", instance)
+        instance.consecutive_failures = 0
+        instance.circuit_open_until = 0.0
+
+    def record_failure(self, instance):
+        instance.consecutive_failures += 1
+        if instance.consecutive_failures >= self._failure_threshold:
+            if instance.consecutive_failures == self._failure_threshold:
+                log.warning(
+                    "opening circuit breaker of %s after %d consecutive failures",
+                    instance,
+                    instance.consecutive_failures,
+                )
+            instance.circuit_open_until = time.time() + self._cooldown_seconds
+
+
+class RandomRouter(Router):
+    def _choose(self, instances):
+        return random.choice(instances)
+
+
+class RoundRobinRouter(Router):
+    def __init__(self, rest_ports, grpc_ports, **kwargs):
+        super(RoundRobinRouter, self).__init__(rest_ports, grpc_ports, **kwargs)
+        # start at a random offset so that gunicorn workers don't move in lockstep
+        self._counter = itertools.count(random.randrange(len(self.instances)))
+
+    def _choose(self, instances):
+        return instances[next(self._counter) % len(instances)]
+
+
+class LeastOutstandingRouter(Router):
+    def _choose(self, instances):
+        fewest = min(instance.in_flight for instance in instances)
+        # break ties randomly, otherwise every idle worker would pick the first instance
+        return random.choice([i for i in instances if i.in_flight == fewest])
+
+
+class PowerOfTwoChoicesRouter(Router):
+    def _choose(self, instances):
+        if len(instances) == 1:
+            return instances[0]
+        first, second = random.sample(instances, 2)
+        return first if first.in_flight <= second.in_flight else second
+
+
+ROUTING_POLICIES = {
+    "random": RandomRouter,
+    "round_robin": RoundRobinRouter,
+    "least_outstanding": LeastOutstandingRouter,
+    "power_of_two_choices": PowerOfTwoChoicesRouter,
+}
+
+
+def create_router(policy, rest_ports, grpc_ports, **kwargs):
+    if policy not in ROUTING_POLICIES:
+        raise ValueError(
+            "SAGEMAKER_TFS_ROUTING_POLICY must be one of: {}".format(
+                ", ".join(sorted(ROUTING_POLICIES))
+            )
+        )
+    log.info("routing requests across tfs instances with policy: %s", policy)
+    return ROUTING_POLICIES[policy](rest_ports, grpc_ports, **kwargs)
@@ -12,28 +12,45 @@
 # language governing permissions and limitations under the License.
 
 import boto3
+import json
 import logging
 import os
 import re
+import shutil
 import signal
 import subprocess
+import sys
+import threading
+import time
+import logging_utils
+import model_registry
 import tfs_utils
+import worker_sizing
 
 from contextlib import contextmanager
 
-logging.basicConfig(level=logging.INFO)
+logging_utils.configure_logging()
 log = logging.getLogger(__name__)
 
 JS_PING = "js_content tensorflowServing.ping"
 JS_INVOCATIONS = "js_content tensorflowServing.invocations"
 GUNICORN_PING = "proxy_pass http://gunicorn_upstream/ping"
 GUNICORN_INVOCATIONS = "proxy_pass http://gunicorn_upstream/invocations"
+GUNICORN_METRICS = "proxy_pass http://gunicorn_upstream/metrics"
+NO_METRICS = "return 404 '{\"error\": \"Not Found\"}'"
+# gunicorn workers share metrics through memory-mapped files in this directory
+METRICS_DIR = "/tmp/prometheus-metrics"
 MULTI_MODEL = "s" if os.environ.get("SAGEMAKER_MULTI_MODEL", "False").lower() == "true" else ""
 MODEL_DIR = f"model{MULTI_MODEL}"
 CODE_DIR = "/opt/ml/{}/code".format(MODEL_DIR)
 PYTHON_LIB_PATH = os.path.join(CODE_DIR, "lib")
 REQUIREMENTS_PATH = os.path.join(CODE_DIR, "requirements.txt")
 INFERENCE_PATH = os.path.join(CODE_DIR, "inference.py")
+WARMUP_PATH = os.path.join(CODE_DIR, "warmup")
+# gunicorn workers create a file named after their pid here when they finish warming up
+WARMUP_STATUS_DIR = "/tmp/sagemaker-warmup"
+# how long the startup probe of the handler cpu usage may run when sizing gunicorn
+GUNICORN_PROBE_TIMEOUT_SECONDS = 120
 
 
 class ServiceManager(object):
@@ -52,6 +69,9 @@ class ServiceManager(object):
         self._gunicorn_workers = os.environ.get("SAGEMAKER_GUNICORN_WORKERS", 1)
         self._gunicorn_threads = os.environ.get("SAGEMAKER_GUNICORN_THREADS", 1)
         self._gunicorn_loglevel = os.environ.get("SAGEMAKER_GUNICORN_LOGLEVEL", "info")
+        self._gunicorn_auto_probe = (
+            os.environ.get("SAGEMAKER_GUNICORN_AUTO_PROBE", "false").lower() == "true"
+        )
         self._tfs_config_path = "/sagemaker/model-config.cfg"
         self._tfs_batching_config_path = "/sagemaker/batching-config.cfg"
 
@@ -61,14 +81,36 @@ class ServiceManager(object):
         self._tfs_gpu_margin = float(os.environ.get("SAGEMAKER_TFS_FRACTIONAL_GPU_MEM_MARGIN", 0.2))
         self._tfs_instance_count = int(os.environ.get("SAGEMAKER_TFS_INSTANCE_COUNT", 1))
         self._tfs_wait_time_seconds = int(os.environ.get("SAGEMAKER_TFS_WAIT_TIME_SECONDS", 300))
+        self._tfs_circuit_breaker_failures = int(
+            os.environ.get("SAGEMAKER_TFS_CIRCUIT_BREAKER_FAILURES", 5)
+        )
+        self._tfs_circuit_breaker_seconds = int(
+            os.environ.get("SAGEMAKER_TFS_CIRCUIT_BREAKER_SECONDS", 10)
+        )
         self._tfs_inter_op_parallelism = os.environ.get("SAGEMAKER_TFS_INTER_OP_PARALLELISM", 0)
         self._tfs_intra_op_parallelism = os.environ.get("SAGEMAKER_TFS_INTRA_OP_PARALLELISM", 0)
         self._gunicorn_worker_class = os.environ.get("SAGEMAKER_GUNICORN_WORKER_CLASS", "gevent")
+        self._python_service_mode = os.environ.get("SAGEMAKER_PYTHON_SERVICE_MODE", "wsgi").lower()
+        self._enable_metrics = (
+            os.environ.get("SAGEMAKER_PYTHON_SERVICE_ENABLE_METRICS", "false").lower() == "true"
+        )
         self._gunicorn_timeout_seconds = int(
             os.environ.get("SAGEMAKER_GUNICORN_TIMEOUT_SECONDS", 30)
         )
+        self._warmup_timeout_seconds = int(os.environ.get("SAGEMAKER_WARMUP_TIMEOUT_SECONDS", 300))
+        self._gunicorn_limit_request_line = os.environ.get("SAGEMAKER_GUNICORN_LIMIT_REQUEST_LINE")
+        self._gunicorn_limit_request_field_size = os.environ.get(
+            "SAGEMAKER_GUNICORN_LIMIT_REQUEST_FIELD_SIZE"
+        )
         self._nginx_proxy_read_timeout_seconds = int(
             os.environ.get("SAGEMAKER_NGINX_PROXY_READ_TIMEOUT_SECONDS", 60))
+        self._nginx_max_concurrent_invocations = int(
+            os.environ.get("SAGEMAKER_NGINX_MAX_CONCURRENT_INVOCATIONS", 0)
+        )
+        self._nginx_max_invocations_per_second = int(
+            os.environ.get("SAGEMAKER_NGINX_MAX_INVOCATIONS_PER_SECOND", 0)
+        )
+        self._nginx_invocation_burst = int(os.environ.get("SAGEMAKER_NGINX_INVOCATION_BURST", 0))
 
         # Nginx proxy read timeout should not be less than the GUnicorn timeout. If it is, this
         # can result in upstream time out errors.
@@ -94,6 +136,8 @@ class ServiceManager(object):
 
         if _enable_batching not in ["true", "false"]:
             raise ValueError("SAGEMAKER_TFS_ENABLE_BATCHING must be 'true' or 'false'")
+        if self._python_service_mode not in ["wsgi", "asgi"]:
+            raise ValueError("SAGEMAKER_PYTHON_SERVICE_MODE must be 'wsgi' or 'asgi'")
         self._tfs_enable_batching = _enable_batching == "true"
 
         if _enable_multi_model_endpoint not in ["true", "false"]:
@@ -136,6 +180,12 @@ class ServiceManager(object):
     def _need_python_service(self):
         if os.path.exists(INFERENCE_PATH):
             self._enable_python_service = True
+        if os.environ.get("SAGEMAKER_PYTHON_SERVICE_ENABLE_PROTOBUF", "false").lower() == "true":
+            # serialized PredictRequests are forwarded to TFS over grpc by the python service
+            self._enable_python_service = True
+        if os.path.isdir(WARMUP_PATH) and not self._tfs_enable_multi_model_endpoint:
+            # warmup samples are replayed through the python service handlers
+            self._enable_python_service = True
         if os.environ.get("SAGEMAKER_MULTI_MODEL_UNIVERSAL_BUCKET") and os.environ.get(
             "SAGEMAKER_MULTI_MODEL_UNIVERSAL_PREFIX"
         ):
@@ -217,19 +267,30 @@ class ServiceManager(object):
                         self._stop()
                         raise ChildProcessError("failed to install required packages.")
 
+        self._size_gunicorn(python_path_content)
+
+        if self._python_service_mode == "asgi":
+            # asyncio event loop per worker, see asgi_service.py
+            worker_class = "uvicorn.workers.UvicornWorker"
+            application = "asgi_service:app"
+        else:
+            worker_class = self._gunicorn_worker_class
+            application = "python_service:app"
+
         gunicorn_command = (
             "gunicorn -b unix:/tmp/gunicorn.sock -k {} --chdir /sagemaker "
-            "--workers {} --threads {} --log-level {} --timeout {} "
+            "--workers {} --threads {} --log-level {} --timeout {} {}"
             "{}{} -e TFS_GRPC_PORTS={} -e TFS_REST_PORTS={} "
             "-e SAGEMAKER_MULTI_MODEL={} -e SAGEMAKER_SAFE_PORT_RANGE={} "
             "-e SAGEMAKER_TFS_WAIT_TIME_SECONDS={} "
-            "python_service:app"
+            "{}"
         ).format(
-            self._gunicorn_worker_class,
+            worker_class,
             self._gunicorn_workers,
             self._gunicorn_threads,
             self._gunicorn_loglevel,
             self._gunicorn_timeout_seconds,
+            self._gunicorn_limit_options(),
             python_path_option,
             ",".join(python_path_content),
             self._tfs_grpc_concat_ports,
@@ -237,10 +298,109 @@ class ServiceManager(object):
             self._tfs_enable_multi_model_endpoint,
             self._sagemaker_port_range,
             self._tfs_wait_time_seconds,
+            application,
         )
 
         log.info("gunicorn command: {}".format(gunicorn_command))
         self._gunicorn_command = gunicorn_command
+        self._setup_gunicorn_dirs()
+
+    def _size_gunicorn(self, python_path):
+        if str(self._gunicorn_workers).lower() != "auto":
+            return
+
+        cpus, source = worker_sizing.cpu_limit()
+        log.info("{:g} cpus available to the container ({})".format(cpus, source))
+        fixed_worker_class = None
+        if self._python_service_mode == "asgi":
+            fixed_worker_class = "uvicorn.workers.UvicornWorker"
+        elif "SAGEMAKER_GUNICORN_WORKER_CLASS" in os.environ:
+            fixed_worker_class = self._gunicorn_worker_class
+
+        decision = worker_sizing.choose(
+            cpus,
+            self._tfs_instance_count,
+            self._probe_handler_cpu_ratio(python_path),
+            fixed_worker_class,
+        )
+        for reason in decision.reasons:
+            log.info("gunicorn auto sizing: {}".format(reason))
+
+        self._gunicorn_workers = decision.workers
+        self._gunicorn_worker_class = decision.worker_class
+        if "SAGEMAKER_GUNICORN_THREADS" not in os.environ:
+            self._gunicorn_threads = decision.threads
+        log.info(
+            "gunicorn auto sizing chose workers: {}, threads: {}, worker class: {}".format(
+                self._gunicorn_workers, self._gunicorn_threads, self._gunicorn_worker_class
+            )
+        )
+
+    def _probe_handler_cpu_ratio(self, python_path):
+        """Measure the cpu share of the handlers of inference.py on the warmup samples, in
+        a separate process so that serve.py does not import the user's code.
+        """
+        if not self._gunicorn_auto_probe:
+            return None
+        if (
+            self._tfs_enable_multi_model_endpoint
+            or not os.path.exists(INFERENCE_PATH)
+            or not os.path.isdir(WARMUP_PATH)
+        ):
+            log.warning("the gunicorn probe needs inference.py and warmup samples, skipping it")
+            return None
+
+        command = [
+            sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker_sizing.py"),
+            "--inference-path",
+            INFERENCE_PATH,
+            "--warmup-path",
+            WARMUP_PATH,
+            "--rest-port",
+            self._tfs_rest_ports[0],
+            "--grpc-port",
+            self._tfs_grpc_ports[0],
+            "--model-name",
+            self._tfs_default_model_name,
+        ]
+        env = os.environ.copy()
+        env["PYTHONPATH"] = ":".join(python_path + [env.get("PYTHONPATH", "")])
+        try:
+            output = subprocess.check_output(
+                command, env=env, timeout=GUNICORN_PROBE_TIMEOUT_SECONDS
+            )
+            return json.loads(output.decode("utf-8").strip().splitlines()[-1])["cpu_ratio"]
+        except (subprocess.SubprocessError, ValueError, KeyError, IndexError) as e:
+            log.warning("gunicorn probe failed, sizing without it: {}".format(e))
+            return None
+
+    def _setup_gunicorn_dirs(self):
+        if self._enable_metrics:
+            # start from empty metrics, but keep them when gunicorn is restarted
+            shutil.rmtree(METRICS_DIR, ignore_errors=True)
+            os.makedirs(METRICS_DIR)
+
+        if self._warmup_enabled():
+            shutil.rmtree(WARMUP_STATUS_DIR, ignore_errors=True)
+            os.makedirs(WARMUP_STATUS_DIR)
+
+    def _warmup_enabled(self):
+        return (
+            self._enable_python_service
+            and not self._tfs_enable_multi_model_endpoint
+            and os.path.isdir(WARMUP_PATH)
+        )
+
+    def _gunicorn_limit_options(self):
+        options = ""
+        if self._gunicorn_limit_request_line is not None:
+            options += "--limit-request-line {} ".format(self._gunicorn_limit_request_line)
+        if self._gunicorn_limit_request_field_size is not None:
+            options += "--limit-request-field_size {} ".format(
+                self._gunicorn_limit_request_field_size
+            )
+        return options
 
     def _download_scripts(self, bucket, prefix):
         log.info("checking boto session region ...")
@@ -265,7 +425,14 @@ class ServiceManager(object):
         indentation = "    "
         tfs_upstream = ""
         for port in self._tfs_rest_ports:
-            tfs_upstream += "{}server localhost:{};\n".format(indentation, port)
+            # passive health checks: stop sending requests to an instance that refuses
+            # connections, e.g. while it is being restarted
+            tfs_upstream += "{}server localhost:{} max_fails={} fail_timeout={}s;\n".format(
+                indentation,
+                port,
+                self._tfs_circuit_breaker_failures,
+                self._tfs_circuit_breaker_seconds,
+            )
         tfs_upstream = tfs_upstream[len(indentation) : -2]
 
         return tfs_upstream
@@ -284,7 +451,12 @@ class ServiceManager(object):
             "FORWARD_INVOCATION_REQUESTS": GUNICORN_INVOCATIONS
             if self._use_gunicorn
             else JS_INVOCATIONS,
+            "FORWARD_METRICS_REQUESTS": GUNICORN_METRICS
+            if self._use_gunicorn and self._enable_metrics
+            else NO_METRICS,
             "PROXY_READ_TIMEOUT": str(self._nginx_proxy_read_timeout_seconds),
+            "INVOCATION_LIMIT_ZONES": self._create_nginx_invocation_limit_zones(),
+            "INVOCATION_LIMITS": self._create_nginx_invocation_limits(),
         }
 
         config = pattern.sub(lambda x: template_values[x.group(1)], template)
@@ -293,6 +465,32 @@ class ServiceManager(object):
         with open("/sagemaker/nginx.conf", "w", encoding="utf8") as f:
             f.write(config)
 
+    def _create_nginx_invocation_limit_zones(self):
+        # invocations over the limits are rejected with 429, so that clients back off
+        # instead of waiting until they time out
+        zones = ""
+        if self._nginx_max_concurrent_invocations > 0:
+            zones += "  limit_conn_zone $server_port zone=invocations_conn:1m;\n"
+            zones += "  limit_conn_status 429;\n"
+        if self._nginx_max_invocations_per_second > 0:
+            zones += "  limit_req_zone $server_port zone=invocations_req:1m rate={}r/s;\n".format(
+                self._nginx_max_invocations_per_second
+            )
+            zones += "  limit_req_status 429;\n"
+        return zones.rstrip("\n")
+
+    def _create_nginx_invocation_limits(self):
+        limits = ""
+        if self._nginx_max_concurrent_invocations > 0:
+            limits += "        limit_conn invocations_conn {};\n".format(
+                self._nginx_max_concurrent_invocations
+            )
+        if self._nginx_max_invocations_per_second > 0:
+            limits += "        limit_req zone=invocations_req burst={} nodelay;\n".format(
+                self._nginx_invocation_burst
+            )
+        return limits.rstrip("\n")
+
     def _read_nginx_template(self):
         with open("/sagemaker/nginx.conf.template", "r", encoding="utf8") as f:
             template = f.read()
@@ -330,6 +528,12 @@ class ServiceManager(object):
         self._log_version("gunicorn --version", "gunicorn version info:")
         env = os.environ.copy()
         env["TFS_DEFAULT_MODEL_NAME"] = self._tfs_default_model_name
+        # the number of workers after sizing, which the workers size their handler pools by
+        env["SAGEMAKER_GUNICORN_WORKERS"] = str(self._gunicorn_workers)
+        if self._enable_metrics:
+            env["prometheus_multiproc_dir"] = METRICS_DIR
+        if self._warmup_enabled():
+            env["SAGEMAKER_WARMUP_STATUS_DIR"] = WARMUP_STATUS_DIR
         p = subprocess.Popen(self._gunicorn_command.split(), env=env)
         log.info("started gunicorn (pid: %d)", p.pid)
         self._gunicorn = p
@@ -378,6 +582,22 @@ class ServiceManager(object):
                 log.info("gunicorn server is ready!")
                 return
 
+    def _wait_for_warmup(self):
+        workers = int(self._gunicorn_workers)
+        deadline = time.time() + self._warmup_timeout_seconds
+        while True:
+            warmed_up = len(os.listdir(WARMUP_STATUS_DIR))
+            if warmed_up >= workers:
+                log.info("all {} gunicorn workers finished warming up".format(workers))
+                return
+            if time.time() > deadline:
+                log.warning(
+                    "{} of {} gunicorn workers finished warming up in {} seconds, "
+                    "starting nginx anyway".format(warmed_up, workers, self._warmup_timeout_seconds)
+                )
+                return
+            time.sleep(0.5)
+
     def _wait_for_tfs(self):
         for i in range(self._tfs_instance_count):
             tfs_utils.wait_for_model(
@@ -412,8 +632,32 @@ class ServiceManager(object):
         instance_id = self._find_tfs_process(pid)
         if instance_id is None:
             raise ValueError("Cannot find tfs with pid: {};".format(pid))
+        # let the python service route around this instance until its models are loaded
+        tfs_utils.mark_tfs_unavailable(self._tfs_rest_ports[instance_id])
         p = self._start_single_tfs(instance_id)
         self._tfs[instance_id] = p
+        threading.Thread(
+            target=self._mark_tfs_available_when_ready, args=(instance_id, p), daemon=True
+        ).start()
+
+    def _mark_tfs_available_when_ready(self, instance_id, process):
+        rest_port = self._tfs_rest_ports[instance_id]
+        deadline = time.time() + self._tfs_wait_time_seconds
+        while time.time() < deadline and self._tfs[instance_id] is process:
+            if tfs_utils.is_model_available(rest_port, self._tfs_default_model_name):
+                log.info("restarted tensorflow serving on port {} is ready".format(rest_port))
+                break
+            time.sleep(1)
+        else:
+            if self._tfs[instance_id] is not process:
+                # restarted again, the newer restart owns the unavailable marker
+                return
+            log.warning(
+                "restarted tensorflow serving on port {} is not ready after {} seconds".format(
+                    rest_port, self._tfs_wait_time_seconds
+                )
+            )
+        tfs_utils.mark_tfs_available(rest_port)
 
     def _start_single_tfs(self, instance_id):
         cmd = tfs_utils.tfs_command(
@@ -479,6 +723,8 @@ class ServiceManager(object):
 
         if self._tfs_enable_multi_model_endpoint:
             log.info("multi-model endpoint is enabled, TFS model servers will be started later")
+            # the gunicorn workers share the registry, and keep it when they restart
+            model_registry.reset()
         else:
             self._create_tfs_config()
             self._start_tfs()
@@ -492,6 +738,9 @@ class ServiceManager(object):
             # make sure gunicorn is up
             with self._timeout(seconds=self._gunicorn_timeout_seconds):
                 self._wait_for_gunicorn()
+            if self._warmup_enabled():
+                # /ping is unreachable until nginx starts
+                self._wait_for_warmup()
 
         self._start_nginx()
         self._state = "started"
@@ -1,5 +1,8 @@
 var tfs_base_uri = '/tfs/v1/models/'
 var custom_attributes_header = 'X-Amzn-SageMaker-Custom-Attributes'
+// compiled once when the script is loaded, instead of on every request
+var custom_attribute_pattern = /tfs-[a-z\-]+=[^,]+/g
+var mme_invoke_uri_pattern = /\/models\/[^,]+\/invoke/g
 
 function invocations(r) {
     var ct = r.headersIn['Content-Type']
@@ -108,10 +111,9 @@ function make_tfs_uri(r, with_method) {
 
 function parse_custom_attributes(r) {
     var attributes = {}
-    var kv_pattern = /tfs-[a-z\-]+=[^,]+/g
     var header = r.headersIn[custom_attributes_header]
     if (header) {
-        var matches = header.match(kv_pattern)
+        var matches = header.match(custom_attribute_pattern)
         if (matches) {
             for (var i = 0; i < matches.length; i++) {
                 var kv = matches[i].split('=')
@@ -124,8 +126,7 @@ function parse_custom_attributes(r) {
 
     // for MME invocations, tfs-model-name is in the uri, or use default_tfs_model
     if (!attributes['tfs-model-name']) {
-        var uri_pattern = /\/models\/[^,]+\/invoke/g
-        var model_name = r.uri.match(uri_pattern)
+        var model_name = r.uri.match(mme_invoke_uri_pattern)
         if (model_name[0]) {
             model_name = r.uri.replace('/models/', '').replace('/invoke', '')
             attributes['tfs-model-name'] = model_name
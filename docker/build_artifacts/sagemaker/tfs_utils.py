@@ -11,60 +11,231 @@
 # ANY KIND, either express or implied. See the License for the specific
 # language governing permissions and limitations under the License.
 
+import functools
 import logging
 import multiprocessing
 import os
 import re
 import requests
+import shutil
+import tempfile
 import time
 import json
 
-from multi_model_utils import timeout
+import logging_utils
+import numpy_codec
+from multi_model_utils import MultiModelException
 from urllib3.util.retry import Retry
 from urllib3.exceptions import NewConnectionError, MaxRetryError
 from collections import namedtuple
 
-logging.basicConfig(level=logging.INFO)
+logging_utils.configure_logging()
 log = logging.getLogger(__name__)
+request_log = logging_utils.RequestLogger(log)
 
 DEFAULT_CONTENT_TYPE = "application/json"
 DEFAULT_ACCEPT_HEADER = "application/json"
 CUSTOM_ATTRIBUTES_HEADER = "X-Amzn-SageMaker-Custom-Attributes"
+# set by nginx to "t=<seconds since the epoch>" when it receives the request
+REQUEST_START_HEADER = "X-Request-Start"
+# requests without a tfs-timeout-ms custom attribute get this timeout, 0 means no timeout
+REQUEST_TIMEOUT_MS = int(os.environ.get("SAGEMAKER_PYTHON_SERVICE_REQUEST_TIMEOUT_MS", 0))
+# the supervisor creates a file named after the rest port of each TFS instance it is restarting
+TFS_UNAVAILABLE_DIR = "/sagemaker/tfs-unavailable"
+TFS_REST_POOL_SIZE = int(os.environ.get("SAGEMAKER_TFS_REST_POOL_SIZE", 100))
+STREAM_CHUNK_BYTES = 64 * 1024
+# distinct custom attributes headers, ports and model names whose parsed attributes and TFS
+# uris are kept. Endpoints typically see only a handful of them.
+CUSTOM_ATTRIBUTES_CACHE_SIZE = int(os.environ.get("SAGEMAKER_CUSTOM_ATTRIBUTES_CACHE_SIZE", 256))
 
 Context = namedtuple(
     "Context",
     "model_name, model_version, method, rest_uri, grpc_port, channel, "
-    "custom_attributes, request_content_type, accept_header, content_length",
+    "custom_attributes, request_content_type, accept_header, content_length, rest_session, "
+    "aio_session, codec, deadline",
 )
+# builds a Context from a tuple without binding every field as a keyword argument
+_new_context = functools.partial(tuple.__new__, Context)
 
 
-def parse_request(req, rest_port, grpc_port, default_model_name, model_name=None, channel=None):
-    tfs_attributes = parse_tfs_custom_attributes(req)
-    tfs_uri = make_tfs_uri(rest_port, tfs_attributes, default_model_name, model_name)
+def detach_context(context):
+    """Return a copy of the context without its connections to TFS and codec module, which
+    cannot be pickled, to pass it to another process.
+    """
+    return context._replace(channel=None, rest_session=None, aio_session=None, codec=None)
 
-    if not model_name:
-        model_name = tfs_attributes.get("tfs-model-name")
 
-    context = Context(
-        model_name,
-        tfs_attributes.get("tfs-model-version"),
-        tfs_attributes.get("tfs-method"),
-        tfs_uri,
-        grpc_port,
-        channel,
-        req.get_header(CUSTOM_ATTRIBUTES_HEADER),
-        req.get_header("Content-Type") or DEFAULT_CONTENT_TYPE,
-        req.get_header("Accept") or DEFAULT_ACCEPT_HEADER,
-        req.content_length,
+def attach_context(context):
+    """Undo detach_context in the receiving process, which has no connections to TFS."""
+    return context._replace(codec=numpy_codec)
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request reaches its deadline before TFS responded."""
+
+
+class TfsResponse:
+    """A minimal stand-in for requests.Response, for TFS responses that were not received
+    with requests (over gRPC or with an asyncio client), so that output handlers can
+    consume every response the same way.
+    """
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {"Content-Type": "application/json"}
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class BodyStream:
+    """A file-like request body of known length.
+
+    requests sends a BodyStream to TFS in chunks with a Content-Length header, so that the
+    body goes from the client connection to TFS without being read into memory or decoded.
+    """
+
+    def __init__(self, stream, content_length, chunk_size=STREAM_CHUNK_BYTES):
+        self._stream = stream
+        self._remaining = content_length
+        self._chunk_size = chunk_size
+
+    def read(self, size=-1):
+        return self._read(self._stream.read, size)
+
+    def readline(self, size=-1):
+        return self._read(self._stream.readline, size)
+
+    def _read(self, read_fn, size):
+        if self._remaining <= 0:
+            return b""
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        chunk = read_fn(size)
+        self._remaining -= len(chunk)
+        return chunk
+
+    def __len__(self):
+        return self._remaining
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self._chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def spool_body(stream, max_memory_bytes):
+    """Copy a request body into a file that can be read more than once. Bodies longer
+    than max_memory_bytes are written to a temporary file on disk.
+    """
+    body = tempfile.SpooledTemporaryFile(max_size=max_memory_bytes)
+    shutil.copyfileobj(stream, body, STREAM_CHUNK_BYTES)
+    body.seek(0)
+    return body
+
+
+def parse_request(
+    req,
+    rest_port,
+    grpc_port,
+    default_model_name,
+    model_name=None,
+    channel=None,
+    session=None,
+    aio_session=None,
+):
+    header = req.get_header(CUSTOM_ATTRIBUTES_HEADER)
+    request_log.info("sagemaker tfs attributes: %s", header)
+    target = _request_target(header, rest_port, grpc_port, default_model_name, model_name)
+
+    context = _new_context(
+        target
+        + (
+            channel,
+            header,
+            req.get_header("Content-Type") or DEFAULT_CONTENT_TYPE,
+            req.get_header("Accept") or DEFAULT_ACCEPT_HEADER,
+            req.content_length,
+            session,
+            aio_session,
+            numpy_codec,
+            request_deadline(req),
+        )
     )
 
     data = req.stream
     return data, context
 
 
-def make_tfs_uri(port, attributes, default_model_name, model_name=None):
-    log.info("sagemaker tfs attributes: \n{}".format(attributes))
+@functools.lru_cache(maxsize=CUSTOM_ATTRIBUTES_CACHE_SIZE)
+def _request_target(header, rest_port, grpc_port, default_model_name, model_name):
+    """The model name, model version, method, TFS uri and grpc port fields of the Context of
+    requests with the given custom attributes header, port and model name.
+    """
+    attributes = _parse_custom_attributes_header(header)
+    tfs_uri = make_tfs_uri(rest_port, attributes, default_model_name, model_name)
+    return (
+        model_name or attributes.get("tfs-model-name", default_model_name),
+        attributes.get("tfs-model-version"),
+        attributes.get("tfs-method"),
+        tfs_uri,
+        grpc_port,
+    )
+
+
+@functools.lru_cache(maxsize=CUSTOM_ATTRIBUTES_CACHE_SIZE)
+def _request_timeout_seconds(header):
+    timeout_ms = _parse_custom_attributes_header(header).get("tfs-timeout-ms")
+    if timeout_ms is None:
+        return REQUEST_TIMEOUT_MS / 1000.0
+    try:
+        return max(int(timeout_ms), 0) / 1000.0
+    except ValueError:
+        log.warning("ignoring invalid tfs-timeout-ms custom attribute: %s", timeout_ms)
+        return REQUEST_TIMEOUT_MS / 1000.0
+
+
+def request_deadline(req):
+    """The deadline of the request, in seconds since the epoch, or None if it has none."""
+    timeout_seconds = _request_timeout_seconds(req.get_header(CUSTOM_ATTRIBUTES_HEADER))
+    return _request_start(req) + timeout_seconds if timeout_seconds else None
 
+
+def _request_start(req):
+    """When nginx received the request, so that time spent queued for a gunicorn worker
+    counts against its deadline.
+    """
+    start = req.get_header(REQUEST_START_HEADER)
+    if start and start.startswith("t="):
+        try:
+            return float(start[2:])
+        except ValueError:
+            pass
+    return time.time()
+
+
+def time_remaining(context):
+    """Seconds left until the deadline of the request, for use as the timeout of TFS calls,
+    or None if it has no deadline.
+
+    :raises DeadlineExceeded: if the deadline has passed
+    """
+    if context.deadline is None:
+        return None
+    remaining = context.deadline - time.time()
+    if remaining <= 0:
+        raise DeadlineExceeded("request deadline exceeded")
+    return remaining
+
+
+def make_tfs_uri(port, attributes, default_model_name, model_name=None):
     tfs_model_name = model_name or attributes.get("tfs-model-name", default_model_name)
     tfs_model_version = attributes.get("tfs-model-version")
     tfs_method = attributes.get("tfs-method", "predict")
@@ -76,9 +247,33 @@ def make_tfs_uri(port, attributes, default_model_name, model_name=None):
     return uri
 
 
+def create_rest_session(pool_size=TFS_REST_POOL_SIZE):
+    """Create a keep-alive session for sending requests to a single TFS REST port.
+
+    Connections are reused across requests instead of paying a new TCP connect
+    (and leaving a socket in TIME_WAIT) for every invocation.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    return session
+
+
 def parse_tfs_custom_attributes(req):
+    return parse_custom_attributes_header(req.get_header(CUSTOM_ATTRIBUTES_HEADER))
+
+
+def parse_custom_attributes_header(header):
+    """The tfs- attributes of a custom attributes header, such as the custom_attributes of
+    a Context, in a dict the caller may modify.
+    """
+    return dict(_parse_custom_attributes_header(header))
+
+
+@functools.lru_cache(maxsize=CUSTOM_ATTRIBUTES_CACHE_SIZE)
+def _parse_custom_attributes_header(header):
+    # the result is shared between requests, callers must not modify it
     attributes = {}
-    header = req.get_header(CUSTOM_ATTRIBUTES_HEADER)
     if header:
         matches = re.findall(r"(tfs-[a-z\-]+=[^,]+)", header)
         attributes = dict(attribute.split("=") for attribute in matches)
@@ -86,20 +281,28 @@ def parse_tfs_custom_attributes(req):
 
 
 def create_tfs_config_individual_model(model_name, base_path):
+    return create_tfs_config_models({model_name: base_path})
+
+
+def create_tfs_config_models(base_paths):
+    """Return a TFS model config serving every model in ``base_paths``, a dict of model
+    name to base path.
+    """
     config = "model_config_list: {\n"
-    config += "  config: {\n"
-    config += "    name: '{}'\n".format(model_name)
-    config += "    base_path: '{}'\n".format(base_path)
-    config += "    model_platform: 'tensorflow'\n"
-
-    config += "    model_version_policy: {\n"
-    config += "      specific: {\n"
-    for version in find_model_versions(base_path):
-        config += "        versions: {}\n".format(version)
-    config += "      }\n"
-    config += "    }\n"
-
-    config += "  }\n"
+    for model_name, base_path in sorted(base_paths.items()):
+        config += "  config: {\n"
+        config += "    name: '{}'\n".format(model_name)
+        config += "    base_path: '{}'\n".format(base_path)
+        config += "    model_platform: 'tensorflow'\n"
+
+        config += "    model_version_policy: {\n"
+        config += "      specific: {\n"
+        for version in find_model_versions(base_path):
+            config += "        versions: {}\n".format(version)
+        config += "      }\n"
+        config += "    }\n"
+
+        config += "  }\n"
     config += "}\n"
     return config
 
@@ -254,29 +457,86 @@ def create_batching_config(batching_config_file):
         f.write(config)
 
 
+def mark_tfs_unavailable(rest_port):
+    os.makedirs(TFS_UNAVAILABLE_DIR, exist_ok=True)
+    open(os.path.join(TFS_UNAVAILABLE_DIR, str(rest_port)), "w").close()
+
+
+def mark_tfs_available(rest_port):
+    try:
+        os.remove(os.path.join(TFS_UNAVAILABLE_DIR, str(rest_port)))
+    except FileNotFoundError:
+        pass
+
+
+def unavailable_tfs_ports():
+    try:
+        return set(os.listdir(TFS_UNAVAILABLE_DIR))
+    except FileNotFoundError:
+        return set()
+
+
+def is_model_available(rest_port, model_name, timeout_seconds=5):
+    tfs_url = "http://localhost:{}/v1/models/{}".format(rest_port, model_name)
+    try:
+        response = requests.get(tfs_url, timeout=timeout_seconds)
+    except requests.exceptions.RequestException:
+        return False
+    if response.status_code != 200:
+        return False
+    versions = json.loads(response.content)["model_version_status"]
+    return all(version["state"] == "AVAILABLE" for version in versions)
+
+
+def serving_model_version(session, rest_uri, timeout_seconds=5):
+    """Return the version TFS serves for requests to rest_uri that name no version, which is
+    the highest available version of the model, or None if it cannot be determined.
+    """
+    status_uri = rest_uri.rsplit(":", 1)[0]
+    try:
+        response = session.get(status_uri, timeout=timeout_seconds)
+    except requests.exceptions.RequestException:
+        return None
+    if response.status_code != 200:
+        return None
+    versions = json.loads(response.content)["model_version_status"]
+    available = [int(v["version"]) for v in versions if v["state"] == "AVAILABLE"]
+    return str(max(available)) if available else None
+
+
 def wait_for_model(rest_port, model_name, timeout_seconds, wait_interval_seconds=5):
+    """Wait until every version of a model is available.
+
+    The wait is bounded by a deadline rather than by SIGALRM, so that models can be waited
+    for concurrently, and by threads other than the main thread.
+
+    :raises MultiModelException: with code 408 if the model is not available within
+        timeout_seconds
+    """
     tfs_url = "http://localhost:{}/v1/models/{}".format(rest_port, model_name)
 
-    with timeout(timeout_seconds):
-        while True:
-            try:
-                session = requests.Session()
-                retries = Retry(total=9, backoff_factor=0.1)
-                session.mount("http://", requests.adapters.HTTPAdapter(max_retries=retries))
-                log.info("Trying to connect with model server: {}".format(tfs_url))
-                response = session.get(tfs_url)
-                log.info(response)
-                if response.status_code == 200:
-                    versions = json.loads(response.content)["model_version_status"]
-                    if all(version["state"] == "AVAILABLE" for version in versions):
-                        break
-            except (
-                ConnectionRefusedError,
-                NewConnectionError,
-                MaxRetryError,
-                requests.exceptions.ConnectionError,
-            ):
-                log.warning("model: {} is not available yet ".format(tfs_url))
-                time.sleep(wait_interval_seconds)
+    deadline = time.time() + timeout_seconds
+    while True:
+        if time.time() >= deadline:
+            raise MultiModelException(408, "Timed out after {} seconds".format(timeout_seconds))
+        try:
+            session = requests.Session()
+            retries = Retry(total=9, backoff_factor=0.1)
+            session.mount("http://", requests.adapters.HTTPAdapter(max_retries=retries))
+            log.info("Trying to connect with model server: {}".format(tfs_url))
+            response = session.get(tfs_url)
+            log.info(response)
+            if response.status_code == 200:
+                versions = json.loads(response.content)["model_version_status"]
+                if all(version["state"] == "AVAILABLE" for version in versions):
+                    break
+        except (
+            ConnectionRefusedError,
+            NewConnectionError,
+            MaxRetryError,
+            requests.exceptions.ConnectionError,
+        ):
+            log.warning("model: {} is not available yet ".format(tfs_url))
+            time.sleep(min(wait_interval_seconds, max(deadline - time.time(), 0)))
 
     log.info("model: {} is available now".format(tfs_url))
@@ -0,0 +1,126 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Replays sample invocations from the warmup directory of the model in every gunicorn
+worker before the worker reports healthy on /ping.
+
+Each file in the directory is the body of one invocation, with the content type given by
+the file extension. When a worker is done it creates a file named after its pid in the
+status directory, which serve.py watches before it starts nginx.
+"""
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+import falcon
+from falcon import testing
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPES = {
+    ".json": "application/json",
+    ".jsonl": "application/jsonlines",
+    ".jsonlines": "application/jsonlines",
+    ".csv": "text/csv",
+    ".pb": "application/x-protobuf",
+}
+
+Sample = namedtuple("Sample", "name, body, content_type")
+
+
+def load_samples(warmup_dir):
+    """Read the samples in the warmup directory, in file name order."""
+    samples = []
+    for name in sorted(os.listdir(warmup_dir)):
+        path = os.path.join(warmup_dir, name)
+        content_type = CONTENT_TYPES.get(os.path.splitext(name)[1].lower())
+        if not os.path.isfile(path):
+            continue
+        if content_type is None:
+            log.warning("skipping warmup file with unknown extension: %s", name)
+            continue
+        with open(path, "rb") as f:
+            samples.append(Sample(name, f.read(), content_type))
+    return samples
+
+
+def _make_request(sample):
+    env = testing.create_environ(
+        path="/invocations",
+        method="POST",
+        body=sample.body,
+        headers={"Content-Type": sample.content_type, "Accept": "application/json"},
+    )
+    return falcon.Request(env)
+
+
+class Warmup:
+    """Sends the samples through ``invoke_fn(req, res)``, the invocation method of the
+    python service resource, ``rounds`` times on a background thread.
+    """
+
+    def __init__(self, invoke_fn, samples, status_dir=None, rounds=1):
+        self._invoke_fn = invoke_fn
+        self._samples = samples
+        self._status_dir = status_dir
+        self._rounds = rounds
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name="warmup")
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        start = time.time()
+        try:
+            for i in range(self._rounds):
+                for sample in self._samples:
+                    self._send(sample, i)
+        finally:
+            log.info(
+                "warmup finished: %d requests in %.1f ms",
+                len(self._samples) * self._rounds,
+                (time.time() - start) * 1000,
+            )
+            self._mark_done()
+
+    def _send(self, sample, round_number):
+        res = falcon.Response()
+        start = time.time()
+        try:
+            self._invoke_fn(_make_request(sample), res)
+        except Exception as e:  # pylint: disable=broad-except
+            log.warning("warmup request %s failed: %s", sample.name, e)
+            return
+        log.info(
+            "warmup request %s (round %d): %s in %.1f ms",
+            sample.name,
+            round_number + 1,
+            res.status,
+            (time.time() - start) * 1000,
+        )
+
+    def _mark_done(self):
+        self._done.set()
+        if self._status_dir:
+            try:
+                with open(os.path.join(self._status_dir, str(os.getpid())), "w"):
+                    pass
+            except OSError as e:
+                log.warning("failed to record warmup status: %s", e)
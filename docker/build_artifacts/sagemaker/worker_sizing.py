@@ -0,0 +1,184 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Sizing of gunicorn when SAGEMAKER_GUNICORN_WORKERS is 'auto'.
+
+The number of workers follows the CPUs available to the container and the number of TFS
+instances. The worker class and the number of threads follow the share of an invocation's
+wall time that the handlers spend on the CPU, which serve.py can measure at startup by
+running this module as a script (see probe_cpu_ratio).
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from collections import namedtuple
+
+CGROUP_V2_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+CGROUP_V1_CPU_QUOTA = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+CGROUP_V1_CPU_PERIOD = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+
+# handler CPU share assumed without a probe: handlers mostly wait for TFS
+DEFAULT_CPU_RATIO = 0.1
+# every worker gets at least this share of a CPU, so that request parsing is spread out
+MIN_WORKER_CPU_SHARE = 0.25
+# handlers busier than this are served by threads in more processes instead of greenlets
+CPU_BOUND_RATIO = 0.5
+MAX_THREADS = 8
+
+SizingDecision = namedtuple("SizingDecision", "workers, threads, worker_class, reasons")
+
+
+def _read(path):
+    with open(path, "r") as f:
+        return f.read().strip()
+
+
+def cpu_limit(
+    cpu_max_path=CGROUP_V2_CPU_MAX,
+    quota_path=CGROUP_V1_CPU_QUOTA,
+    period_path=CGROUP_V1_CPU_PERIOD,
+):
+    """Return the number of CPUs the container may use, and where the number came from."""
+    try:
+        quota, period = _read(cpu_max_path).split()
+        if quota != "max":
+            return int(quota) / int(period), "cgroup v2 cpu.max"
+    except (OSError, ValueError):
+        pass
+    try:
+        quota = int(_read(quota_path))
+        if quota > 0:
+            return quota / int(_read(period_path)), "cgroup v1 cpu.cfs_quota_us"
+    except (OSError, ValueError):
+        pass
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)), "cpu affinity"
+    return os.cpu_count() or 1, "cpu count"
+
+
+def choose(cpus, tfs_instance_count, cpu_ratio=None, fixed_worker_class=None):
+    """Choose the gunicorn workers, threads and worker class.
+
+    :param cpus: CPUs available to the container
+    :param tfs_instance_count: number of TFS processes served by the python service
+    :param cpu_ratio: share of an invocation's wall time the handlers spend on the CPU, or
+        None if it was not measured
+    :param fixed_worker_class: worker class that must be used, such as the uvicorn worker
+    :return: a SizingDecision, with the reasons for each choice
+    """
+    reasons = []
+    cores = max(1, int(math.ceil(cpus)))
+    if cpu_ratio is None:
+        cpu_ratio = DEFAULT_CPU_RATIO
+        reasons.append("handler cpu share not measured, assuming {:.0%}".format(cpu_ratio))
+    else:
+        reasons.append("handlers spend {:.0%} of an invocation on the cpu".format(cpu_ratio))
+
+    workers = int(math.ceil(cores * max(cpu_ratio, MIN_WORKER_CPU_SHARE)))
+    reasons.append(
+        "{} workers for {:g} cpus at {:.0%} cpu each".format(
+            workers, cpus, max(cpu_ratio, MIN_WORKER_CPU_SHARE)
+        )
+    )
+    if workers < tfs_instance_count:
+        workers = min(tfs_instance_count, cores)
+        reasons.append(
+            "raised to {} workers for {} tfs instances".format(workers, tfs_instance_count)
+        )
+    workers = max(1, min(workers, cores))
+
+    if fixed_worker_class:
+        worker_class, threads = fixed_worker_class, 1
+        reasons.append("worker class {} is fixed".format(worker_class))
+    elif cpu_ratio < CPU_BOUND_RATIO:
+        worker_class, threads = "gevent", 1
+        reasons.append("gevent, since handlers mostly wait for TFS")
+    else:
+        worker_class = "gthread"
+        threads = max(2, min(MAX_THREADS, int(math.ceil(1 / cpu_ratio))))
+        reasons.append(
+            "gthread with {} threads, since handlers are cpu bound but still wait for "
+            "TFS".format(threads)
+        )
+    return SizingDecision(workers, threads, worker_class, reasons)
+
+
+def probe_cpu_ratio(inference_path, samples, rest_port, grpc_port, model_name, rounds=3):
+    """Run the handlers of inference.py on the samples against a running TFS instance, and
+    return the share of the wall time spent on the CPU by this thread.
+
+    :param samples: warmup.Sample tuples
+    """
+    import importlib.util
+
+    import warmup
+    import tfs_utils
+
+    spec = importlib.util.spec_from_file_location("inference", inference_path)
+    inference = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(inference)
+    session = tfs_utils.create_rest_session()
+
+    def invoke(sample):
+        data, context = tfs_utils.parse_request(
+            warmup._make_request(sample), rest_port, grpc_port, model_name, session=session
+        )
+        if hasattr(inference, "handler"):
+            return inference.handler(data, context)
+        processed_input = inference.input_handler(data, context)
+        response = session.post(context.rest_uri, data=processed_input)
+        return inference.output_handler(response, context)
+
+    # the first round imports and connects lazily, like the first requests of a worker
+    for sample in samples:
+        invoke(sample)
+
+    cpu_time = _cpu_time()
+    wall_time = time.perf_counter()
+    for _ in range(rounds):
+        for sample in samples:
+            invoke(sample)
+    cpu_time = _cpu_time() - cpu_time
+    wall_time = time.perf_counter() - wall_time
+    return min(1.0, cpu_time / wall_time) if wall_time > 0 else 0.0
+
+
+def _cpu_time():
+    return getattr(time, "thread_time", time.process_time)()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="measure the handler cpu share")
+    parser.add_argument("--inference-path", required=True)
+    parser.add_argument("--warmup-path", required=True)
+    parser.add_argument("--rest-port", required=True)
+    parser.add_argument("--grpc-port", required=True)
+    parser.add_argument("--model-name", required=True)
+    args = parser.parse_args(argv)
+
+    import warmup
+
+    samples = warmup.load_samples(args.warmup_path)
+    if not samples:
+        raise ValueError("no samples in {}".format(args.warmup_path))
+    ratio = probe_cpu_ratio(
+        args.inference_path, samples, args.rest_port, args.grpc_port, args.model_name
+    )
+    # the last line of the output is read by serve.py
+    print(json.dumps({"cpu_ratio": ratio}))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
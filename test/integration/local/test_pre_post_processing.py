@@ -26,7 +26,7 @@ PING_URL = "http://localhost:8080/ping"
 INVOCATIONS_URL = "http://localhost:8080/invocations"
 
 
-@pytest.fixture(scope="module", autouse=True, params=["1", "2", "3", "4", "5"])
+@pytest.fixture(scope="module", autouse=True, params=["1", "2", "3", "4", "5", "6"])
 def volume(tmpdir_factory, request):
     try:
         print(str(tmpdir_factory))
@@ -0,0 +1,58 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+import json
+import time
+
+
+def handler(data, context):
+    """Handle request, sending it to TFS with the keep-alive session of the context.
+
+    Args:
+        data (obj): the request data
+        context (Context): an object containing request and configuration details
+
+    Returns:
+        (bytes, string): data to return to client, (optional) response content type
+    """
+    processed_input = _process_input(data, context)
+    timeout = None
+    if context.deadline is not None:
+        timeout = max(context.deadline - time.time(), 0.001)
+    response = context.rest_session.post(context.rest_uri, data=processed_input, timeout=timeout)
+    return _process_output(response, context)
+
+
+def _process_input(data, context):
+    if context.request_content_type == 'application/json':
+        # pass through json (assumes it's correctly formed)
+        d = data.read().decode('utf-8')
+        return d if len(d) else ''
+
+    if context.request_content_type == 'text/csv':
+        # very simple csv handler
+        return json.dumps({
+            'instances': [float(x) for x in data.read().decode('utf-8').split(',')]
+        })
+
+    raise ValueError('{{"error": "unsupported content type {}"}}'.format(
+        context.request_content_type or "unknown"))
+
+
+def _process_output(data, context):
+    if data.status_code != 200:
+        raise ValueError(data.content.decode('utf-8'))
+
+    response_content_type = context.accept_header
+    prediction = data.content
+    return prediction, response_content_type
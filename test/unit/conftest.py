@@ -0,0 +1,33 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import importlib
+import os
+import sys
+
+import pytest
+
+# the python service modules import each other as top level modules, as they do from the
+# /sagemaker directory of the container
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), '..', '..', 'docker', 'build_artifacts', 'sagemaker')
+)
+
+
+@pytest.fixture
+def python_service(monkeypatch):
+    """The python_service module, which reads the TFS ports serve.py passes to gunicorn when
+    it is first imported.
+    """
+    monkeypatch.setenv('TFS_GRPC_PORTS', '9000')
+    monkeypatch.setenv('TFS_REST_PORTS', '8501')
+    return importlib.import_module('python_service')
@@ -0,0 +1,80 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import threading
+import time
+
+import pytest
+
+from docker.build_artifacts.sagemaker import admission
+
+
+def test_limiter_rejects_when_queue_is_full():
+    limiter = admission.ConcurrencyLimiter('model m', 1, 0, 1.0)
+
+    with limiter.acquire():
+        with pytest.raises(admission.AdmissionRejected):
+            limiter.enter()
+
+    with limiter.acquire():
+        assert limiter.in_flight == 1
+
+
+def test_limiter_queued_caller_gets_released_slot():
+    limiter = admission.ConcurrencyLimiter('model m', 1, 1, 5.0)
+    limiter.enter()
+
+    admitted = []
+
+    def wait_for_slot():
+        with limiter.acquire():
+            admitted.append(True)
+
+    thread = threading.Thread(target=wait_for_slot)
+    thread.start()
+    while limiter.waiting == 0:
+        time.sleep(0.001)
+    limiter.exit()
+    thread.join(5)
+
+    assert admitted == [True]
+    assert limiter.in_flight == 0
+    assert limiter.waiting == 0
+
+
+def test_limiter_wait_ends_at_deadline():
+    queue_changes = []
+    limiter = admission.ConcurrencyLimiter('instance 8501', 1, 1, 5.0, queue_changes.append)
+    limiter.enter()
+
+    start = time.time()
+    with pytest.raises(admission.AdmissionRejected):
+        limiter.enter(deadline=time.time() + 0.05)
+
+    assert time.time() - start < 1
+    assert queue_changes == [1, -1]
+
+
+def test_controller_limits_per_model():
+    rejections = []
+    controller = admission.AdmissionController(1, 0, 0, 0, on_reject=rejections.append)
+
+    with controller.model('a'):
+        with controller.model('b'):
+            with pytest.raises(admission.AdmissionRejected):
+                with controller.model('a'):
+                    pass
+        # no limit per instance
+        with controller.instance('8501'), controller.instance('8501'):
+            pass
+
+    assert rejections == ['model']
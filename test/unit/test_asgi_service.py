@@ -0,0 +1,242 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import asyncio
+import importlib
+import json
+import types
+
+import aiohttp
+import pytest
+
+import eviction
+import model_registry
+import routing
+
+
+class TfsResponse:
+    def __init__(self, status, content):
+        self.status = status
+        self._content = content
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def read(self):
+        return self._content
+
+
+class Session:
+    """An aiohttp.ClientSession of one TFS rest port, which predicts twice each instance, or
+    cannot connect when ``unavailable`` is set.
+    """
+
+    def __init__(self, rest_port, requests, unavailable=False):
+        self._rest_port = rest_port
+        self._requests = requests
+        self.unavailable = unavailable
+
+    def post(self, uri, data=None, **kwargs):
+        self._requests.append((self._rest_port, uri))
+        if self.unavailable:
+            key = types.SimpleNamespace(host='localhost', port=self._rest_port, ssl=True)
+            raise aiohttp.ClientConnectorError(key, ConnectionRefusedError(111, 'refused'))
+        predictions = [2 * i for i in json.loads(data)['instances']]
+        return TfsResponse(200, json.dumps({'predictions': predictions}).encode('utf-8'))
+
+
+class FirstInstanceRouter(routing.Router):
+    def _choose(self, instances):
+        return instances[0]
+
+
+@pytest.fixture
+def asgi_service(python_service):
+    return importlib.import_module('asgi_service')
+
+
+@pytest.fixture
+def resource(python_service):
+    return python_service.resources._python_service_resource
+
+
+@pytest.fixture
+def tfs_requests():
+    return []
+
+
+@pytest.fixture
+def sessions(monkeypatch, tfs_requests):
+    sessions = {}
+
+    def aio_session(invoker, rest_port):
+        if rest_port not in sessions:
+            sessions[rest_port] = Session(rest_port, tfs_requests)
+        return sessions[rest_port]
+
+    monkeypatch.setattr('asgi_service.AsyncInvoker._aio_session', aio_session)
+    return sessions
+
+
+def _call(app, method, path, body=b''):
+    """Send a request to the ASGI application, and return the status, the headers and the
+    body messages of the response.
+    """
+    scope = {'type': 'http', 'method': method, 'path': path, 'headers': []}
+    requests = [{'type': 'http.request', 'body': body}]
+    messages = []
+
+    async def receive():
+        return requests.pop(0)
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    start, body_messages = messages[0], messages[1:]
+    return start['status'], dict(start['headers']), body_messages
+
+
+def _body(body_messages):
+    return b''.join(message['body'] for message in body_messages)
+
+
+def test_invocation(asgi_service, resource, sessions, tfs_requests):
+    app = asgi_service.AsgiApplication(asgi_service.python_service.resources)
+
+    status, headers, body = _call(app, 'POST', '/invocations', b'{"instances": [1, 2]}')
+
+    assert status == 200
+    assert headers[b'content-type'] == b'application/json'
+    assert json.loads(_body(body)) == {'predictions': [2, 4]}
+    assert tfs_requests == [('8501', 'http://localhost:8501/v1/models/None:predict')]
+    assert [instance.in_flight for instance in resource._router.instances] == [0]
+
+
+def test_other_routes(asgi_service):
+    app = asgi_service.AsgiApplication(asgi_service.python_service.resources)
+
+    assert _call(app, 'GET', '/ping')[0] == 200
+    assert _call(app, 'GET', '/unknown')[0] == 404
+
+
+def _two_instances(monkeypatch, resource, failure_threshold):
+    router = FirstInstanceRouter(
+        ['8501', '8502'], ['9000', '9001'], failure_threshold=failure_threshold
+    )
+    monkeypatch.setattr(resource, '_router', router)
+    monkeypatch.setattr(resource, '_retry_budget', routing.RetryBudget(1.0))
+    monkeypatch.setattr(resource, '_retries_enabled', True)
+    monkeypatch.setattr(resource, '_tfs_rest_ports', ['8501', '8502'])
+    monkeypatch.setitem(resource._channels, '9001', None)
+    return router
+
+
+def test_unavailable_instance_is_retried_and_skipped_by_its_circuit_breaker(
+    asgi_service, resource, sessions, tfs_requests, monkeypatch
+):
+    router = _two_instances(monkeypatch, resource, failure_threshold=2)
+    app = asgi_service.AsgiApplication(asgi_service.python_service.resources)
+    app._invoker._aio_session('8501').unavailable = True
+
+    for _ in range(3):
+        status, _, body = _call(app, 'POST', '/invocations', b'{"instances": [1]}')
+        assert status == 200
+        assert json.loads(_body(body)) == {'predictions': [2]}
+
+    # the circuit of the first instance opens after its second failure
+    assert [port for port, _ in tfs_requests] == ['8501', '8502', '8501', '8502', '8502']
+    assert router.instances[0].consecutive_failures == 2
+    assert not router.instances[0].routable(router.instances[0].circuit_open_until - 1)
+    assert router.instances[1].consecutive_failures == 0
+
+
+def test_error_when_every_instance_is_unavailable(
+    asgi_service, resource, sessions, tfs_requests, monkeypatch
+):
+    _two_instances(monkeypatch, resource, failure_threshold=5)
+    app = asgi_service.AsgiApplication(asgi_service.python_service.resources)
+    for rest_port in ('8501', '8502'):
+        app._invoker._aio_session(rest_port).unavailable = True
+
+    status, _, body = _call(app, 'POST', '/invocations', b'{"instances": [1]}')
+
+    assert status == 500
+    assert 'Cannot connect to host' in json.loads(_body(body))['error']
+    assert [port for port, _ in tfs_requests] == ['8501', '8502']
+
+
+def _lines_of_in_flight(instance):
+    for _ in range(2):
+        yield '{}\n'.format(instance.in_flight)
+
+
+async def _async_lines_of_in_flight(instance):
+    for line in _lines_of_in_flight(instance):
+        yield line
+
+
+@pytest.mark.parametrize('lines_fn', [_lines_of_in_flight, _async_lines_of_in_flight])
+def test_streamed_response(asgi_service, resource, sessions, monkeypatch, lines_fn):
+    app = asgi_service.AsgiApplication(asgi_service.python_service.resources)
+    instance = resource._router.instances[0]
+
+    async def handlers(data, context):
+        return lines_fn(instance), 'application/jsonlines'
+
+    monkeypatch.setattr(app._invoker, '_handlers', handlers)
+    status, headers, body = _call(app, 'POST', '/invocations', b'{"instances": [1]}')
+
+    assert status == 200
+    assert headers[b'content-type'] == b'application/jsonlines'
+    assert headers[b'x-accel-buffering'] == b'no'
+    assert b'content-length' not in headers
+    # the instance is in flight until the last chunk is sent
+    assert [message['body'] for message in body] == [b'1\n', b'1\n', b'']
+    assert [message.get('more_body', False) for message in body] == [True, True, False]
+    assert instance.in_flight == 0
+
+
+def test_multi_model_invocation(
+    asgi_service, python_service, resource, sessions, tfs_requests, monkeypatch, tmpdir
+):
+    registry = model_registry.ModelRegistry(
+        {'rest_port': range(9000, 9010), 'grpc_port': range(9500, 9510)},
+        path=str(tmpdir.join('registry.json')),
+        lock_path=str(tmpdir.join('registry.lock')),
+    )
+    with registry.update() as state:
+        ports = model_registry.take_ports(state)
+        state['models']['a'] = model_registry.new_model(state, *ports, '/opt/ml/models/a')
+    registry.model_available('a', pid=None)
+
+    monkeypatch.setattr(python_service, 'SAGEMAKER_MULTI_MODEL_ENABLED', True)
+    monkeypatch.setattr(resource, '_registry', registry, raising=False)
+    usage = eviction.ModelUsage(registry, usage_dir=str(tmpdir.join('usage')))
+    monkeypatch.setattr(resource, '_model_usage', usage, raising=False)
+    monkeypatch.setattr(resource, '_model_versions', {}, raising=False)
+    monkeypatch.setattr(python_service.resources, '_enable_model_manager', True)
+    app = asgi_service.AsgiApplication(python_service.resources)
+
+    status, _, body = _call(app, 'POST', '/models/a/invoke', b'{"instances": [1]}')
+    assert status == 200
+    assert json.loads(_body(body)) == {'predictions': [2]}
+    assert tfs_requests == [(9000, 'http://localhost:9000/v1/models/a:predict')]
+    assert usage.last_used('a') is not None
+    assert usage.least_recently_used() == ['a']
+
+    status, _, body = _call(app, 'POST', '/models/b/invoke', b'{"instances": [1]}')
+    assert status == 404
+    assert json.loads(_body(body)) == {'error': 'Model b is not loaded yet.'}
@@ -0,0 +1,97 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import io
+import json
+
+import pytest
+
+from docker.build_artifacts.sagemaker import chunking
+
+
+class Stream(io.BytesIO):
+    """A request body stream that records how much of the body was read."""
+
+    def readline(self, *args):
+        line = super().readline(*args)
+        self.read_bytes = self.tell()
+        return line
+
+
+def _split(body, content_type, records):
+    return list(chunking.split(io.BytesIO(body), content_type, records))
+
+
+def test_split_csv_lines():
+    body = b'1,2\n3,4\n\n5,6\n7,8\n9,10'
+
+    chunks = _split(body, 'text/csv; charset=utf-8', 2)
+
+    assert chunks == [b'1,2\n3,4\n', b'5,6\n7,8\n', b'9,10']
+
+
+def test_lines_are_read_as_the_chunks_are_consumed():
+    stream = Stream(b'1\n2\n3\n4\n5\n')
+    chunks = chunking.split(stream, 'application/jsonlines', 2)
+
+    assert next(chunks) == b'1\n2\n'
+    assert stream.read_bytes == len(b'1\n2\n3\n')
+    assert list(chunks) == [b'3\n4\n', b'5\n']
+
+
+def test_split_json_instances_keeps_other_keys():
+    body = json.dumps({'signature_name': 's', 'instances': [1, 2, 3]}).encode('utf-8')
+
+    chunks = _split(body, 'application/json', 2)
+
+    assert [json.loads(c) for c in chunks] == [
+        {'signature_name': 's', 'instances': [1, 2]},
+        {'signature_name': 's', 'instances': [3]},
+    ]
+
+
+@pytest.mark.parametrize(
+    'body, content_type, records',
+    [
+        (b'{"instances": [1, 2]}', 'application/json', 2),
+        (b'{"inputs": [1, 2, 3]}', 'application/json', 2),
+        (b'not json', 'application/json', 2),
+        (b'\x00\x01', 'application/octet-stream', 1),
+        (b'1,2\n\n3,4', 'text/csv', 2),
+    ],
+)
+def test_single_chunk_or_other_bodies_are_not_split(body, content_type, records):
+    assert _split(body, content_type, records) == [body]
+
+
+def test_merge_predictions():
+    bodies = ['{"predictions": [1, 2]}', b'{"predictions": [3]}']
+
+    merged = chunking.merge(bodies, 'application/json')
+
+    assert json.loads(merged) == {'predictions': [1, 2, 3]}
+
+
+def test_merge_json_arrays():
+    assert json.loads(chunking.merge(['[1]', '[2, 3]'], 'application/json')) == [1, 2, 3]
+
+
+def test_merge_lines():
+    merged = chunking.merge([b'{"a": 1}\n{"a": 2}', '{"a": 3}\n'], 'application/jsonlines')
+
+    assert merged == b'{"a": 1}\n{"a": 2}\n{"a": 3}\n'
+
+
+def test_merge_streamed_bodies():
+    streamed = (line for line in ['1,2\n', b'3,4\n'])
+
+    assert chunking.merge([streamed, '5,6'], 'text/csv') == b'1,2\n3,4\n5,6\n'
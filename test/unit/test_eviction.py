@@ -0,0 +1,208 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import os
+import threading
+import time
+
+from docker.build_artifacts.sagemaker import eviction, model_registry
+
+
+def _registry(tmpdir, *names):
+    registry = model_registry.ModelRegistry(
+        {'rest_port': range(9000, 9010), 'grpc_port': range(9500, 9510)},
+        path=str(tmpdir.join('registry.json')),
+        lock_path=str(tmpdir.join('registry.lock')),
+    )
+    for name in names:
+        with registry.update() as state:
+            ports = model_registry.take_ports(state)
+            state['models'][name] = model_registry.new_model(state, *ports, '/opt/ml/models/a')
+        registry.model_available(name, pid=None)
+        time.sleep(0.01)
+    return registry
+
+
+def _usage(registry, tmpdir, **kwargs):
+    return eviction.ModelUsage(registry, usage_dir=str(tmpdir.join('usage')), **kwargs)
+
+
+def test_least_recently_used_order(tmpdir):
+    usage = _usage(_registry(tmpdir, 'a', 'b', 'c'), tmpdir)
+    assert usage.least_recently_used() == ['a', 'b', 'c']
+
+    with usage.invocation('a'):
+        assert usage.admitted('a')
+    assert usage.last_used('a') is not None
+
+    assert usage.least_recently_used() == ['b', 'c', 'a']
+    assert usage.least_recently_used(excluded=('b',)) == ['c', 'a']
+
+
+def test_models_in_use_are_not_evicted(tmpdir):
+    usage = _usage(_registry(tmpdir, 'a', 'b'), tmpdir, poll_seconds=0.01)
+
+    with usage.invocation('a'):
+        assert usage.least_recently_used() == ['b']
+        assert not usage.drain('a', 0.05)
+        assert usage.admitted('a')
+
+    assert usage.drain('a', 0.05)
+    assert usage.least_recently_used() == ['b']
+    with usage.invocation('a'):
+        assert not usage.admitted('a')
+
+    usage.undrain('a')
+    with usage.invocation('a'):
+        assert usage.admitted('a')
+
+
+def test_invocations_of_other_workers(tmpdir):
+    registry = _registry(tmpdir, 'a', 'b')
+    usage = _usage(registry, tmpdir, worker=os.getpid(), poll_seconds=0.01)
+    other_usage = _usage(
+        model_registry.ModelRegistry(
+            {'rest_port': range(9000, 9010), 'grpc_port': range(9500, 9510)},
+            path=str(tmpdir.join('registry.json')),
+            lock_path=str(tmpdir.join('registry.lock')),
+        ),
+        tmpdir,
+        worker=os.getppid(),
+    )
+
+    with other_usage.invocation('a'):
+        assert usage.least_recently_used() == ['b']
+        assert not usage.drain('a', 0.05)
+
+    # the model was invoked by the other worker after b loaded
+    assert usage.least_recently_used() == ['b', 'a']
+    with other_usage.invocation('a'):
+        drained = threading.Thread(target=usage.drain, args=('a', 5))
+        drained.start()
+        while not registry.model('a')['draining']:
+            time.sleep(0.01)
+        assert drained.is_alive()
+        assert not other_usage.admitted('a')
+    drained.join(5)
+    assert not drained.is_alive()
+    assert registry.model('a')['draining']
+
+
+def test_invocations_of_dead_workers_are_ignored(tmpdir):
+    registry = _registry(tmpdir, 'a')
+    dead_usage = _usage(registry, tmpdir, worker=2 ** 22 + 1)
+    invocation = dead_usage.invocation('a')
+    invocation.__enter__()
+
+    usage = _usage(registry, tmpdir)
+    assert usage.least_recently_used() == ['a']
+    assert usage.drain('a', 0)
+
+    # the usage file of the dead worker is removed when a live worker counts an invocation
+    with usage.invocation('b'):
+        pass
+    assert os.listdir(str(tmpdir.join('usage'))) == [str(2 ** 22 + 1)]
+    with usage.invocation('a'):
+        pass
+    assert os.listdir(str(tmpdir.join('usage'))) == [str(os.getpid())]
+
+
+def test_invocations_of_unloaded_models(tmpdir):
+    registry = _registry(tmpdir, 'a')
+    usage = _usage(registry, tmpdir)
+
+    with usage.invocation('b'):
+        assert not usage.admitted('b')
+
+    with usage.invocation('a'):
+        # the model is loaded again while it is invoked
+        with registry.update() as state:
+            state['models']['a'] = model_registry.new_model(state, 9008, 9508, '/opt/ml/models/a')
+        registry.model_available('a', pid=None)
+        assert not usage.admitted('a')
+        with usage.invocation('a'):
+            assert usage.admitted('a')
+    assert usage.least_recently_used() == ['a']
+    assert usage.last_used('a') is not None
+
+
+def test_invocations_of_models_in_reused_slots(tmpdir):
+    registry = _registry(tmpdir, 'a')
+    usage = _usage(registry, tmpdir, poll_seconds=0.01)
+
+    with usage.invocation('a'):
+        with registry.update() as state:
+            del state['models']['a']
+            state['models']['b'] = model_registry.new_model(state, 9008, 9508, '/opt/ml/models/b')
+        registry.model_available('b', pid=None)
+        assert registry.model('b')['usage_slot'] == 0
+        assert usage.least_recently_used() == ['b']
+        assert usage.last_used('b') is None
+        with usage.invocation('b'):
+            assert usage.admitted('b')
+            assert usage.least_recently_used() == []
+    assert usage.least_recently_used() == ['b']
+
+
+def test_many_models(tmpdir):
+    names = [str(i) for i in range(eviction.MIN_USAGE_SLOTS + 1)]
+    registry = _registry(tmpdir)
+    with registry.update() as state:
+        for name in names:
+            state['models'][name] = model_registry.new_model(state, 9000, 9500, '/opt/ml/models')
+            state['models'][name].update(state=model_registry.AVAILABLE, loaded_at=1.0)
+    usage = _usage(registry, tmpdir)
+
+    with usage.invocation('0'):
+        pass
+    time.sleep(0.01)
+    # the usage file grows to the slot of the last model
+    with usage.invocation(names[-1]):
+        assert usage.admitted(names[-1])
+    assert usage.least_recently_used() == sorted(names[1:-1]) + ['0', names[-1]]
+
+
+def test_usage_is_not_counted_when_eviction_is_disabled(tmpdir):
+    registry = _registry(tmpdir, 'a')
+    usage = _usage(registry, tmpdir, enabled=False)
+
+    with usage.invocation('a'):
+        assert usage.admitted('a')
+        assert usage.least_recently_used() == []
+        assert not usage.drain('a', 0)
+    assert usage.last_used('a') is None
+    assert usage.last_used_times() == {}
+    assert not tmpdir.join('usage').exists()
+
+
+def test_add_record():
+    records = {}
+    for name in ('a', 'b', 'c'):
+        eviction.add_record(
+            records, name, eviction.eviction_record('no available ports', None, 100), 2
+        )
+
+    assert list(records) == ['b', 'c']
+    assert records['c']['tfs_process_memory_bytes'] == 100
+
+    eviction.add_record(records, 'b', eviction.eviction_record('no available ports', 1.0, 0), 2)
+    assert list(records) == ['c', 'b']
+
+
+def test_process_rss():
+    assert eviction.process_rss(os.getpid()) > 0
+    assert eviction.process_rss(-1) == 0
+
+
+def test_process_alive():
+    assert eviction.process_alive(os.getpid())
+    assert not eviction.process_alive(2 ** 22 + 1)
@@ -0,0 +1,99 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import importlib.util
+import io
+import json
+import os
+import time
+
+import pytest
+
+import tfs_utils
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(__file__), '..', 'resources', 'examples')
+REST_URI = 'http://localhost:9000/v1/models/half_plus_three:predict'
+
+
+class Response:
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+
+class Session:
+    def __init__(self, response):
+        self.response = response
+        self.posts = []
+
+    def post(self, uri, data=None, timeout=None):
+        self.posts.append((uri, data, timeout))
+        return self.response
+
+
+def _load_example(name):
+    path = os.path.join(EXAMPLES_DIR, name, 'inference.py')
+    spec = importlib.util.spec_from_file_location('{}_inference'.format(name), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _context(session, content_type, deadline=None):
+    return tfs_utils.Context(
+        model_name='half_plus_three',
+        model_version=None,
+        method='predict',
+        rest_uri=REST_URI,
+        grpc_port='9500',
+        channel=None,
+        custom_attributes=None,
+        request_content_type=content_type,
+        accept_header='application/json',
+        content_length=None,
+        rest_session=session,
+        aio_session=None,
+        codec=None,
+        deadline=deadline,
+    )
+
+
+def test_rest_session_example():
+    inference = _load_example('test6')
+    session = Session(Response(200, b'{"predictions": [3.5, 4.0]}'))
+
+    body, content_type = inference.handler(
+        io.BytesIO(b'1.0,2.0'), _context(session, 'text/csv', deadline=time.time() + 10)
+    )
+
+    assert (body, content_type) == (b'{"predictions": [3.5, 4.0]}', 'application/json')
+    [(uri, data, timeout)] = session.posts
+    assert uri == REST_URI
+    assert json.loads(data) == {'instances': [1.0, 2.0]}
+    assert 0 < timeout <= 10
+
+
+def test_rest_session_example_without_deadline():
+    inference = _load_example('test6')
+    session = Session(Response(200, b'{"predictions": [3.5]}'))
+
+    inference.handler(io.BytesIO(b'{"instances": [1.0]}'), _context(session, 'application/json'))
+
+    assert session.posts == [(REST_URI, '{"instances": [1.0]}', None)]
+
+
+def test_rest_session_example_error():
+    inference = _load_example('test6')
+    session = Session(Response(400, b'{"error": "bad input"}'))
+
+    with pytest.raises(ValueError, match='bad input'):
+        inference.handler(io.BytesIO(b'{}'), _context(session, 'application/json'))
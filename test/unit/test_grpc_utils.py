@@ -0,0 +1,333 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import array
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+import grpc_utils
+
+pytestmark = pytest.mark.skipif(
+    not grpc_utils.GRPC_PREDICT_AVAILABLE, reason='tensorflow-serving-api is not installed'
+)
+
+
+class Channel:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class MetadataStub:
+    """A PredictionService stub whose models have one float input, or one string input once
+    they are loaded again.
+    """
+
+    def __init__(self):
+        self.dtype = grpc_utils.types_pb2.DT_FLOAT
+        self.calls = 0
+
+    def GetModelMetadata(self, request, timeout=None):
+        self.calls += 1
+        signature_map = grpc_utils.get_model_metadata_pb2.SignatureDefMap()
+        signature = signature_map.signature_def[request.model_spec.signature_name]
+        signature.inputs['x'].dtype = self.dtype
+        response = grpc_utils.get_model_metadata_pb2.GetModelMetadataResponse()
+        response.metadata['signature_def'].Pack(signature_map)
+        return response
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    stub = MetadataStub()
+    monkeypatch.setattr(grpc_utils, '_stub', lambda channel: stub)
+    monkeypatch.setattr(grpc_utils, '_signature_inputs', {})
+    monkeypatch.setattr(grpc_utils, '_stubs', {})
+    return stub
+
+
+def _inputs(channel, model_name):
+    return grpc_utils.signature_inputs(channel, model_name, None, 'serving_default')
+
+
+def test_signature_inputs_are_cached(stub):
+    channel = Channel()
+
+    assert _inputs(channel, 'a') == {'x': grpc_utils.types_pb2.DT_FLOAT}
+    assert _inputs(channel, 'a') == {'x': grpc_utils.types_pb2.DT_FLOAT}
+    assert stub.calls == 1
+
+    _inputs(Channel(), 'a')
+    assert stub.calls == 2
+
+
+def test_forget_model(stub):
+    channel = Channel()
+    _inputs(channel, 'a')
+    _inputs(channel, 'b')
+
+    # the model is loaded again with another signature
+    stub.dtype = grpc_utils.types_pb2.DT_STRING
+    grpc_utils.forget_model('a')
+
+    assert _inputs(channel, 'a') == {'x': grpc_utils.types_pb2.DT_STRING}
+    assert _inputs(channel, 'b') == {'x': grpc_utils.types_pb2.DT_FLOAT}
+    assert stub.calls == 3
+
+
+def test_close_channel(stub):
+    channel, other_channel = Channel(), Channel()
+    _inputs(channel, 'a')
+    _inputs(other_channel, 'a')
+    grpc_utils._stubs[channel] = stub
+
+    grpc_utils.close_channel(channel)
+
+    assert channel.closed
+    assert channel not in grpc_utils._stubs
+    assert [key[0] for key in grpc_utils._signature_inputs] == [other_channel]
+
+
+@pytest.mark.parametrize(
+    'dtype, value',
+    [
+        ('DT_FLOAT', [[1.5, -2.0], [0.25, 3.0]]),
+        ('DT_DOUBLE', [1.5, -2.0]),
+        ('DT_INT8', [-1, 2]),
+        ('DT_INT16', [-300, 2]),
+        ('DT_INT32', [[-1], [2]]),
+        ('DT_INT64', [-(2 ** 40), 2]),
+        ('DT_UINT8', [0, 255]),
+        ('DT_UINT16', [0, 65535]),
+        ('DT_UINT32', [0, 2 ** 32 - 1]),
+        ('DT_UINT64', [0, 2 ** 64 - 1]),
+        ('DT_BOOL', [True, False]),
+        ('DT_STRING', ['a', 'é']),
+    ],
+)
+def test_tensor_proto_round_trip(dtype, value):
+    tensor = grpc_utils.make_tensor_proto(value, grpc_utils.types_pb2.DataType.Value(dtype))
+    assert grpc_utils.tensor_proto_to_list(tensor) == value
+
+
+def test_tensor_content_round_trip():
+    tensor = grpc_utils.make_tensor_proto([[1, 2, 3], [4, 5, 6]], grpc_utils.types_pb2.DT_INT32)
+    content = array.array('i', tensor.int_val).tobytes()
+    del tensor.int_val[:]
+    tensor.tensor_content = content
+
+    assert grpc_utils.tensor_proto_to_list(tensor) == [[1, 2, 3], [4, 5, 6]]
+
+
+def test_binary_strings_are_base64_encoded():
+    tensor = grpc_utils.make_tensor_proto([{'b64': 'gA=='}], grpc_utils.types_pb2.DT_STRING)
+    assert list(tensor.string_val) == [b'\x80']
+    assert grpc_utils.tensor_proto_to_list(tensor, b64=True) == [{'b64': 'gA=='}]
+    assert grpc_utils.tensor_proto_to_list(tensor) == ['\ufffd']
+
+
+@pytest.mark.parametrize(
+    'dtype, value', [('DT_FLOAT', 1.5), ('DT_INT64', 7), ('DT_BOOL', True), ('DT_STRING', 'a')]
+)
+def test_scalar_round_trip(dtype, value):
+    tensor = grpc_utils.make_tensor_proto(value, grpc_utils.types_pb2.DataType.Value(dtype))
+    assert not tensor.tensor_shape.dim
+    assert grpc_utils.tensor_proto_to_list(tensor) == value
+
+
+@pytest.mark.parametrize(
+    'dtype, value', [('DT_FLOAT', 0.0), ('DT_INT32', 0), ('DT_BOOL', False), ('DT_STRING', '')]
+)
+def test_scalar_without_values(dtype, value):
+    tensor = grpc_utils.tensor_pb2.TensorProto(dtype=grpc_utils.types_pb2.DataType.Value(dtype))
+    assert grpc_utils.tensor_proto_to_list(tensor) == value
+
+
+def test_empty_tensors():
+    for value in ([], [[], []]):
+        tensor = grpc_utils.make_tensor_proto(value, grpc_utils.types_pb2.DT_FLOAT)
+        assert grpc_utils.tensor_proto_to_list(tensor) == []
+
+
+def test_repeated_value_is_expanded():
+    tensor = grpc_utils.tensor_pb2.TensorProto(dtype=grpc_utils.types_pb2.DT_INT32)
+    tensor.tensor_shape.dim.add(size=3)
+    tensor.int_val.append(4)
+    assert grpc_utils.tensor_proto_to_list(tensor) == [4, 4, 4]
+
+
+def _predict_response(**outputs):
+    response = grpc_utils.predict_pb2.PredictResponse()
+    for name, (value, dtype) in outputs.items():
+        response.outputs[name].CopyFrom(grpc_utils.make_tensor_proto(value, dtype))
+    return response
+
+
+def test_predict_response_to_json_single_output():
+    response = _predict_response(scores=([[0.5], [1.5]], grpc_utils.types_pb2.DT_FLOAT))
+
+    assert grpc_utils.predict_response_to_json(response, True) == {'predictions': [[0.5], [1.5]]}
+    assert grpc_utils.predict_response_to_json(response, False) == {'outputs': [[0.5], [1.5]]}
+
+
+def test_predict_response_to_json_multiple_outputs():
+    response = _predict_response(
+        scores=([0.5, 1.5], grpc_utils.types_pb2.DT_FLOAT),
+        classes=([['a'], ['b']], grpc_utils.types_pb2.DT_STRING),
+    )
+
+    assert grpc_utils.predict_response_to_json(response, True) == {
+        'predictions': [{'scores': 0.5, 'classes': ['a']}, {'scores': 1.5, 'classes': ['b']}]
+    }
+    assert grpc_utils.predict_response_to_json(response, False) == {
+        'outputs': {'scores': [0.5, 1.5], 'classes': [['a'], ['b']]}
+    }
+
+
+def test_predict_response_to_json_base64_encodes_only_bytes_outputs():
+    # as the TFS REST API encodes outputs whose name ends with _bytes
+    response = _predict_response(
+        image_bytes=([[{'b64': 'iVBORw=='}], ['text']], grpc_utils.types_pb2.DT_STRING),
+        label=(['cat', 'dog'], grpc_utils.types_pb2.DT_STRING),
+    )
+
+    assert grpc_utils.predict_response_to_json(response, True) == {
+        'predictions': [
+            {'image_bytes': [{'b64': 'iVBORw=='}], 'label': 'cat'},
+            {'image_bytes': [{'b64': 'dGV4dA=='}], 'label': 'dog'},
+        ]
+    }
+    assert grpc_utils.predict_response_to_json(response, False) == {
+        'outputs': {
+            'image_bytes': [[{'b64': 'iVBORw=='}], [{'b64': 'dGV4dA=='}]],
+            'label': ['cat', 'dog'],
+        }
+    }
+
+
+def test_predict_response_to_json_scalar_outputs():
+    response = _predict_response(
+        scores=([0.5, 1.5], grpc_utils.types_pb2.DT_FLOAT),
+        version=(3, grpc_utils.types_pb2.DT_INT64),
+    )
+    assert grpc_utils.predict_response_to_json(response, True) == {
+        'predictions': [{'scores': 0.5, 'version': 3}, {'scores': 1.5, 'version': 3}]
+    }
+
+    response = _predict_response(
+        score=(0.5, grpc_utils.types_pb2.DT_FLOAT), version=(3, grpc_utils.types_pb2.DT_INT64)
+    )
+    assert grpc_utils.predict_response_to_json(response, True) == {
+        'predictions': [{'score': 0.5, 'version': 3}]
+    }
+
+
+def test_predict_response_to_json_different_batch_sizes():
+    response = _predict_response(
+        scores=([0.5, 1.5], grpc_utils.types_pb2.DT_FLOAT),
+        classes=([1, 2, 3], grpc_utils.types_pb2.DT_INT32),
+    )
+    with pytest.raises(ValueError):
+        grpc_utils.predict_response_to_json(response, True)
+    assert grpc_utils.predict_response_to_json(response, False) == {
+        'outputs': {'scores': [0.5, 1.5], 'classes': [1, 2, 3]}
+    }
+
+
+def _predict_request(model_name='', version=None, version_label=None):
+    request = grpc_utils.predict_pb2.PredictRequest()
+    request.model_spec.name = model_name
+    if version is not None:
+        request.model_spec.version.value = version
+    if version_label is not None:
+        request.model_spec.version_label = version_label
+    request.inputs['x'].CopyFrom(grpc_utils.make_tensor_proto([1.0], grpc_utils.types_pb2.DT_FLOAT))
+    return request.SerializeToString()
+
+
+def test_parse_predict_request_keeps_the_model_spec():
+    request = grpc_utils.parse_predict_request(
+        _predict_request('a', version=2), default_model_name='default'
+    )
+
+    assert (request.model_spec.name, request.model_spec.version.value) == ('a', 2)
+    assert grpc_utils.tensor_proto_to_list(request.inputs['x']) == [1.0]
+
+
+def test_parse_predict_request_overrides_the_model_spec():
+    request = grpc_utils.parse_predict_request(
+        _predict_request('a', version_label='stable'), 'b', '3', 'default'
+    )
+
+    assert request.model_spec.name == 'b'
+    assert request.model_spec.WhichOneof('version_choice') == 'version'
+    assert request.model_spec.version.value == 3
+
+
+def test_parse_predict_request_default_model_name():
+    request = grpc_utils.parse_predict_request(_predict_request(), default_model_name='default')
+
+    assert request.model_spec.name == 'default'
+    assert not request.model_spec.HasField('version')
+
+
+def test_parse_predict_request_rejects_other_bodies():
+    with pytest.raises(ValueError, match='not a serialized PredictRequest'):
+        grpc_utils.parse_predict_request(b'{"instances": [1.0]}')
+
+
+GEVENT_WORKER = textwrap.dedent('''
+    from gevent import monkey
+
+    monkey.patch_all()
+
+    import gevent
+    import grpc
+    import grpc_utils
+
+    assert grpc_utils.init_gevent()
+    ticks = []
+
+    def tick():
+        while True:
+            ticks.append(None)
+            gevent.sleep(0.01)
+
+    gevent.spawn(tick)
+    gevent.sleep(0)
+    ticks.clear()
+    try:
+        grpc.channel_ready_future(grpc.insecure_channel('localhost:1')).result(timeout=0.5)
+    except grpc.FutureTimeoutError:
+        pass
+    print(len(ticks))
+''')
+
+
+def test_grpc_calls_do_not_block_gevent_workers():
+    pytest.importorskip('gevent')
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(grpc_utils.__file__))
+    output = subprocess.run(
+        [sys.executable, '-c', GEVENT_WORKER], env=env, stdout=subprocess.PIPE, timeout=60
+    ).stdout
+
+    # the other greenlets of the worker run while the call waits
+    assert int(output) > 10
+
+
+def test_init_gevent_without_gevent_workers():
+    assert not grpc_utils.init_gevent()
@@ -0,0 +1,132 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import io
+import logging
+import os
+import queue
+import time
+from collections import namedtuple
+
+import pytest
+
+from docker.build_artifacts.sagemaker import handler_pool, logging_utils
+
+Context = namedtuple('Context', 'model_name, content_length')
+
+
+def _same(context):
+    return context
+
+
+def input_handler(data, context):
+    return '{} {} {}'.format(context.model_name, len(data.read()), os.getpid())
+
+
+def output_handler(response, context):
+    return response.content * 2, 'application/octet-stream'
+
+
+def failing_handler(data, context):
+    raise ValueError('bad input')
+
+
+def logging_handler(data, context):
+    logging.getLogger('handler').warning('handled %s', context.model_name)
+    return data.read()
+
+
+def busy_handler(data, context):
+    start = time.process_time()
+    while time.process_time() - start < 0.2:
+        pass
+    return data.read()
+
+
+@pytest.fixture
+def pool():
+    pool = handler_pool.HandlerPool(1, 100, _same, _same)
+    yield pool
+    pool.close()
+
+
+def test_share_and_take():
+    assert handler_pool.share(b'small', 100) == b'small'
+
+    shared = handler_pool.share('x' * 200, 100)
+    assert isinstance(shared, handler_pool.SharedBuffer)
+    assert handler_pool.take(shared) == 'x' * 200
+    assert not os.path.exists(shared.path)
+
+
+def test_share_stream():
+    assert handler_pool.share_stream(io.BytesIO(b'small'), 5, 100) == b'small'
+
+    shared = handler_pool.share_stream(io.BytesIO(b'x' * 200), 200, 100)
+    assert shared.length == 200
+    assert handler_pool.take(shared) == b'x' * 200
+
+
+def test_run_handlers_in_another_process(pool):
+    body = io.BytesIO(b'x' * 1000)
+
+    result = pool.run_input_handler(input_handler, body, Context('m', 1000))
+
+    model_name, length, pid = result.split()
+    assert (model_name, length) == ('m', '1000')
+    assert int(pid) != os.getpid()
+
+    response = handler_pool.SharedResponse(200, {}, b'y' * 100)
+    body, content_type = pool.run_output_handler(output_handler, response, Context('m', 0))
+    assert body == b'y' * 200
+    assert content_type == 'application/octet-stream'
+
+
+def test_handler_errors_are_raised(pool):
+    with pytest.raises(ValueError):
+        pool.run_input_handler(failing_handler, b'{}', Context('m', 2))
+
+    # the process is still used after the error
+    assert pool.run_input_handler(input_handler, b'{}', Context('m', 2)).startswith('m 2')
+
+
+def test_handler_cpu_time_is_measured_in_the_pool_process():
+    cpu_seconds = []
+    pool = handler_pool.HandlerPool(
+        1, 100, _same, _same, cpu_seconds_fn=lambda context, s: cpu_seconds.append(s)
+    )
+    try:
+        pool.run_input_handler(busy_handler, b'{}', Context('m', 2))
+    finally:
+        pool.close()
+
+    assert len(cpu_seconds) == 1
+    assert cpu_seconds[0] >= 0.2
+
+
+def test_handler_logs_are_written_by_the_pool_process(capfd):
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    # records of the parent go through a queue, whose listener thread is not forked
+    queue_handler = logging_utils._QueueHandler(queue.Queue())
+    root.addHandler(queue_handler)
+    pool = handler_pool.HandlerPool(
+        1, 100, _same, _same, initializer=logging_utils.reset_after_fork
+    )
+    try:
+        assert pool.run_input_handler(logging_handler, b'{}', Context('m', 2)) == b'{}'
+    finally:
+        pool.close()
+        root.removeHandler(queue_handler)
+
+    assert root.handlers == handlers
+    assert 'handled m' in capfd.readouterr().err
@@ -0,0 +1,54 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import logging
+
+import pytest
+
+from docker.build_artifacts.sagemaker import logging_utils
+
+
+def test_parse_log_levels():
+    levels = logging_utils._parse_log_levels('tfs_utils=warning, python_service=debug,')
+
+    assert levels == {'tfs_utils': 'WARNING', 'python_service': 'DEBUG'}
+
+
+def test_parse_log_levels_invalid():
+    with pytest.raises(ValueError):
+        logging_utils._parse_log_levels('tfs_utils')
+
+
+def test_request_logger_suppresses_repeated_messages(caplog):
+    request_log = logging_utils.RequestLogger(logging.getLogger('test'), per_second=0.001)
+
+    with caplog.at_level(logging.INFO, logger='test'):
+        for i in range(3):
+            request_log.info('attributes: %s', i)
+        request_log.info('other message')
+        request_log._next_allowed['attributes: %s'] = 0.0
+        request_log.info('attributes: %s', 3)
+
+    assert [r.getMessage() for r in caplog.records] == [
+        'attributes: 0',
+        'other message',
+        'attributes: 3 (2 similar messages suppressed)',
+    ]
+
+
+def test_request_logger_disabled(caplog):
+    request_log = logging_utils.RequestLogger(logging.getLogger('test'), per_second=0)
+
+    with caplog.at_level(logging.INFO, logger='test'):
+        request_log.info('attributes: %s', 1)
+
+    assert not caplog.records
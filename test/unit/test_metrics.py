@@ -0,0 +1,100 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+import metrics
+
+RECORD_INVOCATIONS = '''
+    import time
+
+    import metrics
+
+    with metrics.stage_timer('m', 'total'):
+        with metrics.stage_timer('m', 'tfs'):
+            time.sleep(0.01)
+    metrics.record_invocation('m', '200 OK')
+    metrics.record_invocation('m', '429 Too Many Requests')
+'''
+
+GENERATE = '''
+    import sys
+
+    import metrics
+
+    content_type, body = metrics.generate()
+    print(content_type)
+    sys.stdout.write(body.decode('utf-8'))
+'''
+
+
+def _run_worker(script, multiproc_dir):
+    """Run a script in a new process, with the metrics enabled as serve.py enables them for
+    the gunicorn workers, and return its output.
+    """
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.path.dirname(metrics.__file__),
+        SAGEMAKER_PYTHON_SERVICE_ENABLE_METRICS='true',
+        prometheus_multiproc_dir=str(multiproc_dir),
+    )
+    return subprocess.run(
+        [sys.executable, '-c', textwrap.dedent(script)],
+        env=env,
+        stdout=subprocess.PIPE,
+        check=True,
+        timeout=60,
+    ).stdout.decode('utf-8')
+
+
+def _samples(exposition):
+    from prometheus_client.parser import text_string_to_metric_families
+
+    return {
+        (sample.name, tuple(sorted(sample.labels.items()))): sample.value
+        for family in text_string_to_metric_families(exposition)
+        for sample in family.samples
+    }
+
+
+def test_metrics_of_all_workers_are_summed(tmpdir):
+    pytest.importorskip('prometheus_client')
+    for _ in range(2):
+        _run_worker(RECORD_INVOCATIONS, tmpdir)
+
+    content_type, exposition = _run_worker(GENERATE, tmpdir).split('\n', 1)
+    samples = _samples(exposition)
+
+    assert content_type.startswith('text/plain')
+    invocations = 'sagemaker_invocations_total'
+    assert samples[(invocations, (('model', 'm'), ('status', '200')))] == 2
+    assert samples[(invocations, (('model', 'm'), ('status', '429')))] == 2
+    for stage in ('tfs', 'total'):
+        labels = (('model', 'm'), ('stage', stage))
+        assert samples[('sagemaker_invocation_stage_seconds_count', labels)] == 2
+        assert samples[('sagemaker_invocation_stage_seconds_sum', labels)] >= 0.02
+
+
+def test_metrics_are_not_recorded_when_disabled():
+    assert not metrics.METRICS_ENABLED
+
+    with metrics.stage_timer('m', 'total'):
+        pass
+    metrics.record_invocation('m', '200 OK')
+
+    assert isinstance(metrics.INVOCATIONS, metrics._NoopMetric)
+    assert isinstance(metrics.STAGE_SECONDS, metrics._NoopMetric)
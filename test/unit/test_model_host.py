@@ -0,0 +1,83 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import json
+
+import pytest
+
+from docker.build_artifacts.sagemaker import model_host
+
+
+def _place(pool, model_name, size=1):
+    return pool.place(model_name, '/opt/ml/models/' + model_name, size).index
+
+
+def test_packs_models_up_to_max_models():
+    pool = model_host.ModelHostPool(2, max_models_per_host=2)
+
+    assert [_place(pool, name) for name in ('a', 'b', 'c', 'd')] == [0, 0, 1, 1]
+    with pytest.raises(model_host.NoCapacity):
+        _place(pool, 'e')
+
+
+def test_best_fit_by_bytes():
+    pool = model_host.ModelHostPool(3, max_bytes_per_host=100)
+    _place(pool, 'a', 70)
+    _place(pool, 'b', 50)
+
+    # fits on both running processes, and fills the first one best
+    assert _place(pool, 'c', 30) == 0
+    assert _place(pool, 'd', 60) == 2
+
+
+def test_spreads_models_without_capacity():
+    pool = model_host.ModelHostPool(2)
+
+    assert [_place(pool, name, 10) for name in ('a', 'b', 'c')] == [0, 1, 0]
+
+
+def test_remove_frees_capacity():
+    pool = model_host.ModelHostPool(1, max_models_per_host=1)
+    _place(pool, 'a')
+
+    host = pool.remove('a')
+
+    assert host.index == 0
+    assert not host.models
+    assert pool.remove('a') is None
+    assert _place(pool, 'b') == 0
+    assert pool.host_of('b') is host
+
+
+def test_state_round_trip():
+    pool = model_host.ModelHostPool(2, max_models_per_host=1)
+    _place(pool, 'a', 10)
+    pool.hosts[0].pid, pool.hosts[0].rest_port, pool.hosts[0].grpc_port = 42, 9000, 9500
+
+    restored = model_host.ModelHostPool(2, max_models_per_host=1)
+    restored.restore(json.loads(json.dumps(pool.state())))
+
+    assert restored.host_of('a').pid == 42
+    assert restored.hosts[0].models == {'a': ('/opt/ml/models/a', 10)}
+    assert _place(restored, 'b') == 1
+
+    # a stopped host without models is left out
+    restored.remove('a')
+    restored.hosts[0].pid = restored.hosts[0].rest_port = restored.hosts[0].grpc_port = None
+    assert list(restored.state()) == ['1']
+
+
+def test_model_size(tmpdir):
+    tmpdir.mkdir('1').join('saved_model.pb').write('x' * 10)
+    tmpdir.join('1').mkdir('variables').join('variables.index').write('x' * 5)
+
+    assert model_host.model_size(str(tmpdir)) == 15
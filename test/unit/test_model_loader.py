@@ -0,0 +1,77 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import threading
+
+import pytest
+
+from docker.build_artifacts.sagemaker import model_loader
+
+
+def test_loads_in_flight_are_shared():
+    release = threading.Event()
+    calls = []
+
+    def load(model_name, path):
+        calls.append((model_name, path))
+        release.wait(5)
+        return model_name
+
+    loader = model_loader.ModelLoader(load, 2)
+    future, attached = loader.submit('a', '/opt/ml/models/a')
+    assert not attached
+    assert loader.submit('a', '/opt/ml/models/a') == (future, True)
+    assert loader.in_flight('a') is future
+
+    release.set()
+    assert future.result(5) == 'a'
+    assert calls == [('a', '/opt/ml/models/a')]
+    assert loader.in_flight('a') is None
+
+    future, attached = loader.submit('a', '/opt/ml/models/a')
+    assert not attached
+    assert future.result(5) == 'a'
+    assert len(calls) == 2
+
+
+def test_parallelism():
+    release = threading.Event()
+    lock = threading.Lock()
+    running = []
+    most_running = []
+
+    def load(model_name):
+        with lock:
+            running.append(model_name)
+            most_running.append(len(running))
+        release.wait(5)
+        with lock:
+            running.remove(model_name)
+
+    loader = model_loader.ModelLoader(load, 2)
+    futures = [loader.submit(name)[0] for name in ('a', 'b', 'c', 'd')]
+    release.set()
+    for future in futures:
+        future.result(5)
+
+    assert max(most_running) <= 2
+
+
+def test_failed_load_is_not_in_flight():
+    def load(model_name):
+        raise RuntimeError('no model {}'.format(model_name))
+
+    loader = model_loader.ModelLoader(load, 1)
+    future, _ = loader.submit('a')
+    with pytest.raises(RuntimeError):
+        future.result(5)
+    assert loader.in_flight('a') is None
@@ -0,0 +1,137 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import subprocess
+import sys
+import time
+
+import pytest
+
+from docker.build_artifacts.sagemaker import model_registry
+
+
+def _registry(tmpdir):
+    return model_registry.ModelRegistry(
+        {'rest_port': range(9000, 9002), 'grpc_port': range(9500, 9503)},
+        path=str(tmpdir.join('registry.json')),
+        lock_path=str(tmpdir.join('registry.lock')),
+    )
+
+
+def test_workers_share_updates(tmpdir):
+    worker, other_worker = _registry(tmpdir), _registry(tmpdir)
+    assert other_worker.model('a') is None
+
+    with worker.update() as state:
+        ports = model_registry.take_ports(state)
+        state['models']['a'] = model_registry.new_model(state, *ports, '/opt/ml/models/a')
+    worker.model_available('a', pid=42)
+
+    entry = other_worker.model('a')
+    assert entry['state'] == model_registry.AVAILABLE
+    assert (entry['rest_port'], entry['grpc_port'], entry['pid']) == (9000, 9500, 42)
+    assert other_worker.snapshot()['ports']['free'] == [1]
+
+
+def test_snapshot_is_cached_until_the_registry_changes(tmpdir):
+    registry = _registry(tmpdir)
+    with registry.update() as state:
+        state['models']['a'] = model_registry.new_model(state, 9000, 9500, '/opt/ml/models/a')
+
+    snapshot = registry.snapshot()
+    assert registry.snapshot() is snapshot
+
+    with _registry(tmpdir).update() as state:
+        del state['models']['a']
+    assert registry.models() == {}
+
+
+def test_failed_update_is_not_written(tmpdir):
+    registry = _registry(tmpdir)
+
+    with pytest.raises(ValueError):
+        with registry.update() as state:
+            model_registry.take_ports(state)
+            raise ValueError()
+
+    assert registry.snapshot()['version'] == 0
+    assert model_registry.ports_available(registry.snapshot())
+    assert tmpdir.listdir(lambda path: path.ext == '.tmp') == []
+
+
+def test_port_slots_run_out_and_are_released(tmpdir):
+    registry = _registry(tmpdir)
+    with registry.update() as state:
+        taken = [model_registry.take_ports(state) for _ in range(3)]
+        assert taken == [(9000, 9500), (9001, 9501), None]
+        model_registry.release_ports(state, *taken[0])
+        with pytest.raises(ValueError):
+            model_registry.release_ports(state, 9001, 9500)
+
+    assert model_registry.take_ports(registry.snapshot()) == (9000, 9500)
+
+
+def test_lock_timings(tmpdir):
+    timings = []
+    lock = model_registry.FileLock(str(tmpdir.join('lock')), lambda *t: timings.append(t))
+
+    with lock:
+        pass
+    with lock:
+        pass
+
+    assert len(timings) == 2
+    assert all(wait >= 0 and hold >= 0 for wait, hold in timings)
+
+
+HOLD_LOCK = '''
+import fcntl, sys, time
+with open(sys.argv[1], 'a') as f:
+    fcntl.lockf(f.fileno(), fcntl.LOCK_EX)
+    print('locked', flush=True)
+    time.sleep(0.3)
+'''
+
+
+def test_lock_held_by_another_process_is_polled(tmpdir, monkeypatch):
+    path = str(tmpdir.join('lock'))
+    holder = subprocess.Popen([sys.executable, '-c', HOLD_LOCK, path], stdout=subprocess.PIPE)
+    assert holder.stdout.readline() == b'locked\n'
+    sleeps = []
+    timings = []
+    lock = model_registry.FileLock(path, lambda *t: timings.append(t), poll_seconds=0.01)
+
+    sleep = time.sleep
+
+    def polled_sleep(seconds):
+        sleeps.append(seconds)
+        sleep(seconds)
+
+    monkeypatch.setattr(model_registry.time, 'sleep', polled_sleep)
+    with lock:
+        pass
+
+    holder.wait()
+    assert sleeps and set(sleeps) == {0.01}
+    [(wait, _)] = timings
+    assert wait > 0.1
+
+
+def test_versions_change_on_every_load(tmpdir):
+    registry = _registry(tmpdir)
+    versions = []
+    for _ in range(2):
+        with registry.update() as state:
+            state['models']['a'] = model_registry.new_model(state, 9000, 9500, '/a')
+        versions.append(registry.model('a')['version'])
+
+    assert versions[0] != versions[1]
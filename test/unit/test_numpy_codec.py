@@ -0,0 +1,99 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import io
+import json
+
+import numpy as np
+import pytest
+
+from docker.build_artifacts.sagemaker import numpy_codec
+
+
+def test_csv_to_ndarray():
+    data = io.BytesIO(b'1.0,2.0,3.0\r\n4,5,6\n')
+
+    array = numpy_codec.csv_to_ndarray(data)
+
+    assert array.dtype == np.float32
+    np.testing.assert_array_equal(array, [[1, 2, 3], [4, 5, 6]])
+
+
+def test_csv_to_ndarray_single_row():
+    array = numpy_codec.csv_to_ndarray('1,2,3', dtype='int64')
+
+    assert array.shape == (1, 3)
+
+
+def test_csv_to_ndarray_ragged_rows():
+    with pytest.raises(ValueError):
+        numpy_codec.csv_to_ndarray('1,2,3\n4,5\n')
+
+
+def test_jsonlines_to_ndarray():
+    array = numpy_codec.jsonlines_to_ndarray(b'[1, 2]\n\n[3, 4]\n', dtype='float64')
+
+    np.testing.assert_array_equal(array, [[1, 2], [3, 4]])
+
+
+def test_tfs_json_to_ndarrays_named_instances():
+    data = json.dumps({'instances': [{'a': 1, 'b': [1, 2]}, {'a': 2, 'b': [3, 4]}]})
+
+    arrays = numpy_codec.tfs_json_to_ndarrays(data)
+
+    np.testing.assert_array_equal(arrays['a'], [1, 2])
+    np.testing.assert_array_equal(arrays['b'], [[1, 2], [3, 4]])
+
+
+def test_ndarray_to_tfs_json_round_trip():
+    array = np.arange(6, dtype=np.float32).reshape(2, 3)
+
+    for row_format in (True, False):
+        body = numpy_codec.ndarray_to_tfs_json(array, row_format=row_format)
+        np.testing.assert_array_equal(numpy_codec.tfs_json_to_ndarrays(body), array)
+
+
+def test_ndarray_to_tfs_json_named_rows():
+    body = numpy_codec.ndarray_to_tfs_json(
+        {'a': np.array([1, 2]), 'b': np.array([[1, 2], [3, 4]])}, signature_name='sig'
+    )
+
+    assert json.loads(body) == {
+        'instances': [{'a': 1, 'b': [1, 2]}, {'a': 2, 'b': [3, 4]}],
+        'signature_name': 'sig',
+    }
+
+
+def test_ndarray_to_tensor_proto():
+    tf = pytest.importorskip('tensorflow')
+    array = np.arange(6, dtype='>i4').reshape(3, 2)
+
+    tensor = numpy_codec.ndarray_to_tensor_proto(array)
+
+    np.testing.assert_array_equal(tf.make_ndarray(tensor), array)
+
+
+def test_response_view():
+    content = json.dumps({'predictions': [{'y': [1, 2], 'z': 3}, {'y': [4, 5], 'z': 6}]})
+
+    view = numpy_codec.response_view(content.encode('utf-8'), dtype='float32')
+
+    assert sorted(view.names()) == ['y', 'z']
+    np.testing.assert_array_equal(view['y'], [[1, 2], [4, 5]])
+    with pytest.raises(ValueError):
+        view.array
+
+
+def test_response_view_single_output():
+    view = numpy_codec.response_view(b'{"outputs": [[1, 2]]}')
+
+    np.testing.assert_array_equal(view.array, [[1, 2]])
@@ -0,0 +1,201 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import json
+
+import pytest
+
+import prediction_cache
+from tfs_utils import TfsResponse
+
+MISS = prediction_cache.MISS
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(prediction_cache, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    lookups = []
+    monkeypatch.setattr(
+        prediction_cache.metrics,
+        'record_prediction_cache_lookups',
+        lambda model, hits, misses: lookups.append((model, hits, misses)),
+    )
+    return lookups
+
+
+def _key(instance, model_name='m', model_version='1'):
+    return prediction_cache.PredictionCache.key(model_name, model_version, None, instance)
+
+
+def _entry_bytes():
+    # prediction 1, and model name 'm', version '1', signature None and the instance digest
+    return len('1') + len('m') + len('1') + len('None') + 40
+
+
+def test_get_many(clock, lookups):
+    cache = prediction_cache.PredictionCache(1024, 0)
+    cache.put(_key('a'), [1.5])
+
+    assert cache.get_many([_key('a'), _key('b'), _key('a', model_version='2')]) == [
+        [1.5],
+        MISS,
+        MISS,
+    ]
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert lookups == [('m', 1, 2)]
+
+
+def test_instances_differing_in_key_order_share_an_entry(clock, lookups):
+    cache = prediction_cache.PredictionCache(1024, 0)
+    cache.put(_key({'x': 1, 'y': 2}), 3)
+
+    assert cache.get_many([_key({'y': 2, 'x': 1})]) == [3]
+
+
+def test_least_recently_used_entries_are_evicted(clock, lookups):
+    cache = prediction_cache.PredictionCache(3 * _entry_bytes(), 0)
+    for instance in ('a', 'b', 'c'):
+        cache.put(_key(instance), 1)
+    assert cache.size_bytes == 3 * _entry_bytes()
+
+    cache.get_many([_key('a')])
+    cache.put(_key('d'), 1)
+
+    assert cache.get_many([_key(i) for i in ('a', 'b', 'c', 'd')]) == [1, MISS, 1, 1]
+    assert cache.evictions == 1
+    assert cache.size_bytes == 3 * _entry_bytes()
+
+
+def test_predictions_larger_than_the_cache_are_not_cached(clock, lookups):
+    cache = prediction_cache.PredictionCache(_entry_bytes(), 0)
+    cache.put(_key('a'), 1)
+    cache.put(_key('b'), list(range(100)))
+
+    assert cache.get_many([_key('a'), _key('b')]) == [1, MISS]
+    assert cache.evictions == 0
+
+
+def test_expired_entries_are_misses(clock, lookups):
+    cache = prediction_cache.PredictionCache(1024, 60)
+    cache.put(_key('a'), 1)
+
+    clock.now += 60
+    assert cache.get_many([_key('a')]) == [1]
+
+    clock.now += 1
+    assert cache.get_many([_key('a')]) == [MISS]
+    assert cache.size_bytes == 0
+
+
+def test_entries_are_dropped_when_the_model_version_changes(clock, lookups):
+    cache = prediction_cache.PredictionCache(1024, 0)
+    versions = ['1']
+    fetches = []
+
+    def fetch_version():
+        fetches.append(versions[0])
+        return versions[0]
+
+    assert cache.model_version('m', fetch_version) == '1'
+    cache.put(_key('a'), 1)
+    cache.put(_key('a', model_name='other'), 1)
+
+    versions[0] = '2'
+    clock.now += prediction_cache.MODEL_VERSION_CHECK_SECONDS - 1
+    assert cache.model_version('m', fetch_version) == '1'
+    assert cache.get_many([_key('a')]) == [1]
+
+    clock.now += 1
+    assert cache.model_version('m', fetch_version) == '2'
+    assert fetches == ['1', '2']
+    assert cache.get_many([_key('a'), _key('a', model_name='other')]) == [MISS, 1]
+
+
+def test_invalidate(clock, lookups):
+    cache = prediction_cache.PredictionCache(1024, 0)
+    cache.model_version('m', lambda: '1')
+    cache.put(_key('a'), 1)
+
+    cache.invalidate('m')
+
+    assert cache.get_many([_key('a')]) == [MISS]
+    assert cache.size_bytes == 0
+    # the served version is fetched again
+    assert cache.model_version('m', lambda: '2') == '2'
+
+
+class Context:
+    model_name = 'm'
+    model_version = '1'
+
+
+@pytest.fixture
+def sent():
+    return []
+
+
+@pytest.fixture
+def python_service(python_service, monkeypatch, lookups, sent):
+    def send_to_tfs(data, context):
+        body = json.loads(data)
+        sent.append(body)
+        predictions = [2 * i for i in body['instances']]
+        return TfsResponse(200, json.dumps({'predictions': predictions}).encode('utf-8'))
+
+    monkeypatch.setattr(python_service, '_batcher', None)
+    monkeypatch.setattr(
+        python_service, '_prediction_cache', prediction_cache.PredictionCache(1024, 0)
+    )
+    monkeypatch.setattr(python_service, '_send_to_tfs', send_to_tfs)
+    return python_service
+
+
+def _cached_predict(python_service, instances):
+    data = json.dumps({'instances': instances})
+    response = python_service._cached_predict(instances, None, Context(), data)
+    assert response.status_code == 200
+    return json.loads(response.content)['predictions']
+
+
+def test_cached_predict_sends_only_the_misses(python_service, sent):
+    assert _cached_predict(python_service, [1, 2]) == [2, 4]
+    assert sent == [{'instances': [1, 2]}]
+
+    assert _cached_predict(python_service, [3, 1, 4, 2]) == [6, 2, 8, 4]
+    assert sent[1:] == [{'instances': [3, 4]}]
+
+    assert _cached_predict(python_service, [4, 3]) == [8, 6]
+    assert len(sent) == 2
+
+
+def test_cached_predict_does_not_cache_errors(python_service, monkeypatch):
+    monkeypatch.setattr(
+        python_service, '_send_to_tfs', lambda data, context: TfsResponse(400, b'{"error": "x"}')
+    )
+    response = python_service._cached_predict([1], None, Context(), json.dumps({'instances': [1]}))
+
+    assert response.status_code == 400
+    assert python_service._prediction_cache.size_bytes == 0
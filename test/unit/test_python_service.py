@@ -0,0 +1,498 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import io
+import json
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import grpc
+import pytest
+import requests
+from falcon import testing
+
+import admission
+import grpc_utils
+import routing
+import tfs_utils
+
+
+class Response:
+    def __init__(self):
+        self.body = None
+        self.stream = None
+
+
+class Slot:
+    def __init__(self):
+        self.held = 0
+
+    @contextmanager
+    def hold(self):
+        self.held += 1
+        try:
+            yield self
+        finally:
+            self.held -= 1
+
+
+def test_slot_is_released_after_the_block(python_service):
+    res, slot = Response(), Slot()
+
+    with python_service._hold_for_stream(res, slot.hold()):
+        res.body = b'{}'
+        assert slot.held == 1
+
+    assert slot.held == 0
+
+
+def test_slot_is_released_when_the_block_raises(python_service):
+    res, slot = Response(), Slot()
+
+    with pytest.raises(ValueError):
+        with python_service._hold_for_stream(res, slot.hold()):
+            res.stream = python_service._stream_chunks(iter(['a']), 'm')
+            raise ValueError('handler error')
+
+    assert slot.held == 0
+
+
+def test_slot_is_held_until_the_stream_runs_out(python_service):
+    res, slot = Response(), Slot()
+    held = []
+
+    def chunks():
+        for chunk in ('a', b'b'):
+            held.append(slot.held)
+            yield chunk
+
+    with python_service._hold_for_stream(res, slot.hold()):
+        res.stream = python_service._stream_chunks(chunks(), 'm')
+    assert slot.held == 1
+
+    assert list(res.stream) == [b'a', b'b']
+    assert held == [1, 1]
+    assert slot.held == 0
+
+    # servers close the response after sending it
+    res.stream.close()
+    assert slot.held == 0
+
+
+def test_slot_is_released_when_the_stream_is_closed_early(python_service):
+    res, slot = Response(), Slot()
+    closed = []
+
+    def chunks():
+        try:
+            yield 'a'
+            yield 'b'
+        finally:
+            closed.append(True)
+
+    with python_service._hold_for_stream(res, slot.hold()):
+        res.body = python_service._stream_chunks(chunks(), 'm')
+
+    assert next(res.body) == b'a'
+    res.body.close()
+    assert closed == [True]
+    assert slot.held == 0
+
+
+def test_slot_is_released_when_the_stream_raises(python_service):
+    res, slot = Response(), Slot()
+
+    def chunks():
+        yield 'a'
+        raise ValueError('handler error')
+
+    with python_service._hold_for_stream(res, slot.hold()):
+        res.stream = python_service._stream_chunks(chunks(), 'm')
+
+    with pytest.raises(ValueError):
+        list(res.stream)
+    assert slot.held == 0
+
+
+def test_nested_slots_are_released_innermost_first(python_service):
+    res, outer, inner = Response(), Slot(), Slot()
+    released = []
+
+    def release_order(slot, name):
+        @contextmanager
+        def hold():
+            with slot.hold():
+                yield
+            released.append(name)
+
+        return hold()
+
+    with python_service._hold_for_stream(res, release_order(outer, 'outer')):
+        with python_service._hold_for_stream(res, release_order(inner, 'inner')):
+            res.stream = python_service._stream_chunks(iter(['a']), 'm')
+
+    assert (outer.held, inner.held) == (1, 1)
+    list(res.stream)
+    assert released == ['inner', 'outer']
+
+
+def test_streamed_invocation_holds_its_tfs_instance(python_service, monkeypatch):
+    resource = python_service.resources._python_service_resource
+    instance = resource._router.instances[0]
+
+    def handlers(data, context):
+        def chunks():
+            for _ in range(2):
+                yield '{}\n'.format(instance.in_flight)
+
+        return chunks(), 'application/jsonlines'
+
+    monkeypatch.setattr(resource, '_handlers', handlers)
+    result = testing.TestClient(python_service.app).simulate_post('/invocations', body='{}')
+
+    assert result.status_code == 200
+    assert result.text == '1\n1\n'
+    assert instance.in_flight == 0
+
+
+class RetryBudget:
+    def __init__(self):
+        self.deposits = 0
+
+    def deposit(self):
+        self.deposits += 1
+
+    def withdraw(self):
+        return False
+
+
+class Handlers:
+    """Handlers that double the JSON lines of each chunk, recording the most chunks they
+    ran at once.
+    """
+
+    def __init__(self, failing_line=None):
+        self.running = 0
+        self.max_running = 0
+        self.failing_line = failing_line
+        self._lock = threading.Lock()
+
+    def __call__(self, data, context):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            time.sleep(0.01)
+            lines = [json.loads(line) for line in data.read().splitlines()]
+            if self.failing_line in lines:
+                raise ValueError('bad line')
+            return ''.join('{}\n'.format(2 * line) for line in lines), 'application/jsonlines'
+        finally:
+            with self._lock:
+                self.running -= 1
+
+
+@pytest.fixture
+def chunked_resource(python_service, monkeypatch):
+    monkeypatch.setattr(python_service, '_chunk_executor', ThreadPoolExecutor(4))
+    monkeypatch.setattr(python_service, 'PYTHON_SERVICE_CHUNK_MIN_BYTES', 1)
+    monkeypatch.setattr(python_service, 'PYTHON_SERVICE_CHUNK_RECORDS', 2)
+    monkeypatch.setattr(python_service, 'PYTHON_SERVICE_CHUNK_PARALLELISM', 2)
+    # one invocation at a time per tfs instance, without a queue
+    monkeypatch.setattr(python_service, '_admission', admission.AdmissionController(0, 1, 0, 0))
+    resource = python_service.resources._python_service_resource
+    monkeypatch.setattr(resource, '_retry_budget', RetryBudget())
+    return resource
+
+
+def _invoke_lines(python_service, lines):
+    body = ''.join('{}\n'.format(line) for line in lines)
+    return testing.TestClient(python_service.app).simulate_post(
+        '/invocations', body=body, headers={'Content-Type': 'application/jsonlines'}
+    )
+
+
+def test_chunked_invocation(python_service, chunked_resource, monkeypatch):
+    handlers = Handlers()
+    monkeypatch.setattr(chunked_resource, '_handlers', handlers)
+
+    result = _invoke_lines(python_service, range(9))
+
+    assert result.status_code == 200
+    assert result.text == ''.join('{}\n'.format(2 * i) for i in range(9))
+    # the chunks share the admission of the request, and at most 2 of them are in flight
+    assert handlers.max_running == 2
+    assert chunked_resource._retry_budget.deposits == 1
+
+
+def test_chunked_invocation_fails_with_its_first_failed_chunk(
+    python_service, chunked_resource, monkeypatch
+):
+    monkeypatch.setattr(chunked_resource, '_handlers', Handlers(failing_line=4))
+
+    result = _invoke_lines(python_service, range(9))
+
+    assert result.status_code == 500
+    assert json.loads(result.text) == {'error': 'bad line'}
+
+
+def test_body_of_a_single_chunk_is_not_split(python_service, chunked_resource, monkeypatch):
+    handlers = Handlers()
+    monkeypatch.setattr(chunked_resource, '_handlers', handlers)
+
+    result = _invoke_lines(python_service, [1, 2])
+
+    assert result.text == '2\n4\n'
+    assert chunked_resource._retry_budget.deposits == 1
+
+
+def _invoke_with_deadline(python_service, timeout_ms, start):
+    headers = {
+        tfs_utils.CUSTOM_ATTRIBUTES_HEADER: 'tfs-timeout-ms={}'.format(timeout_ms),
+        tfs_utils.REQUEST_START_HEADER: 't={}'.format(start),
+    }
+    return testing.TestClient(python_service.app).simulate_post(
+        '/invocations', body='{}', headers=headers
+    )
+
+
+def test_request_that_expired_while_queued_is_shed(python_service, monkeypatch):
+    resource = python_service.resources._python_service_resource
+    calls = []
+    monkeypatch.setattr(resource, '_handlers', lambda data, context: calls.append(context))
+
+    result = _invoke_with_deadline(python_service, 1000, time.time() - 2)
+
+    assert result.status_code == 503
+    assert json.loads(result.text) == {
+        'error': 'request deadline exceeded before it was processed'
+    }
+    assert calls == []
+
+
+class DeadlineExceededRpcError(grpc.RpcError):
+    def code(self):
+        return grpc.StatusCode.DEADLINE_EXCEEDED
+
+
+@pytest.mark.parametrize(
+    'error',
+    [
+        tfs_utils.DeadlineExceeded('request deadline exceeded'),
+        requests.exceptions.ReadTimeout('read timed out'),
+        DeadlineExceededRpcError(),
+    ],
+)
+def test_tfs_timeout(python_service, monkeypatch, error):
+    resource = python_service.resources._python_service_resource
+    deadlines = []
+
+    def handlers(data, context):
+        deadlines.append(context.deadline)
+        raise error
+
+    monkeypatch.setattr(resource, '_handlers', handlers)
+    start = time.time()
+
+    result = _invoke_with_deadline(python_service, 60000, start)
+
+    assert result.status_code == 504
+    assert json.loads(result.text) == {'error': 'request deadline exceeded'}
+    assert deadlines == [pytest.approx(start + 60)]
+
+
+class PredictStub:
+    """A PredictionService stub predicting twice the input x as the output y."""
+
+    def __init__(self):
+        self.requests = []
+        self.Predict = types.SimpleNamespace(future=self._predict)
+
+    def _predict(self, request, timeout=None):
+        self.requests.append(request)
+        x = grpc_utils.tensor_proto_to_list(request.inputs['x'])
+        response = grpc_utils.predict_pb2.PredictResponse()
+        response.outputs['y'].CopyFrom(
+            grpc_utils.make_tensor_proto([2 * i for i in x], grpc_utils.types_pb2.DT_FLOAT)
+        )
+        return types.SimpleNamespace(result=lambda: response)
+
+
+@pytest.fixture
+def predict_stub(python_service, monkeypatch):
+    if not grpc_utils.GRPC_PREDICT_AVAILABLE:
+        pytest.skip('tensorflow-serving-api is not installed')
+    stub = PredictStub()
+    monkeypatch.setattr(grpc_utils, '_stub', lambda channel: stub)
+    # spools the request bodies, since the wsgi input of falcon's test client only allows
+    # reads of a given size
+    resource = python_service.resources._python_service_resource
+    monkeypatch.setattr(resource, '_retries_enabled', True)
+    return stub
+
+
+def _invoke_protobuf(python_service, accept, attributes=None, body=None):
+    if body is None:
+        request = grpc_utils.predict_pb2.PredictRequest()
+        request.model_spec.name = 'client'
+        request.inputs['x'].CopyFrom(
+            grpc_utils.make_tensor_proto([1.0, 2.0], grpc_utils.types_pb2.DT_FLOAT)
+        )
+        body = request.SerializeToString()
+    headers = {'Content-Type': grpc_utils.PROTOBUF_CONTENT_TYPE, 'Accept': accept}
+    if attributes:
+        headers[tfs_utils.CUSTOM_ATTRIBUTES_HEADER] = attributes
+    return testing.TestClient(python_service.app).simulate_post(
+        '/invocations', body=body, headers=headers
+    )
+
+
+def test_protobuf_response_is_chosen_by_accept(python_service, predict_stub):
+    result = _invoke_protobuf(python_service, grpc_utils.PROTOBUF_CONTENT_TYPE)
+
+    assert result.status_code == 200
+    assert result.headers['Content-Type'] == grpc_utils.PROTOBUF_CONTENT_TYPE
+    response = grpc_utils.predict_pb2.PredictResponse.FromString(result.content)
+    assert grpc_utils.tensor_proto_to_list(response.outputs['y']) == [2.0, 4.0]
+
+
+def test_json_response_is_chosen_by_accept(python_service, predict_stub):
+    result = _invoke_protobuf(python_service, 'application/json')
+
+    assert result.status_code == 200
+    assert result.headers['Content-Type'] == 'application/json'
+    assert json.loads(result.text) == {'outputs': [2.0, 4.0]}
+
+
+@pytest.mark.parametrize(
+    'attributes, model_name, version',
+    [
+        (None, 'client', 0),
+        ('tfs-model-version=3', 'client', 3),
+        ('tfs-model-name=attribute,tfs-model-version=3', 'attribute', 3),
+        # without a tfs-model-name attribute, which needs a value
+        ('other=tfs-model-name=,tfs-model-version=3', 'client', 3),
+    ],
+)
+def test_custom_attributes_override_the_model_spec(
+    python_service, predict_stub, attributes, model_name, version
+):
+    _invoke_protobuf(python_service, 'application/json', attributes)
+
+    [request] = predict_stub.requests
+    assert (request.model_spec.name, request.model_spec.version.value) == (model_name, version)
+
+
+def test_invalid_protobuf_request(python_service, predict_stub):
+    result = _invoke_protobuf(python_service, 'application/json', body=b'{"instances": [1]}')
+
+    assert result.status_code == 400
+    assert 'not a serialized PredictRequest' in json.loads(result.text)['error']
+    assert predict_stub.requests == []
+
+
+class Sender:
+    """send_to_tfs, recording the bodies it sends, failing to connect on the first
+    ``unavailable`` calls.
+    """
+
+    def __init__(self, unavailable=0):
+        self.sent = []
+        self.unavailable = unavailable
+
+    def __call__(self, data, context):
+        streamed = isinstance(data, tfs_utils.BodyStream)
+        self.sent.append((context.rest_uri, streamed, b''.join(data) if streamed else data))
+        if len(self.sent) <= self.unavailable:
+            raise requests.exceptions.ConnectionError('connection refused')
+        return tfs_utils.TfsResponse(200, b'{"predictions": [1]}')
+
+
+def _context(content_length):
+    context = tfs_utils.Context(*[None] * len(tfs_utils.Context._fields))
+    return context._replace(
+        model_name='m',
+        rest_uri='uri',
+        accept_header='application/json',
+        content_length=content_length,
+    )
+
+
+@pytest.mark.parametrize(
+    'stream_min_bytes, content_length, streamed',
+    [(0, 10, False), (10, 9, False), (10, None, False), (10, 10, True)],
+)
+def test_default_handler_streams_large_bodies(
+    python_service, monkeypatch, stream_min_bytes, content_length, streamed
+):
+    monkeypatch.setattr(python_service, 'PYTHON_SERVICE_STREAM_MIN_BYTES', stream_min_bytes)
+    sender = Sender()
+    monkeypatch.setattr(python_service, 'send_to_tfs', sender)
+    stream = io.BytesIO(b'0123456789next request')
+
+    body, content_type = python_service.default_handler(stream, _context(content_length))
+
+    assert (body, content_type) == (b'{"predictions": [1]}', 'application/json')
+    if streamed:
+        assert sender.sent == [('uri', True, b'0123456789')]
+    else:
+        assert sender.sent == [('uri', False, b'0123456789next request')]
+
+
+def test_default_handler_does_not_read_streamed_bodies(python_service, monkeypatch):
+    monkeypatch.setattr(python_service, 'PYTHON_SERVICE_STREAM_MIN_BYTES', 1)
+    stream = io.BytesIO(b'0123456789')
+    positions = []
+
+    def send_to_tfs(data, context):
+        positions.append(stream.tell())
+        return tfs_utils.TfsResponse(200, b'{}')
+
+    monkeypatch.setattr(python_service, 'send_to_tfs', send_to_tfs)
+    python_service.default_handler(stream, _context(10))
+
+    assert positions == [0]
+
+
+class FirstInstanceRouter(routing.Router):
+    def _choose(self, instances):
+        return instances[0]
+
+
+def test_spooled_body_is_sent_again_on_retry(python_service, monkeypatch):
+    resource = python_service.resources._python_service_resource
+    router = FirstInstanceRouter(['8501', '8502'], ['9000', '9001'])
+    monkeypatch.setattr(resource, '_router', router)
+    monkeypatch.setattr(resource, '_retry_budget', routing.RetryBudget(1.0))
+    monkeypatch.setattr(resource, '_retries_enabled', True)
+    monkeypatch.setattr(resource, '_tfs_rest_ports', ['8501', '8502'])
+    monkeypatch.setattr(resource, '_handlers', python_service.default_handler)
+    monkeypatch.setitem(resource._channels, '9001', None)
+    monkeypatch.setitem(resource._sessions, '8502', None)
+    # streamed from a body spooled to disk
+    monkeypatch.setattr(python_service, 'PYTHON_SERVICE_STREAM_MIN_BYTES', 1)
+    monkeypatch.setattr(python_service, 'PYTHON_SERVICE_SPOOL_MIN_BYTES', 4)
+    sender = Sender(unavailable=1)
+    monkeypatch.setattr(python_service, 'send_to_tfs', sender)
+
+    result = testing.TestClient(python_service.app).simulate_post(
+        '/invocations', body='{"instances": [1, 2]}'
+    )
+
+    assert result.status_code == 200
+    assert [(uri.split('/')[2], streamed, body) for uri, streamed, body in sender.sent] == [
+        ('localhost:8501', True, b'{"instances": [1, 2]}'),
+        ('localhost:8502', True, b'{"instances": [1, 2]}'),
+    ]
@@ -0,0 +1,186 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import json
+import threading
+import time
+
+import pytest
+
+import request_batcher
+from tfs_utils import TfsResponse
+
+KEY = ('half_plus_three', None, None)
+
+
+class Tfs:
+    """A send_fn that predicts twice each instance, and records the request bodies."""
+
+    def __init__(self, status_code=200, error=None):
+        self.status_code = status_code
+        self.error = error
+        self.bodies = []
+
+    def __call__(self, body):
+        body = json.loads(body)
+        self.bodies.append(body)
+        if self.error:
+            raise self.error
+        if self.status_code != 200:
+            return TfsResponse(self.status_code, b'{"error": "bad input"}')
+        predictions = [2 * i for i in body['instances']]
+        return TfsResponse(200, json.dumps({'predictions': predictions}).encode('utf-8'))
+
+
+@pytest.fixture
+def recorded(monkeypatch):
+    recorded = {'requests': [], 'batches': []}
+    monkeypatch.setattr(
+        request_batcher.metrics,
+        'record_batched_request',
+        lambda model, wait: recorded['requests'].append((model, wait)),
+    )
+    monkeypatch.setattr(
+        request_batcher.metrics,
+        'record_batch',
+        lambda model, size: recorded['batches'].append((model, size)),
+    )
+    return recorded
+
+
+def _submit(batcher, instances, send_fn, results, signature_name=None):
+    def _run():
+        try:
+            results[tuple(instances)] = batcher.submit(KEY, instances, signature_name, send_fn)
+        except Exception as e:  # pylint: disable=broad-except
+            results[tuple(instances)] = e
+
+    thread = threading.Thread(target=_run)
+    thread.start()
+    return thread
+
+
+def _wait_for_pending(batcher, size):
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        with batcher._lock:
+            batch = batcher._pending.get(KEY)
+            if batch and len(batch.instances) == size:
+                return
+        time.sleep(0.001)
+    raise AssertionError('the batch does not hold {} instances'.format(size))
+
+
+def _predictions(response):
+    assert response.status_code == 200
+    return json.loads(response.content)['predictions']
+
+
+def test_concurrent_requests_are_joined(recorded):
+    batcher = request_batcher.RequestBatcher(4, 5)
+    tfs = Tfs()
+    results = {}
+
+    first = _submit(batcher, [1, 2], tfs, results, signature_name='serving_default')
+    _wait_for_pending(batcher, 2)
+    second = _submit(batcher, [3, 4], tfs, results, signature_name='serving_default')
+    first.join(5)
+    second.join(5)
+
+    # the batch is sent as soon as it is full, without waiting for the timeout
+    assert tfs.bodies == [{'instances': [1, 2, 3, 4], 'signature_name': 'serving_default'}]
+    assert _predictions(results[(1, 2)]) == [2, 4]
+    assert _predictions(results[(3, 4)]) == [6, 8]
+
+    assert batcher.stats.batches == 1
+    assert batcher.stats.requests == 2
+    assert recorded['batches'] == [('half_plus_three', 4)]
+    assert [model for model, _ in recorded['requests']] == ['half_plus_three'] * 2
+    assert all(wait >= 0 for _, wait in recorded['requests'])
+
+
+def test_lone_request_is_sent_after_the_timeout(recorded):
+    batcher = request_batcher.RequestBatcher(4, 0.01)
+    tfs = Tfs()
+
+    response = batcher.submit(KEY, [1], None, tfs)
+
+    assert tfs.bodies == [{'instances': [1]}]
+    assert _predictions(response) == [2]
+    assert recorded['batches'] == [('half_plus_three', 1)]
+    assert not batcher._pending
+
+
+def test_request_overflowing_a_batch_starts_a_new_batch(recorded):
+    batcher = request_batcher.RequestBatcher(3, 5)
+    tfs = Tfs()
+    results = {}
+
+    first = _submit(batcher, [1, 2], tfs, results)
+    _wait_for_pending(batcher, 2)
+    batcher._timeout_seconds = 0.01
+    second = _submit(batcher, [3, 4], tfs, results)
+    first.join(5)
+    second.join(5)
+
+    assert sorted(body['instances'] for body in tfs.bodies) == [[1, 2], [3, 4]]
+    assert _predictions(results[(1, 2)]) == [2, 4]
+    assert _predictions(results[(3, 4)]) == [6, 8]
+    assert sorted(recorded['batches']) == [('half_plus_three', 2)] * 2
+
+
+def test_requests_for_other_keys_are_not_joined(recorded):
+    batcher = request_batcher.RequestBatcher(4, 0.05)
+    tfs = Tfs()
+    results = {}
+
+    first = _submit(batcher, [1], tfs, results)
+    other = threading.Thread(target=batcher.submit, args=(('other', None, None), [2], None, tfs))
+    other.start()
+    first.join(5)
+    other.join(5)
+
+    assert sorted(body['instances'] for body in tfs.bodies) == [[1], [2]]
+
+
+def test_error_response_is_given_to_every_request(recorded):
+    batcher = request_batcher.RequestBatcher(2, 5)
+    tfs = Tfs(status_code=400)
+    results = {}
+
+    first = _submit(batcher, [1], tfs, results)
+    _wait_for_pending(batcher, 1)
+    second = _submit(batcher, [2], tfs, results)
+    first.join(5)
+    second.join(5)
+
+    assert len(tfs.bodies) == 1
+    for response in results.values():
+        assert response.status_code == 400
+        assert response.content == b'{"error": "bad input"}'
+
+
+def test_exception_is_raised_to_every_request(recorded):
+    batcher = request_batcher.RequestBatcher(2, 5)
+    error = ConnectionError('tfs is down')
+    tfs = Tfs(error=error)
+    results = {}
+
+    first = _submit(batcher, [1], tfs, results)
+    _wait_for_pending(batcher, 1)
+    second = _submit(batcher, [2], tfs, results)
+    first.join(5)
+    second.join(5)
+
+    assert len(tfs.bodies) == 1
+    assert results == {(1,): error, (2,): error}
+    assert len(recorded['requests']) == 2
@@ -0,0 +1,108 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import pytest
+
+from docker.build_artifacts.sagemaker import routing
+
+REST_PORTS = ['9001', '9003', '9005']
+GRPC_PORTS = ['9000', '9002', '9004']
+
+
+@pytest.mark.parametrize('policy', sorted(routing.ROUTING_POLICIES))
+def test_route_returns_matched_ports(policy):
+    router = routing.create_router(policy, REST_PORTS, GRPC_PORTS)
+
+    for _ in range(20):
+        with router.route() as instance:
+            assert REST_PORTS.index(instance.rest_port) == GRPC_PORTS.index(instance.grpc_port)
+            assert instance.in_flight == 1
+        assert instance.in_flight == 0
+
+
+def test_round_robin_visits_every_instance():
+    router = routing.create_router('round_robin', REST_PORTS, GRPC_PORTS)
+
+    ports = []
+    for _ in range(len(REST_PORTS)):
+        with router.route() as instance:
+            ports.append(instance.rest_port)
+
+    assert sorted(ports) == REST_PORTS
+
+
+def test_least_outstanding_avoids_busy_instances():
+    router = routing.create_router('least_outstanding', REST_PORTS, GRPC_PORTS)
+
+    with router.route() as first, router.route() as second, router.route() as third:
+        assert len({first.rest_port, second.rest_port, third.rest_port}) == 3
+        with router.route() as fourth:
+            assert fourth.in_flight == 2
+
+
+def test_in_flight_released_on_error():
+    router = routing.create_router('power_of_two_choices', REST_PORTS, GRPC_PORTS)
+
+    with pytest.raises(ValueError):
+        with router.route():
+            raise ValueError('handler failed')
+
+    assert all(instance.in_flight == 0 for instance in router.instances)
+
+
+def test_invalid_policy():
+    with pytest.raises(ValueError) as e:
+        routing.create_router('fastest', REST_PORTS, GRPC_PORTS)
+    assert 'SAGEMAKER_TFS_ROUTING_POLICY' in str(e.value)
+
+
+def test_circuit_breaker_skips_failing_instance():
+    router = routing.create_router('round_robin', REST_PORTS, GRPC_PORTS, failure_threshold=2)
+    failing = router.instances[0]
+
+    router.record_failure(failing)
+    router.record_failure(failing)
+
+    for _ in range(10):
+        with router.route() as instance:
+            assert instance is not failing
+
+    router.record_success(failing)
+    assert failing.circuit_open_until == 0
+
+
+def test_restarting_instance_is_skipped():
+    router = routing.create_router('random', REST_PORTS, GRPC_PORTS,
+                                   unavailable_ports_fn=lambda: {'9001', '9003'})
+
+    for _ in range(10):
+        with router.route() as instance:
+            assert instance.rest_port == '9005'
+
+
+def test_excluded_instances_used_as_last_resort():
+    router = routing.create_router('least_outstanding', REST_PORTS[:1], GRPC_PORTS[:1])
+
+    with router.route(excluded=router.instances) as instance:
+        assert instance is router.instances[0]
+
+
+def test_retry_budget():
+    budget = routing.RetryBudget(0.5, max_balance=2)
+
+    assert budget.withdraw()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+    budget.deposit()
+    budget.deposit()
+    assert budget.withdraw()
@@ -0,0 +1,244 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import io
+
+import pytest
+
+import tfs_utils
+
+NOW = 1000.0
+
+
+class Clock:
+    def __init__(self):
+        self.now = NOW
+
+    def time(self):
+        return self.now
+
+
+class Request:
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+    def get_header(self, name):
+        return self.headers.get(name)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(tfs_utils, 'time', clock)
+    return clock
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    yield
+    tfs_utils._request_timeout_seconds.cache_clear()
+    tfs_utils._request_target.cache_clear()
+    tfs_utils._parse_custom_attributes_header.cache_clear()
+
+
+def _request(timeout_ms=None, start=None):
+    headers = {}
+    if timeout_ms is not None:
+        headers[tfs_utils.CUSTOM_ATTRIBUTES_HEADER] = 'tfs-timeout-ms={}'.format(timeout_ms)
+    if start is not None:
+        headers[tfs_utils.REQUEST_START_HEADER] = start
+    return Request(headers)
+
+
+def test_deadline_counts_from_when_nginx_received_the_request(clock):
+    assert tfs_utils.request_deadline(_request(500, start='t=990.25')) == 990.75
+
+
+@pytest.mark.parametrize('start', [None, '', '990.25', 't=', 't=abc', 'ts=990.25'])
+def test_deadline_counts_from_now_without_a_valid_request_start(clock, start):
+    assert tfs_utils.request_deadline(_request(500, start=start)) == NOW + 0.5
+
+
+@pytest.mark.parametrize('timeout_ms', [None, 'abc', '1.5', '0', '-10'])
+def test_no_deadline_without_a_valid_timeout(clock, timeout_ms):
+    assert tfs_utils.request_deadline(_request(timeout_ms, start='t=990.25')) is None
+
+
+@pytest.mark.parametrize('timeout_ms', [None, 'abc'])
+def test_default_timeout(clock, monkeypatch, timeout_ms):
+    monkeypatch.setattr(tfs_utils, 'REQUEST_TIMEOUT_MS', 2000)
+
+    assert tfs_utils.request_deadline(_request(timeout_ms)) == NOW + 2
+
+
+def test_time_remaining(clock):
+    context = tfs_utils.Context(*[None] * len(tfs_utils.Context._fields))
+    assert tfs_utils.time_remaining(context) is None
+
+    context = context._replace(deadline=NOW + 0.5)
+    assert tfs_utils.time_remaining(context) == 0.5
+
+    clock.now += 0.5
+    with pytest.raises(tfs_utils.DeadlineExceeded):
+        tfs_utils.time_remaining(context)
+
+
+def test_body_stream_reads_only_its_content_length():
+    stream = io.BytesIO(b'0123456789next request')
+    body = tfs_utils.BodyStream(stream, 10, chunk_size=4)
+
+    assert len(body) == 10
+    assert body.read(3) == b'012'
+    assert len(body) == 7
+    assert body.read() == b'3456789'
+    assert body.read() == b''
+    assert stream.read() == b'next request'
+
+
+def test_body_stream_is_iterated_in_chunks():
+    body = tfs_utils.BodyStream(io.BytesIO(b'0123456789next request'), 10, chunk_size=4)
+
+    assert list(body) == [b'0123', b'4567', b'89']
+
+
+def test_body_stream_reads_lines():
+    body = tfs_utils.BodyStream(io.BytesIO(b'1,2\n3,4\nnext'), 8)
+
+    assert list(iter(body.readline, b'')) == [b'1,2\n', b'3,4\n']
+
+
+@pytest.mark.parametrize('max_memory_bytes, on_disk', [(100, False), (10, True)])
+def test_spool_body(max_memory_bytes, on_disk):
+    content = b'x' * 50
+    body = tfs_utils.spool_body(io.BytesIO(content), max_memory_bytes)
+
+    assert body._rolled == on_disk
+    # read again for every retry
+    assert body.read() == content
+    body.seek(0)
+    assert body.read() == content
+    body.close()
+
+
+class RequestWithBody(Request):
+    def __init__(self, headers=None, content_length=None):
+        super().__init__(headers)
+        self.content_length = content_length
+        self.stream = io.BytesIO(b'{}')
+
+
+def _attributes(header):
+    return {tfs_utils.CUSTOM_ATTRIBUTES_HEADER: header} if header else {}
+
+
+@pytest.mark.parametrize(
+    'header, rest_port, model_name, expected',
+    [
+        (None, '8501', None, ('default', None, None, 'default:predict', '9000')),
+        (None, '8502', None, ('default', None, None, 'default:predict', '9001')),
+        (None, '8501', 'url', ('url', None, None, 'url:predict', '9000')),
+        (
+            'tfs-model-name=a,tfs-model-version=2,tfs-method=classify',
+            '8501',
+            None,
+            ('a', '2', 'classify', 'a/versions/2:classify', '9000'),
+        ),
+        # the model name of the url takes precedence
+        ('tfs-model-name=a', '8501', 'url', ('url', None, None, 'url:predict', '9000')),
+    ],
+)
+def test_request_target(header, rest_port, model_name, expected):
+    grpc_port = {'8501': '9000', '8502': '9001'}[rest_port]
+    for _ in range(2):
+        # the second request gets the cached target
+        _, context = tfs_utils.parse_request(
+            RequestWithBody(_attributes(header)), rest_port, grpc_port, 'default', model_name
+        )
+        name, version, method, uri_suffix, context_grpc_port = expected
+        assert (context.model_name, context.model_version, context.method) == (
+            name,
+            version,
+            method,
+        )
+        assert context.rest_uri == 'http://localhost:{}/v1/models/{}'.format(
+            rest_port, uri_suffix
+        )
+        assert context.grpc_port == context_grpc_port
+    assert tfs_utils._request_target.cache_info().hits == 1
+
+
+def test_targets_of_different_keys_are_cached_apart():
+    targets = [
+        tfs_utils._request_target(header, rest_port, '9000', 'default', model_name)
+        for header, rest_port, model_name in [
+            ('tfs-model-name=a', '8501', None),
+            ('tfs-model-name=b', '8501', None),
+            ('tfs-model-name=a', '8502', None),
+            ('tfs-model-name=a', '8501', 'c'),
+        ]
+    ]
+
+    assert [target[3] for target in targets] == [
+        'http://localhost:8501/v1/models/a:predict',
+        'http://localhost:8501/v1/models/b:predict',
+        'http://localhost:8502/v1/models/a:predict',
+        'http://localhost:8501/v1/models/c:predict',
+    ]
+    assert tfs_utils._request_target.cache_info().currsize == 4
+
+
+def test_parse_tfs_custom_attributes_returns_a_new_dict():
+    request = Request(_attributes('tfs-model-name=a,other=1'))
+
+    attributes = tfs_utils.parse_tfs_custom_attributes(request)
+    attributes['tfs-model-name'] = 'changed'
+
+    assert tfs_utils.parse_tfs_custom_attributes(request) == {'tfs-model-name': 'a'}
+    assert tfs_utils._parse_custom_attributes_header.cache_info().hits == 1
+
+
+def test_parse_request_sets_every_context_field():
+    headers = {
+        tfs_utils.CUSTOM_ATTRIBUTES_HEADER: 'tfs-model-name=a',
+        'Content-Type': 'text/csv',
+        'Accept': 'application/jsonlines',
+    }
+    request = RequestWithBody(headers, content_length=2)
+
+    data, context = tfs_utils.parse_request(
+        request,
+        '8501',
+        '9000',
+        'default',
+        channel='channel',
+        session='session',
+        aio_session='aio_session',
+    )
+
+    assert data is request.stream
+    assert len(context) == len(tfs_utils.Context._fields)
+    assert context._asdict() == {
+        'model_name': 'a',
+        'model_version': None,
+        'method': None,
+        'rest_uri': 'http://localhost:8501/v1/models/a:predict',
+        'grpc_port': '9000',
+        'channel': 'channel',
+        'custom_attributes': 'tfs-model-name=a',
+        'request_content_type': 'text/csv',
+        'accept_header': 'application/jsonlines',
+        'content_length': 2,
+        'rest_session': 'session',
+        'aio_session': 'aio_session',
+        'codec': tfs_utils.numpy_codec,
+        'deadline': None,
+    }
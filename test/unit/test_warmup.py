@@ -0,0 +1,59 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import os
+
+import falcon
+
+from docker.build_artifacts.sagemaker import warmup
+
+
+def test_load_samples(tmpdir):
+    tmpdir.join('2.csv').write('1,2,3')
+    tmpdir.join('1.json').write('{"instances": [1.0]}')
+    tmpdir.join('README.txt').write('not a sample')
+    tmpdir.mkdir('nested')
+
+    samples = warmup.load_samples(str(tmpdir))
+
+    assert samples == [
+        warmup.Sample('1.json', b'{"instances": [1.0]}', 'application/json'),
+        warmup.Sample('2.csv', b'1,2,3', 'text/csv'),
+    ]
+
+
+def test_warmup_run(tmpdir):
+    requests = []
+
+    def invoke(req, res):
+        requests.append((req.path, req.content_type, req.stream.read(req.content_length)))
+        res.status = falcon.HTTP_200
+
+    samples = [warmup.Sample('1.csv', b'1,2,3', 'text/csv')]
+    warmup_run = warmup.Warmup(invoke, samples, status_dir=str(tmpdir), rounds=2)
+
+    assert not warmup_run.done
+    warmup_run.run()
+
+    assert warmup_run.done
+    assert requests == [('/invocations', 'text/csv', b'1,2,3')] * 2
+    assert os.listdir(str(tmpdir)) == [str(os.getpid())]
+
+
+def test_warmup_run_survives_failed_requests():
+    def invoke(req, res):
+        raise ValueError('handler failed')
+
+    warmup_run = warmup.Warmup(invoke, [warmup.Sample('1.json', b'{}', 'application/json')])
+    warmup_run.run()
+
+    assert warmup_run.done
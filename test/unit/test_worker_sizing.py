@@ -0,0 +1,64 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License'). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the 'license' file accompanying this file. This file is
+# distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+from docker.build_artifacts.sagemaker import worker_sizing
+
+
+def _cpu_limit(tmpdir, cpu_max=None, quota=None, period='100000'):
+    paths = {}
+    for name, content in (('cpu.max', cpu_max), ('quota', quota), ('period', period)):
+        path = tmpdir.join(name)
+        if content is not None:
+            path.write(content)
+        paths[name] = str(path)
+    return worker_sizing.cpu_limit(paths['cpu.max'], paths['quota'], paths['period'])
+
+
+def test_cpu_limit_cgroup_v2(tmpdir):
+    assert _cpu_limit(tmpdir, cpu_max='250000 100000') == (2.5, 'cgroup v2 cpu.max')
+
+
+def test_cpu_limit_cgroup_v1(tmpdir):
+    assert _cpu_limit(tmpdir, quota='400000') == (4.0, 'cgroup v1 cpu.cfs_quota_us')
+
+
+def test_cpu_limit_without_quota(tmpdir):
+    cpus, source = _cpu_limit(tmpdir, cpu_max='max 100000', quota='-1')
+
+    assert cpus >= 1
+    assert source in ('cpu affinity', 'cpu count')
+
+
+def test_choose_io_bound_handlers():
+    decision = worker_sizing.choose(72, 1)
+
+    assert (decision.workers, decision.threads, decision.worker_class) == (18, 1, 'gevent')
+    assert decision.reasons
+
+
+def test_choose_cpu_bound_handlers():
+    decision = worker_sizing.choose(8, 1, cpu_ratio=0.8)
+
+    assert (decision.workers, decision.threads, decision.worker_class) == (7, 2, 'gthread')
+
+
+def test_choose_at_least_one_worker_per_tfs_instance():
+    decision = worker_sizing.choose(4, 3, cpu_ratio=0.1)
+
+    assert decision.workers == 3
+
+
+def test_choose_fixed_worker_class():
+    decision = worker_sizing.choose(0.5, 1, fixed_worker_class='uvicorn.workers.UvicornWorker')
+
+    assert decision.workers == 1
+    assert decision.worker_class == 'uvicorn.workers.UvicornWorker'